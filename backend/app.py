@@ -1,21 +1,34 @@
 import json
 import pickle
 from datetime import datetime
+from io import BytesIO
 
 import numpy as np
 import requests
-from flask import Flask, jsonify, render_template, request
+from flask import Flask, Response, jsonify, render_template, request, stream_with_context
 from flask_cors import CORS
-from time import sleep
 from math import ceil
 import os
-from random import randint
-from requests import HTTPError
+import threading
+import time
 import pandas as pd
-from realtorAPI import get_coordinates, get_property_list, get_property_details
+from realtorAPI import get_coordinates, get_property_list
 import matplotlib.pyplot as plt
 from flasgger import Swagger
 from pymongo import MongoClient
+from bson import ObjectId
+from bson.errors import InvalidId
+import metrics
+from metrics import observe_stage, stage_timer
+from ingest import data_version, project_fields
+import sync
+import rollups
+from chart_cache import ChartCache
+from crawl_scheduler import CrawlScheduler, SchedulerNotRunning
+from details_enrichment import DetailsEnricher
+from geocode_index import CityIndex
+from lease import Lease
+from snapshot import SnapshotStore
 
 # use Agg backend for plotting
 plt.switch_backend('Agg')
@@ -39,6 +52,13 @@ swagger_config = {
 
 FRONTEND_URL = os.environ.get('FRONTEND_URL', 'http://localhost:3000')
 MONGODB_URI = os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/')
+MONGODB_DB = os.environ.get('MONGODB_DB', 'rentalai_db')
+# Largest page of listings a client can request at once
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+# 'background' syncs the CSV data into MongoDB in a thread at startup
+SYNC_ON_STARTUP = os.environ.get('SYNC_ON_STARTUP', 'off')
+# 'on' runs the crawl jobs in this process, while it holds the scheduler's lease in the meta collection
+CRAWL_SCHEDULER = os.environ.get('CRAWL_SCHEDULER', 'off')
 
 
 app = Flask(__name__)
@@ -46,127 +66,100 @@ CORS(app, origins=[FRONTEND_URL])
 
 swag = Swagger(app, config=swagger_config)
 
+# Per-stage latency histograms, served on /metrics
+metrics.init_app(app)
+
 # Initialize MongoDB connection
 client = MongoClient(MONGODB_URI)
-db = client['rentalai_db']
+db = client[MONGODB_DB]
 properties_collection = db['properties']
 test_collection = db['test_data']
+stats_collection = db['listing_stats']
+timeseries_collection = db['rent_timeseries']
+meta_collection = db['meta']
+
+# Rendered charts, one file per chart and data version
+chart_cache = ChartCache()
+# Memory-mapped columnar copies of the collections, one file per data version
+snapshots = SnapshotStore(db)
+
+# Stale rollups are rebuilt by one background thread at a time, requests don't wait for it
+rollups_backfill_lock = threading.Lock()
+# Seconds clients are told to wait while the rollups are rebuilt
+ROLLUPS_RETRY_AFTER = 5
+
+
+class RollupsPending(Exception):
+    """ The rollups are being rebuilt, the request is answered with a 503. """
+
+
+def backfill_rollups():
+    try:
+        if rollups.backfill(properties_collection, stats_collection, timeseries_collection):
+            print("Rebuilt the rent rollups")
+    except Exception as e:
+        print(f"Error rebuilding the rent rollups: {e}")
+    finally:
+        rollups_backfill_lock.release()
+
+
+# Function to start the rebuild of the rollups of listings loaded before they existed, or of another bin width
+def check_rollups():
+    if not rollups.stale(properties_collection, stats_collection):
+        return
+    if rollups_backfill_lock.acquire(blocking=False):
+        threading.Thread(target=backfill_rollups, name='rollups-backfill', daemon=True).start()
+    raise RollupsPending("Rent statistics are being computed, retry shortly")
 
-# Function to load data from CSV to MongoDB
+
+def rollups_pending_response(e):
+    return jsonify({"error": str(e)}), 503, {'Retry-After': str(ROLLUPS_RETRY_AFTER)}
+
+
+# Function to sync the CSV data into MongoDB, only changed rows are written (see sync.py)
 def load_data_to_mongodb():
     try:
-        # Load OttawaON data
-        ottawa_df = pd.read_csv('OttawaON.csv')
-        
-        # Convert DataFrame to list of dictionaries
-        ottawa_records = ottawa_df.to_dict('records')
-        
-        # clear existing data and insert new data
-        properties_collection.delete_many({})
-        properties_collection.insert_many(ottawa_records)
-        
-        # Load test_set data
-        test_df = pd.read_csv('test_set.csv')
-        
-        # Convert DataFrame to list of dictionaries
-        test_records = test_df.to_dict('records')
-        
-        # clear existing data and insert new data 
-        test_collection.delete_many({})
-        test_collection.insert_many(test_records)
-        
+        sync.run_sync(db)
         print("Data successfully loaded into MongoDB")
     except Exception as e:
         print(f"Error loading data to MongoDB: {e}")
 
-# Call this function when the app starts
-load_data_to_mongodb()
+# Run `python sync.py` to load the data, or set SYNC_ON_STARTUP=background
+# to sync when the app starts without delaying it
+if SYNC_ON_STARTUP == 'background':
+    threading.Thread(target=load_data_to_mongodb, daemon=True).start()
 
 # Handle OPTIONS requests (preflight)
 # @app.route('/', methods=['OPTIONS'])
 # def handle_options():
 #     return '', 200, {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Headers': '*','Content-Type':'application/json'}
 
-def get_property_list_by_city(city, building_type):
-    """ Gets a list of properties for a given city, and caches it. """
-
-    # coords = get_coordinates(city)  # Creates bounding box for city
-    coords = ["44.9617738","45.5376502","-76.3555857","-75.2465783"] # Ottawa
-    max_pages = 1
-    current_page = 1
-    filename = "Ottawa2025.csv"
-
-    # data = pd.DataFrame()
-    if os.path.exists(filename):
-        results_df = pd.read_csv(filename)
-        ## If the queries were interrupted, this will resume from the last page
-        current_page = ceil(results_df.shape[0]/200) + 1
-        max_pages = current_page + 1
-    else:
-        results_df = pd.DataFrame()
-    while current_page <= max_pages:
-        try:
-            data = get_property_list(
-                coords[0], coords[1], 
-                coords[2], coords[3],
-                building_type,
-                current_page=current_page)
-            ## Rounds up the total records by the records per page to nearest int
-            max_pages = ceil(data["Paging"]["TotalRecords"]/data["Paging"]["RecordsPerPage"])
-            for json in data["Results"]:
-                # Use concat instead of append (which is deprecated)
-                new_row = pd.json_normalize(json)
-                results_df = pd.concat([results_df, new_row], ignore_index=True)
-
-            print("continuing: " + str(current_page))
-            # Save after each successful page fetch
-            results_df.to_csv(filename, index=False)
-            current_page += 1
-
-            sleep(randint(600, 900))  # sleep 10-15 minutes to avoid rate-limit
-        except HTTPError:
-            print("Error occurred on city: " + city)
-            sleep(randint(3000, 3600))  # sleep for 50-60 minutes if limited
-
-    return results_df
-
-
-# def get_property_details_from_csv(filename):
-#     """ Gets the details of a list of properties from the CSV file created above. """
-#     results_df = pd.read_csv(filename)
-#     if "HasDetails" not in results_df.columns:
-#         results_df["HasDetails"] = 0
-#     for index, row in results_df.iterrows():
-#         if row["HasDetails"] == 1:
-#             continue
-#         property_id = str(row["Id"])
-#         mls_reference_number = str(row["MlsNumber"])
-#         try:
-#             data = get_property_details(property_id, mls_reference_number)
-#             results_df = results_df.join(pd.json_normalize(data), lsuffix='_')
-#             results_df.loc[index, 'HasDetails'] = 1
-#
-#             try:
-#                 # Step 1: Read the existing CSV file into a DataFrame
-#                 existing_df = pd.read_csv(filename)
-#             except FileNotFoundError:
-#                 # Handle the case where the file doesn't exist initially
-#                 existing_df = pd.DataFrame()
-#
-#             # Step 2: Append new data
-#             results_df = pd.concat([existing_df, results_df])
-#
-#             # Step 3: Remove redundancy
-#             combined_df = results_df.drop_duplicates(subset='Id')
-#
-#             # Step 4: Save updated dataframe
-#             combined_df.to_csv(filename, index=False)
-#
-#             sleep(randint(600, 900))
-#         except HTTPError:
-#             print("Error occurred on propertyID: " + property_id)
-#             sleep(randint(3000, 3600))
-#     return results_df
+# Function to fetch one page of the listings in a bounding box for the crawl scheduler
+def fetch_listings_page(bounding_box, building_type, page):
+    return get_property_list(
+        bounding_box[0], bounding_box[1],
+        bounding_box[2], bounding_box[3],
+        building_type,
+        current_page=page)
+
+
+# BuildingTypeId
+#     1 House
+#     17 Apartment
+BUILDING_TYPES = [1, 17]
+
+# Crawls run in the background, tile by tile and page by page, and resume after a restart
+city_index = CityIndex()
+crawl_scheduler = CrawlScheduler(city_index.bounding_box, fetch_listings_page,
+                                 ingest=lambda records: sync.upsert_listings(db, records),
+                                 lease=Lease(meta_collection, 'crawl_scheduler'))
+# The debug reloader's parent process only watches the files, its child serves the app
+RELOADER_PARENT = __name__ == '__main__' and os.environ.get('WERKZEUG_RUN_MAIN') != 'true'
+if CRAWL_SCHEDULER == 'on' and not RELOADER_PARENT:
+    crawl_scheduler.start()
+
+# Details are fetched under the crawler's rate limit, only for new and edited listings
+details_enricher = DetailsEnricher(db, limiter=crawl_scheduler.limiter)
 
 
 @app.route('/api/home', methods=['GET'])
@@ -206,52 +199,479 @@ def list_properties():
         return jsonify({"error": str(e)}), 500
 
 
-@app.route('/api/property/<city>', methods=['GET'])
+# Function to add the status URL to a crawl job
+def crawl_job_response(job, status=200):
+    status_url = f"/api/crawls/{job['id']}"
+    response = jsonify(dict(job, status_url=status_url))
+    response.status_code = status
+    if status == 202:
+        response.headers['Location'] = status_url
+    return response
+
+
+@app.route('/api/property/<city>', methods=['GET', 'POST'])
 def update(city):
-    # df_new = get_property_details_from_csv(city)
-    # BuildingTypeId
-    #     1 House
-    #     17 Apartment
-    houses = 1
-    # results_houses = get_property_list_by_city(city, building_type=houses)
-
-    apartments = 17
-    result_apartments = get_property_list_by_city(city, building_type=apartments)
-
-    # Check if result_apartments is a DataFrame
-    # if isinstance(result_apartments, pd.DataFrame):
-    #     # Concatenate the two DataFrames
-    #     results_df = pd.concat([results_df, result_apartments], ignore_index=True)
-    # else:
-    #     print(f"Invalid result type: {type(result_apartments)}")
-    #
-    # # Convert DataFrame to a list of dictionaries
-    # data = results_df.to_json(orient='records')
-    #
-    # # Convert the data to JSON
-    # json_data = json.loads(data)
-
-    # Concatenate DataFrames
-    concatenated_df = pd.concat([result_apartments], ignore_index=True)
-    # Convert the DataFrame to JSON and return as a response
-    json_data = concatenated_df.to_json(orient='records')
-
-    return json_data
+    """
+    Crawl the listings of a city
+
+    The crawl covers the city's houses and apartments. It runs in the
+    background at the API's rate limit and its listings are upserted into
+    MongoDB page by page. Submitting a city that is already being crawled
+    returns the running job.
+    ---
+    parameters:
+      - in: path
+        name: city
+        type: string
+        required: true
+    responses:
+      202:
+        description: Returns the crawl job, poll its status_url for progress
+      503:
+        description: This process doesn't run the crawl jobs (CRAWL_SCHEDULER is off or another process holds its lease)
+    """
+    try:
+        job = crawl_scheduler.submit(city, BUILDING_TYPES)
+        return crawl_job_response(job, 202)
+    except SchedulerNotRunning as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/crawls', methods=['GET'])
+def list_crawls():
+    """
+    List crawl jobs
+    ---
+    responses:
+      200:
+        description: Returns the active and recently finished crawl jobs
+    """
+    return jsonify([dict(job, status_url=f"/api/crawls/{job['id']}") for job in crawl_scheduler.list()])
+
+
+@app.route('/api/crawls', methods=['POST'])
+def submit_crawls():
+    """
+    Crawl several cities
+
+    Queues one job per city, the jobs run concurrently under the shared rate limit.
+    ---
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: object
+          properties:
+            cities:
+              type: array
+              items:
+                type: string
+            building_types:
+              type: array
+              items:
+                type: integer
+              description: BuildingTypeIds, houses (1) and apartments (17) by default
+    responses:
+      202:
+        description: Returns the crawl jobs
+      400:
+        description: No cities given
+      503:
+        description: This process doesn't run the crawl jobs (CRAWL_SCHEDULER is off or another process holds its lease)
+    """
+    body = request.get_json(silent=True) or {}
+    cities = body.get('cities') or []
+    if not isinstance(cities, list) or not cities:
+        return jsonify({"error": "cities must be a non-empty list"}), 400
+    try:
+        building_types = [int(building_type) for building_type in body.get('building_types') or BUILDING_TYPES]
+        jobs = [crawl_scheduler.submit(city, building_types) for city in cities]
+        return jsonify([dict(job, status_url=f"/api/crawls/{job['id']}") for job in jobs]), 202
+    except SchedulerNotRunning as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/crawls/<job_id>', methods=['GET'])
+def get_crawl(job_id):
+    """
+    Crawl progress
+    ---
+    parameters:
+      - in: path
+        name: job_id
+        type: string
+        required: true
+    responses:
+      200:
+        description: >
+          Returns the job's status (queued, running, waiting, backoff, done or failed),
+          pages fetched, tiles done out of tiles, records crawled, last_error and next_attempt (epoch seconds)
+      404:
+        description: Unknown job
+    """
+    job = crawl_scheduler.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown crawl job: {job_id}"}), 404
+    return crawl_job_response(job)
+
+
+@app.route('/api/details', methods=['POST'])
+def enrich_details():
+    """
+    Fetch the details of new and edited listings
+
+    Runs in the background, a run already in progress is returned as it is.
+    ---
+    parameters:
+      - in: query
+        name: limit
+        type: integer
+        required: false
+        description: Listings to fetch at most
+    responses:
+      202:
+        description: Returns the run's status, poll GET /api/details for progress
+    """
+    limit = request.args.get('limit', type=int)
+    response = jsonify(details_enricher.start(limit))
+    response.status_code = 202
+    response.headers['Location'] = '/api/details'
+    return response
+
+
+@app.route('/api/details', methods=['GET'])
+def get_details_status():
+    """
+    Details enrichment progress
+    ---
+    responses:
+      200:
+        description: >
+          Returns the status (idle, running, done, stopped or failed) of the last run
+          and its counts of pending, fetched, failed and rate limited listings
+    """
+    return jsonify(details_enricher.status())
+
+
+# Function to serialize a document as JSON, NaN (missing CSV values) becomes null
+def document_to_json(document):
+    return json.dumps({key: None if isinstance(value, float) and value != value else value
+                       for key, value in document.items()}, default=str)
 
 
 @app.route('/api/get_data', methods=['GET'])
 def get_data():
     """
-    Get all property data
+    Get property data
+
+    Documents are streamed while the cursor is read. Without a limit the whole
+    collection is returned as a JSON array. With a limit, one page is returned
+    as {"data": [...], "next_cursor": ...}; pass next_cursor back as cursor to
+    get the next page. With format=ndjson, documents are returned one per line
+    and a page ends with a {"next_cursor": ...} line.
     ---
+    parameters:
+      - in: query
+        name: fields
+        type: string
+        required: false
+        description: Comma-separated fields to return, e.g. Id,Property.LeaseRent
+      - in: query
+        name: limit
+        type: integer
+        required: false
+        description: Page size, at most MAX_PAGE_SIZE
+      - in: query
+        name: cursor
+        type: string
+        required: false
+        description: The next_cursor of the previous page
+      - in: query
+        name: format
+        type: string
+        enum: [json, ndjson]
+        required: false
     responses:
       200:
-        description: Returns all property data from MongoDB
+        description: Returns property data from MongoDB
+      400:
+        description: Invalid limit or cursor
     """
     try:
-        # Get all properties from MongoDB
-        properties = list(properties_collection.find({}, {'_id': 0}))
-        return jsonify(properties)
+        limit = request.args.get('limit', type=int)
+        cursor = request.args.get('cursor')
+        ndjson = request.args.get('format') == 'ndjson'
+        paginated = limit is not None or cursor is not None
+
+        if limit is not None and limit < 1:
+            return jsonify({"error": "limit must be positive"}), 400
+        if paginated:
+            limit = min(limit or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+
+        # Keyset pagination on _id, which is always indexed
+        query = {}
+        if cursor:
+            try:
+                query['_id'] = {'$gt': ObjectId(cursor)}
+            except (InvalidId, TypeError):
+                return jsonify({"error": f"Invalid cursor: {cursor}"}), 400
+
+        fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
+
+        started = time.perf_counter()
+        pipeline = [{'$match': query}, {'$sort': {'_id': 1}}]
+        if paginated:
+            # One extra document tells whether there is a next page
+            pipeline.append({'$limit': limit + 1})
+        if fields:
+            pipeline.append(project_fields(fields))
+        documents = properties_collection.aggregate(pipeline)
+        fetch_seconds = time.perf_counter() - started
+
+        def generate():
+            # The cursor fetches its batches while the response streams, only the time spent in it counts
+            nonlocal fetch_seconds
+            if not ndjson:
+                yield '{"data": [' if paginated else '['
+            count = 0
+            last_id = None
+            has_more = False
+            try:
+                while True:
+                    started = time.perf_counter()
+                    document = next(documents, None)
+                    fetch_seconds += time.perf_counter() - started
+                    if document is None:
+                        break
+                    if paginated and count == limit:
+                        has_more = True
+                        break
+                    last_id = document.pop('_id')
+                    if ndjson:
+                        yield document_to_json(document) + '\n'
+                    else:
+                        yield (', ' if count else '') + document_to_json(document)
+                    count += 1
+            finally:
+                observe_stage('mongo_fetch', fetch_seconds)
+
+            next_cursor = str(last_id) if has_more else None
+            if ndjson:
+                if paginated:
+                    yield json.dumps({'next_cursor': next_cursor}) + '\n'
+            elif paginated:
+                yield '], "next_cursor": ' + json.dumps(next_cursor) + '}'
+            else:
+                yield ']'
+
+        mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+        return Response(stream_with_context(generate()), mimetype=mimetype)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# Function to parse a "west,south,east,north" viewport into a GeoJSON polygon
+def bbox_polygon(bbox):
+    west, south, east, north = [float(value) for value in bbox.split(',')]
+    if not (-180 <= west < east <= 180 and -90 <= south < north <= 90):
+        raise ValueError
+    return {'type': 'Polygon', 'coordinates': [[
+        [west, south], [east, south], [east, north], [west, north], [west, south],
+    ]]}
+
+
+@app.route('/api/listings', methods=['GET'])
+def search_listings():
+    """
+    Search listings by budget, bedrooms and map viewport
+
+    Listings are sorted by rent and returned one page at a time as
+    {"data": [...], "next_cursor": ...}; pass next_cursor back as cursor to get
+    the next page. Only listings with a rent are returned, and only listings
+    with coordinates when a bbox is given.
+    ---
+    parameters:
+      - in: query
+        name: min_rent
+        type: number
+        required: false
+      - in: query
+        name: max_rent
+        type: number
+        required: false
+      - in: query
+        name: bedrooms
+        type: number
+        required: false
+        description: Number of bedrooms, dens included ("2 + 1" is 3)
+      - in: query
+        name: bbox
+        type: string
+        required: false
+        description: Viewport as west,south,east,north, e.g. -75.8,45.3,-75.6,45.5
+      - in: query
+        name: fields
+        type: string
+        required: false
+        description: Comma-separated fields to return, e.g. Id,Property.LeaseRent
+      - in: query
+        name: limit
+        type: integer
+        required: false
+        description: Page size, 100 by default and at most MAX_PAGE_SIZE
+      - in: query
+        name: cursor
+        type: string
+        required: false
+        description: The next_cursor of the previous page
+    responses:
+      200:
+        description: Returns the matching listings from MongoDB
+      400:
+        description: Invalid parameter
+    """
+    try:
+        min_rent = request.args.get('min_rent', type=float)
+        max_rent = request.args.get('max_rent', type=float)
+        bedrooms = request.args.get('bedrooms', type=float)
+        limit = min(request.args.get('limit', 100, type=int), MAX_PAGE_SIZE)
+        if limit < 1:
+            return jsonify({"error": "limit must be positive"}), 400
+
+        # Served by the rent and bedrooms_rent indexes
+        rent = {'$gte': min_rent if min_rent is not None else float('-inf')}
+        if max_rent is not None:
+            rent['$lte'] = max_rent
+        conditions = [{'rent': rent}]
+        if bedrooms is not None:
+            conditions.append({'bedrooms': bedrooms})
+
+        # Served by the location_rent index
+        bbox = request.args.get('bbox')
+        if bbox:
+            try:
+                conditions.append({'location': {'$geoWithin': {'$geometry': bbox_polygon(bbox)}}})
+            except ValueError:
+                return jsonify({"error": f"Invalid bbox: {bbox}"}), 400
+
+        # Keyset pagination on (rent, _id), the sort order of the indexes
+        cursor = request.args.get('cursor')
+        if cursor:
+            try:
+                cursor_rent, cursor_id = cursor.split('_')
+                cursor_rent, cursor_id = float(cursor_rent), ObjectId(cursor_id)
+            except (ValueError, InvalidId):
+                return jsonify({"error": f"Invalid cursor: {cursor}"}), 400
+            conditions.append({'$or': [
+                {'rent': {'$gt': cursor_rent}},
+                {'rent': cursor_rent, '_id': {'$gt': cursor_id}},
+            ]})
+
+        fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
+
+        with stage_timer('mongo_fetch'):
+            # One extra document tells whether there is a next page
+            pipeline = [{'$match': {'$and': conditions}}, {'$sort': {'rent': 1, '_id': 1}}, {'$limit': limit + 1}]
+            if fields:
+                pipeline.append(project_fields(fields + ['rent']))
+            documents = list(properties_collection.aggregate(pipeline))
+
+        next_cursor = None
+        if len(documents) > limit:
+            documents = documents[:limit]
+            next_cursor = f"{documents[-1]['rent']!r}_{documents[-1]['_id']}"
+        for document in documents:
+            del document['_id']
+            if fields and 'rent' not in fields:
+                del document['rent']
+
+        body = ('{"data": [' + ', '.join(document_to_json(document) for document in documents)
+                + '], "next_cursor": ' + json.dumps(next_cursor) + '}')
+        return Response(body, mimetype='application/json')
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    """
+    Rent statistics per building type
+
+    Read from the materialized listing_stats rollups, which are updated as
+    listings are ingested. Means are exact; the median and quantiles are
+    estimated from the rent histogram, to within RENT_BIN_WIDTH dollars.
+    ---
+    responses:
+      200:
+        description: Returns count, mean, median, quantiles and histogram of the rents, for all listings and per building type
+      503:
+        description: The rollups are being rebuilt, retry after the Retry-After seconds
+    """
+    try:
+        with stage_timer('mongo_fetch'):
+            check_rollups()
+            documents = list(stats_collection.find())
+
+        stats = {document['_id']: rollups.summarize(document) for document in documents}
+        empty = rollups.summarize({'rent_sum': 0})
+        return jsonify({
+            'all': stats.pop(rollups.ALL_LISTINGS, empty),
+            'by_building_type': stats,
+        })
+    except RollupsPending as e:
+        return rollups_pending_response(e)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/rent_timeseries', methods=['GET'])
+def get_rent_timeseries():
+    """
+    Rent statistics per day or month the listings were posted
+    ---
+    parameters:
+      - in: query
+        name: period
+        type: string
+        enum: [day, month]
+        required: false
+        description: month by default
+      - in: query
+        name: building_type
+        type: string
+        required: false
+        description: all (the default), Apartment, House, ...
+    responses:
+      200:
+        description: Returns the count, mean and median rent of each day or month, in date order
+      400:
+        description: Invalid period
+      503:
+        description: The rollups are being rebuilt, retry after the Retry-After seconds
+    """
+    try:
+        period = request.args.get('period', 'month')
+        if period not in rollups.TIMESERIES_PERIODS:
+            return jsonify({"error": f"Invalid period: {period}"}), 400
+        query = {'period': period, 'building_type': request.args.get('building_type', rollups.ALL_LISTINGS)}
+
+        with stage_timer('mongo_fetch'):
+            check_rollups()
+            documents = list(timeseries_collection.find(query).sort('date', 1))
+
+        series = []
+        for document in documents:
+            stats = rollups.summarize(document)
+            series.append({'date': document['date'], 'count': stats['count'],
+                           'mean': stats['mean'], 'median': stats['median']})
+        return jsonify(series)
+    except RollupsPending as e:
+        return rollups_pending_response(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -267,7 +687,8 @@ def get_test_data():
     """
     try:
         # Get all test data from MongoDB
-        test_data = list(test_collection.find({}, {'_id': 0}))
+        # Rows in file order, without the bookkeeping fields of sync.py
+        test_data = list(test_collection.find({}, {'_id': 0, '_row': 0, '_content_hash': 0}).sort('_row', 1))
         return jsonify(test_data)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -416,57 +837,91 @@ def get_test_data():
 #     })
 
 
+# Function to return a rendered chart, answering 304 when the client has it already
+def chart_response(name, render):
+    with stage_timer('mongo_fetch'):
+        version = data_version(meta_collection)
+    image_url, etag = chart_cache.get(name, version, render)
+
+    response = jsonify({
+        'image_path': image_url
+    })
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+# Function to save the current figure as PNG bytes
+def figure_to_png():
+    img_data = BytesIO()
+    plt.savefig(img_data, format='png')
+    plt.close()  # Close the plot to avoid displaying it
+    return img_data.getvalue()
+
+
+def render_rent_by_month():
+    # Read the monthly rollups, a few rows per building type
+    with stage_timer('mongo_fetch'):
+        check_rollups()
+        documents = list(timeseries_collection.find({'period': 'month'}).sort('date', 1))
+
+    series = {}
+    for document in documents:
+        months, means = series.setdefault(document['building_type'], ([], []))
+        months.append(pd.Timestamp(document['date']))
+        means.append(rollups.summarize(document)['mean'])
+
+    # Plotting
+    with stage_timer('render'):
+        plt.figure(figsize=(15, 6))
+        months, means = series.pop(rollups.ALL_LISTINGS, ([], []))
+        plt.plot(months, means, marker='o', linestyle='-', color='purple', label='All listings')
+        for building_type, (months, means) in sorted(series.items()):
+            plt.plot(months, means, marker='.', linestyle='--', label=building_type)
+        plt.title('Monthly Average Rent Prices')
+        plt.xlabel('Posted Month')
+        plt.ylabel('Average Rent Price')
+        plt.legend()
+        plt.grid(True)
+        return figure_to_png()
+
+
+def render_rent_distr():
+    # Only the rents are needed, read from the mapped snapshot column
+    with stage_timer('mongo_fetch'):
+        rents = snapshots.table('properties', ['rent'])['rent'].to_numpy()
+        rental_prices = rents[rents > 0]
+
+    with stage_timer('render'):
+        plt.figure(figsize=(15, 6))
+        # Create a histogram to show the distribution of rental prices
+        plt.hist(rental_prices, bins=10, edgecolor='black', color='purple')
+        plt.title('Distribution of Rental Prices')
+        plt.xlabel('Rental Price')
+        plt.ylabel('Frequency')
+        return figure_to_png()
+
+
 @app.route('/api/get_rent_by_month', methods=['GET'])
 def plot_rent_prices():
     """
     Monthly average
+
+    The plot is rendered once per data version. Send the response's ETag as
+    If-None-Match to get a 304 while the data is unchanged.
     ---
     responses:
       200:
         description: Returns the image path of the plot for the Monthly average rental prices
+      304:
+        description: The plot is unchanged
+      503:
+        description: The rollups are being rebuilt, retry after the Retry-After seconds
     """
     try:
-        # Get all property data from MongoDB
-        property_keys = properties_collection.find({}, {'_id': 0})
-        properties = []
-        
-        for key in property_keys:
-            properties.append(key)
-        
-        # Convert to DataFrame
-        df = pd.DataFrame(properties)
-        
-        df['target'] = df['Property.LeaseRentUnformattedValue']
-
-        # Convert 'InsertedDateUTC' to datetime format
-        ticks_per_second = 1e7  # 1 tick = 100 nanoseconds, 1 second = 1e7 ticks
-        epoch_ticks = 621355968000000000  # Ticks from 0001-01-01 to 1970-01-01
-
-        # Convert 'InsertedDateUTC' to datetime format
-        df['InsertedDateUTC'] = pd.to_datetime((df['InsertedDateUTC'] - epoch_ticks) / ticks_per_second, unit='s', utc=True, errors='coerce')
-
-        # Convert to Canada (Eastern Time)
-        df['postedDate'] = df['InsertedDateUTC'].dt.tz_convert('America/Toronto')
-
-        # Sort DataFrame by 'postedDate'
-        df = df.sort_values(by='postedDate')
-
-        # Plotting
-        plt.figure(figsize=(15, 6))
-        plt.plot(df['postedDate'], df['target'], marker='o', linestyle='-', color='purple')
-        plt.title('Rent Prices Over Time')
-        plt.xlabel('Posted Date')
-        plt.ylabel('Rent Price')
-        plt.grid(True)
-
-        # Save the plot as an image
-        image_path = 'static/rent_prices_plot.png'
-        plt.savefig(image_path)
-        plt.close()
-        
-        return jsonify({
-            'image_path': image_path
-        })
+        return chart_response('rent_prices_plot', render_rent_by_month)
+    except RollupsPending as e:
+        return rollups_pending_response(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -474,36 +929,18 @@ def plot_rent_prices():
 def plot_rent_histo():
     """
     Distribution of rental prices
+
+    The plot is rendered once per data version. Send the response's ETag as
+    If-None-Match to get a 304 while the data is unchanged.
     ---
     responses:
       200:
         description: Returns the image path of the plot for the distribution of rental prices across all listings
+      304:
+        description: The plot is unchanged
     """
     try:
-        # Get all properties from MongoDB
-        properties = list(properties_collection.find({}, {'_id': 0}))
-        
-        # Convert to DataFrame
-        df = pd.DataFrame(properties)
-        
-        # Assuming 'Property.LeaseRentUnformattedValue' is the column with rental prices
-        rental_prices = df['Property.LeaseRentUnformattedValue']
-
-        plt.figure(figsize=(15, 6))
-        # Create a histogram to show the distribution of rental prices
-        plt.hist(rental_prices, bins=10, edgecolor='black', color='purple')
-        plt.title('Distribution of Rental Prices')
-        plt.xlabel('Rental Price')
-        plt.ylabel('Frequency')
-
-        # Save the plot as an image
-        image_path = 'static/rent_prices_histo.png'
-        plt.savefig(image_path)
-        plt.close()  # Close the plot to avoid displaying it
-        
-        return jsonify({
-            'image_path': image_path
-        })
+        return chart_response('rent_prices_histo', render_rent_distr)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -0,0 +1,298 @@
+""" Reproducible benchmark of the API and ML endpoints on synthetic listings.
+
+Generates Realtor-shaped listings in the flattened column schema of
+OttawaON.csv, loads them into MongoDB and times the endpoints of app.py and
+ml_server.py through their Flask test clients. By default everything runs
+offline: mongomock stands in for MongoDB and a local model directory stands in
+for S3. Results are written to a JSON file that can be compared between
+commits:
+
+    python benchmark.py --sizes 1000 10000 --output bench-new.json
+    python benchmark.py --compare bench-old.json bench-new.json
+
+Use --mongodb-uri to run against a real (local) MongoDB, which is required for
+the larger sizes (up to 1M listings). The services then use a database of
+their own, BENCHMARK_DB, which is dropped first: the listings and test set of
+rentalai_db are never touched.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Ottawa bounding box: [latMin, latMax, lonMin, lonMax]
+OTTAWA_BOX = [44.9617738, 45.5376502, -76.3555857, -75.2465783]
+# .NET ticks of 2023-01-01 and 2025-01-01
+TICKS_START = 638081280000000000
+TICKS_END = 638712864000000000
+# Database the services use with --mongodb-uri, replaced by every run
+BENCHMARK_DB = 'rentalai_benchmark'
+
+SAMPLE_PREDICTION = {
+    'province': 1, 'bedNumb': 2, 'storyNumb': 1, 'buildingType': 1, 'city': 'Ottawa',
+    'amenities': 1, 'publicTransit': 1, 'recreation': 1, 'shops': 1, 'highway': 0,
+    'park': 1, 'schools': 1, 'college': 0, 'hospital': 0, 'university': 1,
+    'hasParking': 1, 'postedDate': '2024-01-01', 'parkingSize': 1,
+}
+
+
+def generate_listings(size, seed=0, template_path=os.path.join(BASE_DIR, 'OttawaON.csv')):
+    """
+    Builds `size` synthetic listings with the columns of OttawaON.csv. Rows are
+    resampled from the real listings, then the identifiers, location, rent,
+    bedrooms and dates are randomized so that every listing is distinct.
+    """
+    rng = np.random.default_rng(seed)
+    template = pd.read_csv(template_path)
+    df = template.iloc[rng.integers(0, len(template), size)].reset_index(drop=True)
+
+    df['Id'] = np.arange(10_000_000, 10_000_000 + size)
+    df['MlsNumber'] = rng.integers(1_000_000, 99_999_999, size).astype(str)
+    df['Property.Address.Latitude'] = rng.uniform(OTTAWA_BOX[0], OTTAWA_BOX[1], size).round(6)
+    df['Property.Address.Longitude'] = rng.uniform(OTTAWA_BOX[2], OTTAWA_BOX[3], size).round(6)
+
+    rent = np.clip(rng.normal(1900, 350, size), 800, 6000).round(-1)
+    df['Property.LeaseRentUnformattedValue'] = rent
+    df['Property.LeaseRent'] = ['${:,.0f}/Monthly'.format(value) for value in rent]
+
+    bedrooms = rng.integers(0, 4, size).astype(str)
+    dens = rng.integers(0, 2, size).astype(str)
+    df['Building.Bedrooms'] = np.char.add(np.char.add(bedrooms, ' + '), dens)
+
+    df['InsertedDateUTC'] = rng.integers(TICKS_START, TICKS_END, size)
+    return df
+
+
+def percentile(latencies, q):
+    return float(np.percentile(latencies, q)) * 1000 if latencies else None
+
+
+def summarize(endpoint, size, latencies, rows=None):
+    total = sum(latencies)
+    result = {
+        'endpoint': endpoint,
+        'size': size,
+        'requests': len(latencies),
+        'mean_ms': total / len(latencies) * 1000,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'max_ms': max(latencies) * 1000,
+        'throughput_rps': len(latencies) / total if total else None,
+    }
+    if rows is not None:
+        result['rows_per_second'] = rows * len(latencies) / total if total else None
+    print(f"{endpoint:<28} size={str(size or '-'):<8} p50={result['p50_ms']:.2f}ms "
+          f"p95={result['p95_ms']:.2f}ms rps={result['throughput_rps']:.1f}")
+    return result
+
+
+def time_requests(send, repeat):
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = send()
+        response.get_data()  # Consume streamed bodies
+        latencies.append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            raise RuntimeError(f"{response.status_code}: {response.get_data(as_text=True)[:200]}")
+    return latencies
+
+
+def setup_environment(workdir, mongodb_uri):
+    """Points both services at offline stand-ins for S3 and, unless a URI is given, MongoDB."""
+    model_dir = os.path.join(workdir, 'models')
+    os.makedirs(model_dir)
+    shutil.copyfile(os.path.join(BASE_DIR, 'model.pkl'), os.path.join(model_dir, 'model.pkl'))
+    os.environ.update({
+        'MODEL_SOURCE_DIR': model_dir,
+        'MODEL_CACHE_DIR': os.path.join(workdir, 'model_cache'),
+        'SHAP_CACHE_DIR': os.path.join(workdir, 'shap_cache'),
+        'CHART_CACHE_DIR': os.path.join(workdir, 'charts'),
+        'SNAPSHOT_DIR': os.path.join(workdir, 'snapshots'),
+        'MODEL_REFRESH_INTERVAL': '0',
+        'CITY_INDEX_RETRY_AFTER': '1e9',
+        # Scoring is timed below rather than run by the background thread
+        'DEAL_SCORER': 'off',
+        # No crawl workers, and no request ever reaches the network: replaying an empty cache fails instead
+        'CRAWL_SCHEDULER': 'off',
+        'CRAWL_DATA_DIR': os.path.join(workdir, 'crawl_data'),
+        'HTTP_MODE': 'replay',
+        'HTTP_CACHE_DIR': os.path.join(workdir, 'http_cache'),
+        'DEBUG': 'False',
+        'MONGODB_DB': BENCHMARK_DB,
+    })
+    os.environ.pop('ENVIRONMENT', None)
+
+    if mongodb_uri:
+        from pymongo import MongoClient
+
+        os.environ['MONGODB_URI'] = mongodb_uri
+        MongoClient(mongodb_uri).drop_database(BENCHMARK_DB)
+    else:
+        import mongomock
+        import pymongo
+
+        # Both services share one in-memory server, like they share one MongoDB
+        shared_client = mongomock.MongoClient()
+        pymongo.MongoClient = lambda *args, **kwargs: shared_client
+
+
+def benchmark_features(rows, repeat):
+    """Times the feature pipeline on `rows` synthetic listings and as many prediction payloads."""
+    from features import listing_features, payload_features
+
+    frame = generate_listings(rows)
+    payloads = [dict(SAMPLE_PREDICTION, bedNumb=index % 5, storyNumb=index % 3) for index in range(rows)]
+    results = []
+    for name, build in (('features[listings]', lambda: listing_features(frame)),
+                        ('features[payloads]', lambda: payload_features(payloads, lambda city: [45.25, -75.8]))):
+        latencies = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            build()
+            latencies.append(time.perf_counter() - started)
+        results.append(summarize(name, rows, latencies, rows=rows))
+    return results
+
+
+def run(sizes, repeat, mongodb_uri, feature_rows=0):
+    workdir = tempfile.mkdtemp(prefix='rentalai-bench-')
+    os.chdir(BASE_DIR)
+    sys.path.insert(0, BASE_DIR)
+    setup_environment(workdir, mongodb_uri)
+
+    import app
+    import deal_score
+    import ml_server
+    import sync
+
+    api = app.app.test_client()
+    ml_api = ml_server.app.test_client()
+    results = benchmark_features(feature_rows, max(1, min(repeat, 3))) if feature_rows else []
+    try:
+        sync.sync_test_data(app.db, pd.read_csv(os.path.join(BASE_DIR, 'test_set.csv')).to_dict('records'))
+        for size in sizes:
+            records = generate_listings(size).to_dict('records')
+            # The first sync replaces the listings of the previous size, the second finds nothing to write
+            for name in ('sync', 'sync[unchanged]'):
+                started = time.perf_counter()
+                sync.sync_listings(app.db, records)
+                results.append(summarize(name, size, [time.perf_counter() - started], rows=size))
+
+            # Every listing is new to the model, then none is
+            version, model = ml_server.model_registry.get()
+            for name in ('deal_score', 'deal_score[unchanged]'):
+                started = time.perf_counter()
+                deal_score.score_listings(app.db, version, model)
+                results.append(summarize(name, size, [time.perf_counter() - started], rows=size))
+            results.append(summarize('deals', size, time_requests(
+                lambda: ml_api.get('/api/deals?limit=20'), repeat)))
+
+            # Whole-collection endpoints are repeated less on large collections
+            heavy_repeat = max(1, min(repeat, 100_000 // size))
+            results.append(summarize('get_data', size, time_requests(
+                lambda: api.get('/api/get_data'), heavy_repeat), rows=size))
+            results.append(summarize('listings[budget]', size, time_requests(
+                lambda: api.get('/api/listings?min_rent=1700&max_rent=2100&bedrooms=2&limit=100'),
+                repeat)))
+            results.append(summarize('stats', size, time_requests(
+                lambda: api.get('/api/stats'), repeat)))
+            # Charts are rendered on the first request after a data change
+            for chart in ('get_rent_by_month', 'get_rent_distr'):
+                results.append(summarize(f'{chart}[cold]', size, time_requests(
+                    lambda: api.get(f'/api/{chart}'), 1)))
+                results.append(summarize(f'{chart}[warm]', size, time_requests(
+                    lambda: api.get(f'/api/{chart}'), repeat)))
+
+        results.append(summarize('get_prediction', None, time_requests(
+            lambda: ml_api.post('/api/get_prediction', json=SAMPLE_PREDICTION), repeat * 10)))
+        batch = [dict(SAMPLE_PREDICTION, bedNumb=index % 5, storyNumb=index % 3) for index in range(1000)]
+        results.append(summarize('get_predictions[1000]', None, time_requests(
+            lambda: ml_api.post('/api/get_predictions', json=batch), repeat), rows=len(batch)))
+
+        # Cold: queue the job and wait for it, warm: served from the SHAP cache
+        def importance_cold():
+            response = ml_api.get('/api/get_importance')
+            if response.status_code != 202:
+                return response
+            status_url = f"/api/jobs/{response.json['job_id']}"
+            while True:
+                response = ml_api.get(status_url)
+                if response.json['status'] == 'failed':
+                    raise RuntimeError(f"Importance job failed: {response.json['error']}")
+                if response.json['status'] == 'done':
+                    return response
+                time.sleep(0.05)
+
+        results.append(summarize('get_importance[cold]', None, time_requests(importance_cold, 1)))
+        results.append(summarize('get_importance[warm]', None, time_requests(
+            lambda: ml_api.get('/api/get_importance'), repeat)))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                                       text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path):
+    """Prints the p50 latency and throughput change of every benchmark in both files."""
+    with open(old_path) as file:
+        old = {(r['endpoint'], r['size']): r for r in json.load(file)['results']}
+    with open(new_path) as file:
+        new = {(r['endpoint'], r['size']): r for r in json.load(file)['results']}
+
+    print(f"{'endpoint':<28} {'size':<8} {'p50 old':>10} {'p50 new':>10} {'change':>8}")
+    for key in sorted(set(old) & set(new), key=lambda k: (k[0], k[1] or 0)):
+        before, after = old[key]['p50_ms'], new[key]['p50_ms']
+        change = (after - before) / before * 100 if before else float('nan')
+        print(f"{key[0]:<28} {str(key[1] or ''):<8} {before:>9.2f}ms {after:>9.2f}ms {change:>7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                        help='numbers of synthetic listings to benchmark (1k to 1M)')
+    parser.add_argument('--repeat', type=int, default=20, help='requests per endpoint and size')
+    parser.add_argument('--mongodb-uri', help='benchmark against this MongoDB instead of mongomock')
+    parser.add_argument('--feature-rows', type=int, default=1_000_000,
+                        help='listings to benchmark the feature pipeline on, 0 to skip it')
+    parser.add_argument('--output', default='benchmark.json', help='where to write the results')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    output = os.path.abspath(args.output)
+    results = run(args.sizes, args.repeat, args.mongodb_uri, args.feature_rows)
+    with open(output, 'w') as file:
+        json.dump({
+            'commit': git_commit(),
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'mongodb': 'uri' if args.mongodb_uri else 'mongomock',
+            'results': results,
+        }, file, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == '__main__':
+    main()
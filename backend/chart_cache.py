@@ -0,0 +1,80 @@
+""" Rendered charts cached on disk under content-addressed file names.
+
+A chart's file name is derived from the chart name and the version of the
+data it was rendered from (see ingest.data_version), so a new data version
+gets a new file and a file is never overwritten while it is being served.
+The same name doubles as the ETag of the endpoint returning the chart.
+
+Concurrent requests for a chart that is not rendered yet wait on a per-key
+lock, so it is rendered once per data change. pyplot keeps global state, so
+renders of different charts are serialized as well.
+"""
+import hashlib
+import os
+import posixpath
+import threading
+
+CHART_CACHE_DIR = os.environ.get('CHART_CACHE_DIR', os.path.join('static', 'charts'))
+# URL path the browser loads CHART_CACHE_DIR from, whatever the directory's path on disk
+CHART_CACHE_URL = os.environ.get('CHART_CACHE_URL', 'static/charts')
+
+# pyplot figures are global to the process
+_render_lock = threading.Lock()
+
+
+def _write_atomic(path, data):
+    """Writes to a temporary file first so readers never see a partial file."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+class ChartCache:
+    """ Renders each (chart, data version) once and keeps the latest file of each chart. """
+
+    def __init__(self, directory=CHART_CACHE_DIR, url=CHART_CACHE_URL):
+        self.directory = directory
+        self.url = url
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _lock(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def get(self, name, data_version, render):
+        """
+        Returns (image_url, etag) of the chart `name` for data_version, calling
+        render() for the PNG bytes if it was not rendered yet. The URL is
+        relative to the server, with forward slashes on every platform.
+        """
+        key = hashlib.sha256(f"{name}:{data_version}".encode()).hexdigest()[:16]
+        filename = f"{name}-{key}.png"
+        image_path = os.path.join(self.directory, filename)
+        image_url = posixpath.join(self.url, filename)
+        if os.path.exists(image_path):
+            return image_url, key
+
+        with self._lock(key):
+            # Another request may have rendered it while we waited
+            if not os.path.exists(image_path):
+                with _render_lock:
+                    image = render()
+                os.makedirs(self.directory, exist_ok=True)
+                _write_atomic(image_path, image)
+                self._remove_stale(name, filename)
+        with self._locks_lock:
+            self._locks.pop(key, None)
+        return image_url, key
+
+    def _remove_stale(self, name, current):
+        # Files of older data versions, the previous one is kept for clients still loading it
+        paths = [os.path.join(self.directory, filename) for filename in os.listdir(self.directory)
+                 if filename.startswith(f"{name}-") and filename.endswith('.png') and filename != current]
+        paths.sort(key=lambda path: os.path.getmtime(path) if os.path.exists(path) else 0)
+        for path in paths[:-1]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,226 @@
+""" Streaming ingestion of crawled listing pages.
+
+A crawl covers a city's bounding box in tiles, one set per building type.
+Each fetched page of Realtor.ca search results is normalized into the flat
+columns of OttawaON.csv with a single pd.json_normalize call, appended to the
+crawl's Parquet dataset as one part file and, minus the listings the crawl
+already saw, upserted into MongoDB (sync.upsert_listings). The tile's progress
+is then checkpointed. A page only counts as done once it is checkpointed, so
+an interrupted crawl resumes at the first page that wasn't; writing its part
+file and upserting it again are both idempotent. The checkpoint only holds
+the tiles, its size doesn't grow with the listings: the Ids the crawl saw are
+read back from the part files of the checkpointed pages when it is loaded.
+
+    crawl_data/<crawl_id>/part-<tile>-00001.parquet
+    crawl_data/<crawl_id>/checkpoint.json
+
+Tile ids are the building type followed by the quadrants taken from the
+city's box: '17_' is the whole box, '17_2' its north-west quarter.
+"""
+import glob
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+
+CRAWL_DATA_DIR = os.environ.get('CRAWL_DATA_DIR', 'crawl_data')
+# Identifiers stay strings, some MLS numbers have letters
+STRING_COLUMNS = ('MlsNumber',)
+
+
+def _is_nested(value):
+    return isinstance(value, (list, dict))
+
+
+def _is_text(series):
+    # Object columns, or string columns on pandas versions that infer them
+    return pd.api.types.is_object_dtype(series.dtype) or pd.api.types.is_string_dtype(series.dtype)
+
+
+def normalize_page(results):
+    """
+    Flattens a page of search results into one row per listing, with values
+    typed the way pd.read_csv types the crawled CSV files. Lists (photos,
+    agents, ...) are kept as they are.
+    """
+    frame = pd.json_normalize(results)
+    for column in frame.columns:
+        series = frame[column]
+        if not _is_text(series) or column in STRING_COLUMNS or series.map(_is_nested).any():
+            continue
+        numeric = pd.to_numeric(series, errors='coerce')
+        if series.notna().any() and numeric.notna().sum() == series.notna().sum():
+            frame[column] = numeric
+    for column in STRING_COLUMNS:
+        if column in frame.columns:
+            frame[column] = frame[column].map(lambda value: value if pd.isna(value) else str(value))
+    return frame
+
+
+def _parquet_frame(frame):
+    # Parquet columns need a single type: nested values become JSON, mixed values strings
+    frame = frame.copy()
+    for column in frame.columns:
+        if _is_text(frame[column]):
+            frame[column] = frame[column].map(
+                lambda value: json.dumps(value) if _is_nested(value) else value if pd.isna(value) else str(value))
+    return frame
+
+
+def _replace_atomic(path, write):
+    """Calls write(tmp_path), then moves the file in place so readers never see a partial file."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def split_bbox(bounding_box):
+    """Splits a [latMin, latMax, lonMin, lonMax] box into its four quadrants."""
+    lat_min, lat_max, lon_min, lon_max = bounding_box
+    lat_mid, lon_mid = (lat_min + lat_max) / 2, (lon_min + lon_max) / 2
+    return [
+        [lat_min, lat_mid, lon_min, lon_mid],
+        [lat_min, lat_mid, lon_mid, lon_max],
+        [lat_mid, lat_max, lon_min, lon_mid],
+        [lat_mid, lat_max, lon_mid, lon_max],
+    ]
+
+
+def new_tile(bounding_box, building_type, depth=0):
+    return {
+        'bbox': [float(value) for value in bounding_box],
+        'building_type': building_type,
+        'depth': depth,
+        'next_page': 1,
+        'max_pages': None,
+        'total_records': None,
+        'done': False,
+    }
+
+
+class Crawl:
+    """ The tiles, part files and checkpoint of one crawl, e.g. 'ottawa'. """
+
+    def __init__(self, crawl_id, directory=CRAWL_DATA_DIR):
+        self.crawl_id = crawl_id
+        self.path = os.path.join(directory, crawl_id)
+        self._lock = threading.RLock()
+        self.state, self.seen = self._load()
+
+    def _new_state(self, tiles=None):
+        return {
+            'crawl_id': self.crawl_id,
+            'tiles': tiles or {},
+            'pages': 0,
+            'records': 0,
+            'started': time.time(),
+            'updated': None,
+            'finished': None,
+        }
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.path, 'checkpoint.json')) as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            state = None
+        if state is None or 'tiles' not in state:
+            return self._new_state(), set()
+        # Checkpoints written before the part files were read back listed the Ids
+        seen = set(state.pop('seen_ids', []))
+        for path in self._part_paths():
+            tile_id, page = os.path.basename(path)[len('part-'):-len('.parquet')].rsplit('-', 1)
+            tile = state['tiles'].get(tile_id)
+            # Pages fetched after the last checkpoint are fetched and ingested again
+            if tile is not None and int(page) < tile['next_page']:
+                seen.update(pd.read_parquet(path, columns=['Id'])['Id'].astype(str))
+        return state, seen
+
+    def _save(self):
+        os.makedirs(self.path, exist_ok=True)
+
+        def write(tmp_path):
+            with open(tmp_path, 'w') as file:
+                json.dump(self.state, file)
+        # Held while writing, so an older state never replaces a newer one
+        with self._lock:
+            _replace_atomic(os.path.join(self.path, 'checkpoint.json'), write)
+
+    @property
+    def started(self):
+        return bool(self.state['tiles'])
+
+    @property
+    def finished(self):
+        return self.state['finished'] is not None
+
+    def pending_tiles(self):
+        """Ids of the tiles with pages left, the largest areas first."""
+        with self._lock:
+            tiles = self.state['tiles']
+            return sorted((tile_id for tile_id, tile in tiles.items() if not tile['done']),
+                          key=lambda tile_id: (tiles[tile_id]['depth'], tile_id))
+
+    def tile(self, tile_id):
+        with self._lock:
+            return dict(self.state['tiles'][tile_id])
+
+    def _part_paths(self):
+        return sorted(glob.glob(os.path.join(self.path, 'part-*.parquet')))
+
+    def reset(self, bounding_box=None, building_types=()):
+        """Starts the crawl over, with one tile covering bounding_box per building type."""
+        for path in self._part_paths():
+            os.remove(path)
+        tiles = {f"{building_type}_": new_tile(bounding_box, building_type) for building_type in building_types}
+        with self._lock:
+            self.state = self._new_state(tiles)
+            self.seen = set()
+        self._save()
+
+    def write_page(self, tile_id, page, results, max_pages, total_records=None, ingest=None, split=False):
+        """
+        Stores a fetched page of a tile, passes the listings the crawl had not
+        seen yet to ingest(records) and checkpoints the tile. With split, the
+        tile is done and its four quadrants are queued instead. Returns the
+        page's DataFrame and what ingest returned.
+        """
+        frame = normalize_page(results)
+        os.makedirs(self.path, exist_ok=True)
+        if len(frame):
+            _replace_atomic(os.path.join(self.path, f"part-{tile_id}-{page:05d}.parquet"),
+                            lambda tmp_path: _parquet_frame(frame).to_parquet(tmp_path, index=False))
+
+        ids = frame['Id'].astype(str) if 'Id' in frame.columns else pd.Series([], dtype=str)
+        with self._lock:
+            new = frame[~ids.isin(self.seen).to_numpy()] if len(frame) else frame
+        counts = ingest(new.to_dict('records')) if ingest is not None and len(new) else None
+
+        now = time.time()
+        with self._lock:
+            self.seen.update(ids)
+            tile = self.state['tiles'][tile_id]
+            tile.update(next_page=page + 1, max_pages=max_pages, total_records=total_records,
+                        done=split or page >= max_pages)
+            if split:
+                for quadrant, bounding_box in enumerate(split_bbox(tile['bbox'])):
+                    self.state['tiles'][f"{tile_id}{quadrant}"] = new_tile(
+                        bounding_box, tile['building_type'], tile['depth'] + 1)
+            self.state.update(
+                pages=self.state['pages'] + 1,
+                records=len(self.seen),
+                updated=now,
+                finished=None if self.pending_tiles() else now,
+            )
+        self._save()
+        return frame, counts
+
+    def read(self):
+        """Reads every listing stored so far into one DataFrame, once per Id."""
+        frames = [pd.read_parquet(path) for path in self._part_paths()]
+        if not frames:
+            return pd.DataFrame()
+        frame = pd.concat(frames, ignore_index=True)
+        return frame.drop_duplicates(subset='Id', keep='last', ignore_index=True) if 'Id' in frame else frame
@@ -0,0 +1,391 @@
+""" Background crawl jobs with tiling, per-host rate limiting and backoff.
+
+Crawls are submitted as jobs and run by CRAWL_WORKERS scheduler threads, so
+no request waits on the Realtor.ca API. A job crawls a city's bounding box
+(from the geocode index) for several building types. The search API pages
+through at most CRAWL_PAGE_WINDOW results, so a tile with more results is
+split into quadrants, down to CRAWL_MAX_TILE_DEPTH. Workers crawl different
+tiles, building types and cities at the same time.
+
+Every request to a host takes a token from that host's bucket, shared by all
+workers (one page per CRAWL_PAGE_INTERVAL seconds by default). A 403 or 429
+pauses the whole host with exponential backoff, honouring Retry-After; other
+errors back off the job alone and fail it after CRAWL_MAX_FAILURES attempts
+in a row.
+
+Jobs are saved to CRAWL_JOBS_PATH after every step and pages are checkpointed
+by crawl_ingest.Crawl, so a restarted scheduler resumes where it stopped.
+Only one process may run the scheduler: given a lease.Lease, its workers only
+run jobs while the process holds it, reloading the jobs file when they take
+it over. A process that isn't running the jobs serves them from the file and
+turns submissions away with SchedulerNotRunning.
+"""
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from math import ceil
+
+from requests import HTTPError
+
+from crawl_ingest import CRAWL_DATA_DIR, Crawl
+from geocode_index import city_key
+
+CRAWL_JOBS_PATH = os.environ.get('CRAWL_JOBS_PATH', os.path.join(CRAWL_DATA_DIR, 'jobs.json'))
+# Seconds between two requests to the same host, and requests allowed in a burst
+CRAWL_PAGE_INTERVAL = float(os.environ.get('CRAWL_PAGE_INTERVAL', 600))
+CRAWL_BURST = int(os.environ.get('CRAWL_BURST', 1))
+# Backoff after a failed page: base * 2^(failures - 1) seconds, at most max
+CRAWL_BACKOFF_BASE = float(os.environ.get('CRAWL_BACKOFF_BASE', 900))
+CRAWL_BACKOFF_MAX = float(os.environ.get('CRAWL_BACKOFF_MAX', 4 * 3600))
+CRAWL_MAX_FAILURES = int(os.environ.get('CRAWL_MAX_FAILURES', 8))
+CRAWL_WORKERS = int(os.environ.get('CRAWL_WORKERS', 2))
+# Results the search API pages through, and how often a tile can be split to fit in them
+CRAWL_PAGE_WINDOW = int(os.environ.get('CRAWL_PAGE_WINDOW', 600))
+CRAWL_MAX_TILE_DEPTH = int(os.environ.get('CRAWL_MAX_TILE_DEPTH', 8))
+# Finished jobs kept around for the status endpoint
+CRAWL_HISTORY_SIZE = int(os.environ.get('CRAWL_HISTORY_SIZE', 100))
+
+REALTOR_HOST = 'api2.realtor.ca'
+RATE_LIMITED = (403, 429)
+ACTIVE = ('queued', 'running', 'waiting', 'backoff')
+
+
+class TokenBucket:
+    """ Allows `capacity` requests at once, refilled at `rate` requests per second. """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(0.0, now - self.updated)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate) if elapsed else self.tokens
+        self.updated = max(self.updated, now)
+
+    def try_acquire(self):
+        """Takes a token and returns 0, or returns the seconds until one is available."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Blocks until a token is taken."""
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Hands out no tokens for the next `seconds`, e.g. after being rate limited."""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+            self.updated = max(self.updated, self.paused_until)
+
+
+class RateLimiter:
+    """ One token bucket per host. """
+
+    def __init__(self, interval=CRAWL_PAGE_INTERVAL, burst=CRAWL_BURST):
+        self.interval = interval
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, host):
+        with self._lock:
+            if host not in self._buckets:
+                # No interval means no limit
+                self._buckets[host] = TokenBucket(1 / self.interval if self.interval else 1e9, self.burst)
+            return self._buckets[host]
+
+
+def backoff_delay(failures, retry_after=None, base=CRAWL_BACKOFF_BASE, maximum=CRAWL_BACKOFF_MAX):
+    """Exponential backoff with 10% jitter, never shorter than the server's Retry-After."""
+    delay = min(base * 2 ** (failures - 1), maximum) * random.uniform(1, 1.1)
+    return max(delay, retry_after or 0)
+
+
+def retry_after_seconds(error):
+    try:
+        return float(error.response.headers.get('Retry-After'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class SchedulerNotRunning(Exception):
+    """ Raised when submitting a job to a process that isn't running the crawl jobs. """
+
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file, indent=2)
+    os.replace(tmp_path, path)
+
+
+class CrawlScheduler:
+    """
+    Runs city crawl jobs in background threads.
+    locate(city) returns the city's [latMin, latMax, lonMin, lonMax] box,
+    fetch_page(bounding_box, building_type, page) returns a page of the search
+    API and ingest(records) stores its listings.
+    """
+
+    def __init__(self, locate, fetch_page, ingest=None, limiter=None, path=CRAWL_JOBS_PATH,
+                 directory=CRAWL_DATA_DIR, workers=CRAWL_WORKERS, lease=None):
+        self.locate = locate
+        self.fetch_page = fetch_page
+        self.ingest = ingest
+        self.limiter = limiter or RateLimiter()
+        self.path = path
+        self.directory = directory
+        self.workers = workers
+        self.lease = lease
+        self._leased = False
+        self._jobs = {}
+        self._crawls = {}
+        # (job id, tile id) pairs being worked on, a None tile locates the city
+        self._in_flight = set()
+        self._lock = threading.RLock()
+        self._wake = threading.Condition(self._lock)
+        self._threads = []
+        self.load()
+
+    def _read(self):
+        try:
+            with open(self.path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return []
+
+    def load(self):
+        jobs = self._read()
+        with self._lock:
+            for job in jobs:
+                # A job that was mid-page when the process stopped is simply run again
+                if job['status'] == 'running':
+                    job['status'] = 'queued'
+                # Jobs saved before crawls covered several building types
+                job.setdefault('building_types', [job.pop('building_type', 17)])
+                self._jobs[job['id']] = job
+
+    def _save(self):
+        with self._lock:
+            jobs = sorted(self._jobs.values(), key=lambda job: job['submitted'])
+            finished = [job for job in jobs if job['status'] not in ACTIVE]
+            for job in finished[:max(0, len(finished) - CRAWL_HISTORY_SIZE)]:
+                del self._jobs[job['id']]
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            _write_json_atomic(self.path, sorted(self._jobs.values(), key=lambda job: job['submitted']))
+
+    def running(self):
+        """Whether this process runs the jobs: its workers are started and it holds the lease, if any."""
+        return bool(self._threads) and (self.lease is None or self.lease.held())
+
+    def _hold_lease(self):
+        with self._lock:
+            if self.lease is None:
+                return True
+            leased, self._leased = self._leased, self.lease.held()
+            if self._leased and not leased:
+                # Another process may have run the jobs since, pick up where it left them
+                if not self._in_flight:
+                    self._crawls.clear()
+                self.load()
+            return self._leased
+
+    def start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f'crawl-worker-{len(self._threads)}', daemon=True)
+                self._threads.append(thread)
+                thread.start()
+        return self
+
+    def _crawl(self, crawl_id):
+        with self._lock:
+            if crawl_id not in self._crawls:
+                self._crawls[crawl_id] = Crawl(crawl_id, self.directory)
+            return self._crawls[crawl_id]
+
+    def submit(self, city, building_types):
+        """Queues a crawl of a city unless one is in flight, returns the job."""
+        if not self.running():
+            raise SchedulerNotRunning("Crawls are run by the process with CRAWL_SCHEDULER=on, which isn't this one")
+        crawl_id = city_key(city)
+        with self._lock:
+            for job in self._jobs.values():
+                if job['crawl_id'] == crawl_id and job['status'] in ACTIVE:
+                    return self.get(job['id'])
+
+            crawl = self._crawl(crawl_id)
+            if crawl.finished or sorted({tile['building_type'] for tile in crawl.state['tiles'].values()}) \
+                    != sorted(building_types):
+                # Start over, listings come and go
+                crawl.reset()
+            now = time.time()
+            job = {
+                'id': uuid.uuid4().hex,
+                'crawl_id': crawl_id,
+                'city': city,
+                'building_types': list(building_types),
+                'status': 'queued',
+                'pages': crawl.state['pages'],
+                'records': crawl.state['records'],
+                'tiles': len(crawl.state['tiles']),
+                'tiles_done': len(crawl.state['tiles']) - len(crawl.pending_tiles()),
+                'failures': 0,
+                'last_error': None,
+                'next_attempt': now,
+                'submitted': now,
+                'updated': now,
+                'finished': None,
+            }
+            self._jobs[job['id']] = job
+            self._save()
+            self._wake.notify_all()
+        return self.get(job['id'])
+
+    def _view(self):
+        if not self.running():
+            # Another process runs the jobs and saves them after every step
+            return {job['id']: job for job in self._read()}
+        return self._jobs
+
+    def get(self, job_id):
+        """Returns a copy of the job's progress, or None if it is unknown."""
+        with self._lock:
+            job = self._view().get(job_id)
+            return dict(job) if job is not None else None
+
+    def list(self):
+        with self._lock:
+            return sorted((dict(job) for job in self._view().values()), key=lambda job: job['submitted'])
+
+    def _claim(self):
+        """Takes the next tile due, returns (job, tile id) or None and the seconds until one is due."""
+        now = time.time()
+        wait = 60.0
+        for job in sorted(self._jobs.values(), key=lambda job: job['next_attempt']):
+            if job['status'] not in ACTIVE:
+                continue
+            if job['next_attempt'] > now:
+                wait = min(wait, job['next_attempt'] - now)
+                continue
+            crawl = self._crawl(job['crawl_id'])
+            tiles = crawl.pending_tiles() if crawl.started else [None]
+            for tile_id in tiles:
+                if (job['id'], tile_id) not in self._in_flight:
+                    self._in_flight.add((job['id'], tile_id))
+                    return (job, tile_id), 0
+        return None, wait
+
+    def _run(self):
+        while True:
+            if not self._hold_lease():
+                time.sleep(self.lease.timeout / 3)
+                continue
+            with self._lock:
+                task, wait = self._claim()
+                if task is None:
+                    # Idle workers still renew the lease
+                    self._wake.wait(timeout=min(wait, self.lease.timeout / 3) if self.lease else wait)
+                    continue
+            job, tile_id = task
+            try:
+                self.step(job, tile_id)
+            except Exception as e:
+                print(f"Error in crawl job {job['id']}: {e}")
+                self._failed(job, str(e), retry_after=None, rate_limited=False)
+            finally:
+                with self._lock:
+                    self._in_flight.discard((job['id'], tile_id))
+                    self._wake.notify_all()
+
+    def step(self, job, tile_id):
+        """Fetches and ingests the next page of a tile (or locates the city first), or reschedules the job."""
+        crawl = self._crawl(job['crawl_id'])
+        if tile_id is None:
+            crawl.reset(self.locate(job['city']), job['building_types'])
+            self._progress(job, crawl)
+            return
+
+        wait = self.limiter.bucket(REALTOR_HOST).try_acquire()
+        if wait:
+            self._update(job, status='waiting', next_attempt=time.time() + wait)
+            return
+
+        self._update(job, status='running')
+        tile = crawl.tile(tile_id)
+        page = tile['next_page']
+        try:
+            data = self.fetch_page(tile['bbox'], tile['building_type'], page)
+        except HTTPError as e:
+            status = e.response.status_code if e.response is not None else None
+            self._failed(job, f"HTTP {status} on page {page} of tile {tile_id}", retry_after_seconds(e),
+                         status in RATE_LIMITED)
+            return
+
+        total_records = data["Paging"]["TotalRecords"]
+        records_per_page = data["Paging"]["RecordsPerPage"]
+        # Tiles with more results than the API pages through are split into quadrants
+        split = page == 1 and total_records > CRAWL_PAGE_WINDOW and tile['depth'] < CRAWL_MAX_TILE_DEPTH
+        ## Rounds up the total records by the records per page to nearest int
+        max_pages = ceil(min(total_records, CRAWL_PAGE_WINDOW) / records_per_page)
+        crawl.write_page(tile_id, page, data["Results"], max_pages, total_records, ingest=self.ingest, split=split)
+        print(f"Crawled page {page}/{max_pages} of {job['crawl_id']} tile {tile_id}"
+              + (" (split)" if split else ""))
+        self._progress(job, crawl)
+
+    def _progress(self, job, crawl):
+        now = time.time()
+        with self._lock:
+            if job['status'] not in ACTIVE:
+                return
+            self._update(
+                job,
+                status='done' if crawl.finished else 'queued',
+                pages=crawl.state['pages'],
+                records=crawl.state['records'],
+                tiles=len(crawl.state['tiles']),
+                tiles_done=len(crawl.state['tiles']) - len(crawl.pending_tiles()),
+                failures=0,
+                last_error=None,
+                next_attempt=max(now, job['next_attempt']),
+                finished=now if crawl.finished else None,
+            )
+
+    def _failed(self, job, error, retry_after, rate_limited):
+        with self._lock:
+            failures = job['failures'] + 1
+            delay = backoff_delay(failures, retry_after)
+            if rate_limited:
+                # Every job of the host waits, rate limits are per client
+                self.limiter.bucket(REALTOR_HOST).pause(delay)
+            elif failures >= CRAWL_MAX_FAILURES:
+                self._update(job, status='failed', failures=failures, last_error=error, finished=time.time())
+                return
+            print(f"Crawl {job['crawl_id']}: {error}, retrying in {delay:.0f}s")
+            self._update(job, status='backoff', failures=failures, last_error=error,
+                         next_attempt=time.time() + delay)
+
+    def _update(self, job, **fields):
+        with self._lock:
+            job.update(fields, updated=time.time())
+            self._save()
+            self._wake.notify_all()
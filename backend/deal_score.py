@@ -0,0 +1,177 @@
+""" Deal scores: every stored listing's rent against the rent the model predicts.
+
+A scoring pass builds the features of the listings (features.py) and predicts
+their rents with one model call per chunk, then stores on each listing:
+
+    predicted_rent   the model's rent, None when a feature is missing
+    rent_residual    rent - predicted_rent, negative when the listing is
+                     cheaper than the model expects; None without a rent
+    scored_version   the model version the listing was scored with
+
+Syncs replace changed listings whole, dropping these fields, so the listings
+to score are simply those without the current scored_version: new and
+changed listings, or all of them after a model change. Chunks are read in
+_id order and written back straight away, so an interrupted pass resumes
+where it stopped.
+
+The deal_score index on (scored_version, rent_residual) returns the most
+underpriced listings of the current model as a sorted index scan.
+
+Every process serving the model may start a DealScorer, only the one holding
+the 'deal_scorer' lease (lease.py) scores; it renews the lease between chunks.
+
+    python deal_score.py --model model.pkl
+"""
+import argparse
+import os
+import threading
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+from pymongo import ASCENDING, MongoClient, UpdateOne
+
+from features import SOURCE_COLUMNS, listing_features
+from ingest import data_version, project_fields
+
+MONGODB_URI = os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/')
+MONGODB_DB = os.environ.get('MONGODB_DB', 'rentalai_db')
+DEAL_SCORE_CHUNK_SIZE = int(os.environ.get('DEAL_SCORE_CHUNK_SIZE', 10000))
+# Seconds between two checks for new listings or a new model
+DEAL_SCORE_INTERVAL = float(os.environ.get('DEAL_SCORE_INTERVAL', 60))
+
+
+def ensure_deal_index(collection):
+    collection.create_index([('scored_version', ASCENDING), ('rent_residual', ASCENDING)], name='deal_score')
+
+
+def score_frame(model, frame):
+    """Returns the predicted rents of listing rows, NaN for the rows with a missing feature."""
+    features = listing_features(frame)
+    valid = ~np.isnan(features).any(axis=1)
+    predicted = np.full(len(frame), np.nan)
+    if valid.any():
+        predicted[valid] = model.predict(features[valid])
+    return predicted
+
+
+def _value(number):
+    return None if number is None or number != number else float(number)
+
+
+def score_listings(db, model_version, model, chunk_size=DEAL_SCORE_CHUNK_SIZE, stop=None, lease=None):
+    """Scores the listings not scored with model_version yet, returns how many were scored."""
+    collection = db['properties']
+    ensure_deal_index(collection)
+    scored = 0
+    last_id = None
+    # A lost lease stops the pass, the new holder scores the rest
+    while (stop is None or not stop.is_set()) and (lease is None or lease.held()):
+        query = {'scored_version': {'$ne': model_version}}
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        documents = list(collection.aggregate([
+            {'$match': query},
+            {'$sort': {'_id': 1}},
+            {'$limit': chunk_size},
+            project_fields(SOURCE_COLUMNS + ['rent', '_content_hash']),
+        ]))
+        if not documents:
+            break
+
+        frame = pd.DataFrame(documents)
+        predicted = score_frame(model, frame)
+        rents = pd.to_numeric(frame['rent'], errors='coerce').to_numpy(dtype=np.float64) \
+            if 'rent' in frame.columns else np.full(len(frame), np.nan)
+        now = time.time()
+        operations = []
+        for document, rent, prediction in zip(documents, rents, predicted):
+            prediction = _value(prediction)
+            residual = _value(rent - prediction) if prediction is not None else None
+            operations.append(UpdateOne(
+                # A listing replaced since it was read is left for the next pass
+                {'_id': document['_id'], '_content_hash': document.get('_content_hash')},
+                {'$set': {'predicted_rent': prediction, 'rent_residual': residual,
+                          'scored_version': model_version, 'scored': now}},
+            ))
+        collection.bulk_write(operations, ordered=False)
+        scored += len(documents)
+        last_id = documents[-1]['_id']
+    return scored
+
+
+def underpriced(collection, model_version, limit, fields):
+    """Returns the listings furthest below their predicted rent, the cheapest relative to the model first."""
+    return list(collection.aggregate([
+        {'$match': {'scored_version': model_version, 'rent_residual': {'$lt': 0}}},
+        {'$sort': {'rent_residual': 1}},
+        {'$limit': limit},
+        project_fields(fields + ['rent', 'predicted_rent', 'rent_residual']),
+    ]))
+
+
+class DealScorer:
+    """
+    Rescores the listings in a background thread whenever the model version
+    or the data version of the listings changes.
+    """
+
+    def __init__(self, db, model_registry, interval=DEAL_SCORE_INTERVAL, lease=None):
+        self.db = db
+        self.model_registry = model_registry
+        self.interval = interval
+        self.lease = lease
+        self.last_run = None
+        self.stop = threading.Event()
+        self._scored = (None, None)
+        self._thread = None
+
+    def run_once(self):
+        """Scores what changed since the last pass, returns how many listings were scored."""
+        version, model = self.model_registry.get()
+        current = (version, data_version(self.db['meta']))
+        if model is None or current == self._scored:
+            return 0
+        started = time.perf_counter()
+        scored = score_listings(self.db, version, model, stop=self.stop, lease=self.lease)
+        self._scored = current
+        self.last_run = {'model_version': version, 'scored': scored, 'finished': time.time(),
+                         'seconds': time.perf_counter() - started}
+        if scored:
+            print(f"Scored {scored} listings with model version {version} in {self.last_run['seconds']:.2f}s")
+        return scored
+
+    def _run(self):
+        while not self.stop.is_set():
+            try:
+                if self.lease is None or self.lease.held():
+                    self.run_once()
+            except Exception as e:
+                print(f"Error scoring listings: {e}")
+            self.stop.wait(self.interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='deal-scorer', daemon=True)
+        self._thread.start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mongodb-uri', default=MONGODB_URI)
+    parser.add_argument('--model', default='model.pkl', help='model file (pickle or joblib)')
+    parser.add_argument('--model-version', help='version to record, the file name by default')
+    parser.add_argument('--chunk-size', type=int, default=DEAL_SCORE_CHUNK_SIZE, help='listings per model call')
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongodb_uri)[MONGODB_DB]
+    model = joblib.load(args.model)
+    version = args.model_version or os.path.basename(args.model)
+    started = time.perf_counter()
+    scored = score_listings(db, version, model, args.chunk_size)
+    print(f"Scored {scored} listings in {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+""" Incremental enrichment of the listings with their Realtor.ca details.
+
+Each listing's details are stored in a document of their own in
+property_details, keyed on the listing Id:
+
+    {'_id': '26772180', 'Id': 26772180, 'MlsNumber': 'X1234567',
+     'PhotoChangeDateUTC': '2024-02-21 8:11:48 PM', 'details': {...}, 'fetched': ...,
+     'fetched_photo_date': '2024-02-21 8:11:48 PM'}
+
+PhotoChangeDateUTC is the version of the listing last tried, fetched_photo_date
+the version the stored details are of. A run compares the listings with the
+stored details and fetches only the listings without details, or whose
+PhotoChangeDateUTC changed since their details were fetched (the listing was
+edited). DETAILS_WORKERS threads fetch at once, each
+request taking a token from the same per-host bucket as the crawler, and
+every result is upserted as soon as it arrives. Nothing else is saved, so an
+interrupted run simply starts over with what is still missing.
+
+The details are always requested from the API, bypassing the response cache
+(http_client.py): its key doesn't change when a listing is edited, so it
+would answer a refetch with the details of the previous version.
+
+A 403 or 429 pauses the host and the listing is retried later in the run.
+Listings failing otherwise are given up after DETAILS_MAX_FAILURES runs,
+until their PhotoChangeDateUTC changes; the details of the previous version
+are kept meanwhile.
+
+    python details_enrichment.py --workers 4 --limit 500
+"""
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import ASCENDING, MongoClient
+from requests import HTTPError
+
+from crawl_scheduler import RATE_LIMITED, REALTOR_HOST, RateLimiter, backoff_delay, retry_after_seconds
+from realtorAPI import get_property_details
+
+MONGODB_URI = os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/')
+MONGODB_DB = os.environ.get('MONGODB_DB', 'rentalai_db')
+DETAILS_WORKERS = int(os.environ.get('DETAILS_WORKERS', 4))
+DETAILS_MAX_FAILURES = int(os.environ.get('DETAILS_MAX_FAILURES', 3))
+# Times a listing is retried within a run after being rate limited
+DETAILS_MAX_RETRIES = int(os.environ.get('DETAILS_MAX_RETRIES', 5))
+
+
+def _str(value):
+    return None if value is None or value != value else str(value)
+
+
+def _fetched_photo_date(document):
+    if 'fetched_photo_date' in document:
+        return document['fetched_photo_date']
+    # Stored before fetched_photo_date, the version last tried is that of the details unless it failed
+    return document.get('PhotoChangeDateUTC') if 'last_error' not in document else None
+
+
+def pending_listings(db, limit=None):
+    """Returns the listings (Id, MlsNumber, PhotoChangeDateUTC) whose details are missing or outdated."""
+    projection = {'PhotoChangeDateUTC': 1, 'fetched_photo_date': 1, 'failures': 1, 'last_error': 1, 'details': 1}
+    stored = {document['_id']: document for document in db['property_details'].find({}, projection)}
+    pending = []
+    seen = set()
+    cursor = db['properties'].find({}, {'_id': 0, 'Id': 1, 'MlsNumber': 1, 'PhotoChangeDateUTC': 1})
+    for listing in cursor.sort('Id', ASCENDING):
+        key = _str(listing.get('Id'))
+        if key is None or key in seen or _str(listing.get('MlsNumber')) is None:
+            continue
+        seen.add(key)
+        document = stored.get(key)
+        version = _str(listing.get('PhotoChangeDateUTC'))
+        if document is None:
+            current, tried = False, False
+        else:
+            current = 'details' in document and _fetched_photo_date(document) == version
+            tried = document.get('PhotoChangeDateUTC') == version
+        # Versions that failed are retried up to DETAILS_MAX_FAILURES times
+        if not current and (not tried or document.get('failures', 0) < DETAILS_MAX_FAILURES):
+            pending.append(listing)
+            if limit is not None and len(pending) == limit:
+                break
+    return pending
+
+
+def _store(collection, listing, details=None, error=None):
+    key = _str(listing['Id'])
+    fields = {
+        'Id': listing['Id'],
+        'MlsNumber': _str(listing['MlsNumber']),
+        'PhotoChangeDateUTC': _str(listing.get('PhotoChangeDateUTC')),
+    }
+    if error is None:
+        collection.update_one(
+            {'_id': key},
+            {'$set': dict(fields, details=details, fetched=time.time(),
+                          fetched_photo_date=fields['PhotoChangeDateUTC']),
+             '$unset': {'failures': '', 'last_error': ''}},
+            upsert=True)
+        return
+    # The details of the previous version, if any, are kept along with their fetched_photo_date
+    previous = collection.find_one({'_id': key}, {'PhotoChangeDateUTC': 1})
+    failures_reset = previous is not None and previous.get('PhotoChangeDateUTC') != fields['PhotoChangeDateUTC']
+    update = {'$set': dict(fields, last_error=error, failed=time.time())}
+    if failures_reset:
+        update['$set']['failures'] = 1
+    else:
+        update['$inc'] = {'failures': 1}
+    collection.update_one({'_id': key}, update, upsert=True)
+
+
+def enrich_details(db, fetch_details=get_property_details, limiter=None, workers=DETAILS_WORKERS,
+                   limit=None, stop=None, progress=None):
+    """
+    Fetches and stores the details of the pending listings, returns the counts.
+    fetch_details(property_id, mls_number, refresh) returns the details,
+    refresh=True bypassing any cached response.
+    stop is a threading.Event ending the run early, progress(counts) is
+    called after every listing.
+    """
+    limiter = limiter or RateLimiter()
+    stop = stop or threading.Event()
+    collection = db['property_details']
+    collection.create_index([('Id', ASCENDING)], name='listing_id')
+    listings = pending_listings(db, limit)
+    counts = {'pending': len(listings), 'fetched': 0, 'failed': 0, 'rate_limited': 0}
+    lock = threading.Lock()
+
+    def fetch(listing):
+        bucket = limiter.bucket(REALTOR_HOST)
+        attempts = 0
+        while not stop.is_set():
+            wait = bucket.try_acquire()
+            if wait:
+                # Short sleeps, so a stop is noticed
+                stop.wait(min(wait, 1.0))
+                continue
+            try:
+                details = fetch_details(str(listing['Id']), str(listing['MlsNumber']), refresh=True)
+            except HTTPError as e:
+                status = e.response.status_code if e.response is not None else None
+                if status in RATE_LIMITED:
+                    attempts += 1
+                    with lock:
+                        counts['rate_limited'] += 1
+                    bucket.pause(backoff_delay(attempts, retry_after_seconds(e)))
+                    if attempts < DETAILS_MAX_RETRIES:
+                        continue
+                    # Left for the next run
+                    return
+                result = ('failed', None, f"HTTP {status}")
+            except Exception as e:
+                result = ('failed', None, str(e))
+            else:
+                result = ('fetched', details, None)
+            _store(collection, listing, details=result[1], error=result[2])
+            with lock:
+                counts[result[0]] += 1
+                if progress is not None:
+                    progress(dict(counts))
+            return
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='details') as executor:
+        # Every listing is submitted up front, at most `workers` of them fetch at once
+        list(executor.map(fetch, listings))
+    return counts
+
+
+class DetailsEnricher:
+    """ Runs enrich_details in a background thread, one run at a time. """
+
+    def __init__(self, db, fetch_details=get_property_details, limiter=None, workers=DETAILS_WORKERS):
+        self.db = db
+        self.fetch_details = fetch_details
+        self.limiter = limiter
+        self.workers = workers
+        self.stop = threading.Event()
+        self._lock = threading.RLock()
+        self._thread = None
+        self._status = {'status': 'idle', 'counts': None, 'started': None, 'finished': None, 'error': None}
+
+    def status(self):
+        with self._lock:
+            return dict(self._status)
+
+    def _set(self, **fields):
+        with self._lock:
+            self._status.update(fields)
+
+    def start(self, limit=None):
+        """Starts a run unless one is in progress, returns the status."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return self.status()
+            self.stop.clear()
+            self._status = {'status': 'running', 'counts': None, 'started': time.time(), 'finished': None,
+                            'error': None}
+            self._thread = threading.Thread(target=self._run, args=(limit,), name='details-enrichment',
+                                            daemon=True)
+            self._thread.start()
+            return self.status()
+
+    def _run(self, limit):
+        try:
+            counts = enrich_details(self.db, self.fetch_details, self.limiter, self.workers, limit, self.stop,
+                                    progress=lambda counts: self._set(counts=counts))
+            self._set(status='stopped' if self.stop.is_set() else 'done', counts=counts, finished=time.time())
+        except Exception as e:
+            print(f"Error enriching details: {e}")
+            self._set(status='failed', error=str(e), finished=time.time())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mongodb-uri', default=MONGODB_URI)
+    parser.add_argument('--workers', type=int, default=DETAILS_WORKERS, help='requests in flight at once')
+    parser.add_argument('--limit', type=int, default=None, help='listings to fetch at most')
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongodb_uri)[MONGODB_DB]
+    started = time.perf_counter()
+    counts = enrich_details(db, workers=args.workers, limit=args.limit,
+                            progress=lambda counts: print(f"Details: {counts}"))
+    print(f"Enriched details in {time.perf_counter() - started:.2f}s: {counts}")
+
+
+if __name__ == '__main__':
+    main()
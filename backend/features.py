@@ -0,0 +1,202 @@
+""" The model's feature pipeline, shared by training, serving and analytics.
+
+Turns listings into the 21 features of FEATURE_NAMES, as a float32 matrix
+(the precision the forest's split thresholds are stored in):
+
+    listing_features(frame)      normalized listing rows, with the dotted
+                                 Realtor.ca columns of OttawaON.csv, a crawl
+                                 page (crawl_ingest.normalize_page) or the
+                                 properties collection
+    payload_features(rows, ...)  prediction request payloads, the already
+                                 encoded fields of /api/get_prediction
+
+The encodings are those ML.ipynb trained model.pkl with. Every operation
+works on whole columns: text columns (bedrooms, amenities, categories) only
+have a few distinct values, so they are factorized and each distinct value
+is parsed once, then the results are broadcast back with the codes.
+"""
+import numpy as np
+import pandas as pd
+
+from ingest import parse_bedrooms
+
+# Column order the model was trained on (see test_set.csv)
+FEATURE_NAMES = ['ProvinceName', 'BuildingBedrooms', 'BuildingStoriesTotal',
+                 'BuildingType', 'PropertyAddressLongitude', 'PropertyAddressLatitude',
+                 'hasLaundry', 'PublicTransit', 'RecreationNearby', 'Shopping', 'Highway',
+                 'Park', 'Schools', 'CEGEP', 'Hospital', 'University', 'PropertyParkingType',
+                 'Year', 'Month', 'Day', 'ParkingSizeType']
+TARGET = 'Property.LeaseRentUnformattedValue'
+# Listing columns the features are built from
+SOURCE_COLUMNS = ['ProvinceName', 'Building.Bedrooms', 'Building.StoriesTotal', 'Building.Type',
+                  'Property.Address.Longitude', 'Property.Address.Latitude', 'Building.Ammenities',
+                  'Property.AmmenitiesNearBy', 'Property.ParkingType', 'InsertedDateUTC',
+                  'Property.ParkingSpaceTotal']
+
+# LabelEncoder classes of the notebook, in code order. Missing values sort last,
+# values the model never saw get UNKNOWN_CODE
+PROVINCES = ['Ontario', 'Quebec']
+BUILDING_TYPES = ['Apartment', 'House']
+BUILDING_AMENITIES = ['Furnished, Laundry - In Suite', 'Furnished, Laundry Facility', 'Laundry - In Suite',
+                      'Laundry - In Suite, Exercise Centre', 'Laundry Facility',
+                      'Party Room, Laundry Facility, Exercise Centre', 'Storage - Locker', None]
+UNKNOWN_CODE = -1
+# Features set when Property.AmmenitiesNearBy contains the text
+AMENITIES_NEARBY = {
+    'PublicTransit': 'Public Transit',
+    'RecreationNearby': 'Recreation Nearby',
+    'Shopping': 'Shopping',
+    'Highway': 'Highway',
+    'Park': 'Park',
+    'Schools': 'Schools',
+    'CEGEP': 'CEGEP',
+    'Hospital': 'Hospital',
+    'University': 'University',
+}
+# ParkingSizeType: 0 none, 1 up to 5 spaces, 2 up to 10, 3 more
+PARKING_SIZE_BINS = [0, 5, 10]
+
+# InsertedDateUTC is in .NET ticks: 100 nanoseconds since 0001-01-01 UTC
+TICKS_PER_SECOND = 1e7
+EPOCH_TICKS = 621355968000000000  # Ticks from 0001-01-01 to 1970-01-01
+TIMEZONE = 'America/Toronto'
+
+# Request payload fields, as (payload field, feature), the city and date are converted
+PAYLOAD_FIELDS = [
+    ('province', 'ProvinceName'), ('bedNumb', 'BuildingBedrooms'), ('storyNumb', 'BuildingStoriesTotal'),
+    ('buildingType', 'BuildingType'), ('amenities', 'hasLaundry'), ('publicTransit', 'PublicTransit'),
+    ('recreation', 'RecreationNearby'), ('shops', 'Shopping'), ('highway', 'Highway'), ('park', 'Park'),
+    ('schools', 'Schools'), ('college', 'CEGEP'), ('hospital', 'Hospital'), ('university', 'University'),
+    ('hasParking', 'PropertyParkingType'), ('parkingSize', 'ParkingSizeType'),
+]
+# Payload fields the API reads as floats, the others are truncated to integers
+FLOAT_PAYLOAD_FIELDS = ('bedNumb', 'storyNumb')
+
+
+def posted_dates(ticks):
+    """Converts a sequence of .NET ticks to local (Toronto) timestamps, NaT where invalid."""
+    seconds = (pd.to_numeric(pd.Series(ticks), errors='coerce') - EPOCH_TICKS) / TICKS_PER_SECOND
+    return pd.to_datetime(seconds, unit='s', utc=True, errors='coerce').dt.tz_convert(TIMEZONE)
+
+
+def _map_distinct(series, parse):
+    # Applies parse to each distinct value once, missing values included, None becomes NaN
+    codes, uniques = pd.factorize(series, use_na_sentinel=False)
+    return np.array([parse(value) for value in uniques], dtype=np.float64)[codes]
+
+
+def _is_missing(value):
+    return value is None or value != value
+
+
+def _column(frame, name):
+    return frame[name] if name in frame.columns else pd.Series(np.nan, index=frame.index, dtype=object)
+
+
+def _bedrooms(value):
+    # Listings without a bedroom count have 0
+    return 0.0 if _is_missing(value) else parse_bedrooms(str(value))
+
+
+def encode_labels(series, classes):
+    """Label encodes a text column with the notebook's classes, None standing for missing values."""
+    lookup = {value: code for code, value in enumerate(classes)}
+
+    def encode(value):
+        return lookup.get(None if _is_missing(value) else value, UNKNOWN_CODE)
+    return _map_distinct(series, encode)
+
+
+def amenities_nearby(series):
+    """Returns a (rows, 9) matrix of the AMENITIES_NEARBY flags of Property.AmmenitiesNearBy."""
+    codes, uniques = pd.factorize(series.fillna(''), use_na_sentinel=False)
+    flags = np.array([[text in str(value) for text in AMENITIES_NEARBY.values()] for value in uniques],
+                     dtype=np.float64).reshape(len(uniques), len(AMENITIES_NEARBY))
+    return flags[codes]
+
+
+def parking_size(spaces):
+    """Bins Property.ParkingSpaceTotal into ParkingSizeType."""
+    spaces = pd.to_numeric(spaces, errors='coerce').to_numpy(dtype=np.float64)
+    size = np.digitize(spaces, PARKING_SIZE_BINS, right=True)
+    # No (or a missing) number of spaces is no parking
+    return np.where(spaces > PARKING_SIZE_BINS[0], size, 0)
+
+
+def listing_features(frame):
+    """Builds the (rows, 21) float32 feature matrix of normalized listing rows."""
+    features = np.empty((len(frame), len(FEATURE_NAMES)), dtype=np.float32)
+    column = {name: position for position, name in enumerate(FEATURE_NAMES)}
+
+    features[:, column['ProvinceName']] = encode_labels(_column(frame, 'ProvinceName'), PROVINCES)
+    features[:, column['BuildingBedrooms']] = _map_distinct(_column(frame, 'Building.Bedrooms'), _bedrooms)
+    features[:, column['BuildingStoriesTotal']] = pd.to_numeric(
+        _column(frame, 'Building.StoriesTotal'), errors='coerce').fillna(1).to_numpy()
+    features[:, column['BuildingType']] = encode_labels(_column(frame, 'Building.Type'), BUILDING_TYPES)
+    features[:, column['PropertyAddressLongitude']] = pd.to_numeric(
+        _column(frame, 'Property.Address.Longitude'), errors='coerce').to_numpy()
+    features[:, column['PropertyAddressLatitude']] = pd.to_numeric(
+        _column(frame, 'Property.Address.Latitude'), errors='coerce').to_numpy()
+    features[:, column['hasLaundry']] = encode_labels(_column(frame, 'Building.Ammenities'), BUILDING_AMENITIES)
+
+    first = column['PublicTransit']
+    features[:, first:first + len(AMENITIES_NEARBY)] = amenities_nearby(_column(frame, 'Property.AmmenitiesNearBy'))
+    features[:, column['PropertyParkingType']] = _column(frame, 'Property.ParkingType').notna().to_numpy()
+
+    posted = posted_dates(_column(frame, 'InsertedDateUTC'))
+    features[:, column['Year']] = posted.dt.year.to_numpy(dtype=np.float64, na_value=np.nan)
+    features[:, column['Month']] = posted.dt.month.to_numpy(dtype=np.float64, na_value=np.nan)
+    features[:, column['Day']] = posted.dt.day.to_numpy(dtype=np.float64, na_value=np.nan)
+    features[:, column['ParkingSizeType']] = parking_size(_column(frame, 'Property.ParkingSpaceTotal'))
+    return features
+
+
+def training_set(frame):
+    """Returns the feature matrix and the rents of the listings that have one, as in the notebook."""
+    frame = frame[pd.to_numeric(_column(frame, TARGET), errors='coerce').notna()]
+    return listing_features(frame), pd.to_numeric(frame[TARGET]).to_numpy(dtype=np.float64)
+
+
+def payload_features(rows, centroid):
+    """
+    Builds the float32 feature matrix of prediction request payloads (dicts).
+    centroid(city) returns the [lat, lon] the listing is placed at. Returns
+    the matrix, with a row for every payload, and the errors of the rows
+    that could not be converted, by row index.
+    """
+    frame = pd.DataFrame.from_records([row if isinstance(row, dict) else {} for row in rows],
+                                      index=range(len(rows)))
+    features = np.zeros((len(rows), len(FEATURE_NAMES)), dtype=np.float32)
+    column = {name: position for position, name in enumerate(FEATURE_NAMES)}
+    errors = {}
+
+    def fail(mask, message):
+        for index in np.flatnonzero(mask):
+            errors.setdefault(int(index), message)
+
+    fail(np.array([not isinstance(row, dict) for row in rows], dtype=bool), "Invalid value: expected an object")
+    for field, feature in PAYLOAD_FIELDS + [('city', None), ('postedDate', None)]:
+        fail(_column(frame, field).isna().to_numpy(), f"Missing field: '{field}'")
+
+    for field, feature in PAYLOAD_FIELDS:
+        values = pd.to_numeric(_column(frame, field), errors='coerce').to_numpy(dtype=np.float64)
+        fail(np.isnan(values), f"Invalid value: '{field}'")
+        features[:, column[feature]] = values if field in FLOAT_PAYLOAD_FIELDS else np.trunc(values)
+
+    # postedDate is YYYY-MM-DD
+    parts = _column(frame, 'postedDate').astype(str).str.split('-', n=2, expand=True).reindex(columns=range(3))
+    for position, feature in enumerate(('Year', 'Month', 'Day')):
+        values = pd.to_numeric(parts[position], errors='coerce').to_numpy(dtype=np.float64)
+        fail(np.isnan(values), "Invalid value: 'postedDate'")
+        features[:, column[feature]] = values
+
+    # Cities are looked up by name, other values can't be geocoded
+    cities = _column(frame, 'city').astype(object)
+    invalid = cities.notna() & ~cities.map(lambda city: isinstance(city, str) and bool(city.strip()))
+    fail(invalid.to_numpy(dtype=bool), "Invalid value: 'city'")
+    # Each city is looked up once, rows without a valid one already failed
+    codes, uniques = pd.factorize(cities.where(~invalid))
+    coordinates = np.array([centroid(city) for city in uniques] + [[np.nan, np.nan]], dtype=np.float64)
+    features[:, column['PropertyAddressLatitude']] = coordinates[codes, 0]
+    features[:, column['PropertyAddressLongitude']] = coordinates[codes, 1]
+    return features, errors
@@ -0,0 +1,86 @@
+""" Array-backed inference for tree ensembles.
+
+For a single row, sklearn's predict spends most of its time validating input
+and dispatching one job per tree. CompiledForest flattens every tree of the
+forest once into shared NumPy node arrays and walks all trees together, one
+vectorized step per tree level.
+"""
+import os
+
+import numpy as np
+
+# Larger batches are left to sklearn, which parallelizes across trees
+FOREST_ENGINE_MAX_ROWS = int(os.environ.get('FOREST_ENGINE_MAX_ROWS', 64))
+
+SUPPORTED_MODELS = ('RandomForestRegressor', 'ExtraTreesRegressor', 'DecisionTreeRegressor')
+
+
+class CompiledForest:
+    """ The nodes of all trees of a forest, laid out in flat arrays. """
+
+    def __init__(self, feature, threshold, children, value, roots, depth, n_features):
+        self.feature = feature
+        self.threshold = threshold
+        # children[2 * node + (x <= threshold)] is the next node: right, then left
+        self.children = children
+        self.value = value
+        self.roots = roots
+        self.depth = depth
+        self.n_features = n_features
+
+    @classmethod
+    def from_model(cls, model):
+        """Compiles a fitted sklearn tree model, returns None if it is not supported."""
+        if type(model).__name__ not in SUPPORTED_MODELS:
+            return None
+        estimators = getattr(model, 'estimators_', [model])
+        trees = [estimator.tree_ for estimator in estimators]
+        if not trees or any(tree.n_outputs != 1 for tree in trees):
+            return None
+
+        offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+        n_nodes = offsets[-1]
+        feature = np.zeros(n_nodes, dtype=np.intp)
+        threshold = np.zeros(n_nodes, dtype=np.float64)
+        children = np.zeros(2 * n_nodes, dtype=np.intp)
+        value = np.zeros(n_nodes, dtype=np.float64)
+
+        for tree, offset in zip(trees, offsets):
+            nodes = slice(offset, offset + tree.node_count)
+            own = np.arange(offset, offset + tree.node_count)
+            is_leaf = tree.children_left == -1
+
+            # Leaves point to themselves, so walking past them is a no-op
+            feature[nodes] = np.where(is_leaf, 0, tree.feature)
+            threshold[nodes] = np.where(is_leaf, np.inf, tree.threshold)
+            children[2 * offset:2 * (offset + tree.node_count):2] = np.where(
+                is_leaf, own, tree.children_right + offset)
+            children[2 * offset + 1:2 * (offset + tree.node_count):2] = np.where(
+                is_leaf, own, tree.children_left + offset)
+            value[nodes] = tree.value[:, 0, 0]
+
+        return cls(feature, threshold, children, value,
+                   roots=offsets[:-1].astype(np.intp),
+                   depth=max(tree.max_depth for tree in trees),
+                   n_features=trees[0].n_features)
+
+    def supports(self, X):
+        """Trees trained with missing values route NaN differently, leave those to sklearn."""
+        return X.shape[1] == self.n_features and not np.isnan(X).any()
+
+    def predict(self, X):
+        """Predicts a 2D array of rows, averaging the leaf values of all trees."""
+        # sklearn compares float32 features against float64 thresholds
+        X = np.asarray(X, dtype=np.float32)
+        if X.shape[0] == 1:
+            x = X[0]
+            nodes = self.roots
+            for _ in range(self.depth):
+                nodes = self.children[2 * nodes + (x[self.feature[nodes]] <= self.threshold[nodes])]
+            return np.array([self.value[nodes].mean()])
+
+        rows = np.arange(X.shape[0])[:, None]
+        nodes = np.broadcast_to(self.roots, (X.shape[0], len(self.roots)))
+        for _ in range(self.depth):
+            nodes = self.children[2 * nodes + (X[rows, self.feature[nodes]] <= self.threshold[nodes])]
+        return self.value[nodes].mean(axis=1)
@@ -0,0 +1,160 @@
+""" Offline index of city bounding boxes and centroids.
+
+The index lives in CITY_INDEX_PATH as JSON and is loaded into memory once, so
+lookups never touch the network. Missing or stale cities are queued (at most
+CITY_INDEX_QUEUE_SIZE of them) and geocoded with realtorAPI.get_coordinates
+by one background thread, then picked up by later lookups. Geocoding requests
+are at least CITY_INDEX_GEOCODE_INTERVAL apart, Nominatim's usage policy
+allowing one per second. The index can also be built ahead of time:
+
+    python geocode_index.py Ottawa Toronto Montreal
+"""
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+from realtorAPI import get_coordinates
+
+CITY_INDEX_PATH = os.environ.get('CITY_INDEX_PATH', 'city_index.json')
+# Seconds after which an entry is geocoded again (default 30 days)
+CITY_INDEX_MAX_AGE = float(os.environ.get('CITY_INDEX_MAX_AGE', 30 * 24 * 3600))
+# Seconds to wait before geocoding a city again after a failed attempt
+CITY_INDEX_RETRY_AFTER = float(os.environ.get('CITY_INDEX_RETRY_AFTER', 3600))
+# Cities waiting to be geocoded in the background, lookups of more are dropped until there is room
+CITY_INDEX_QUEUE_SIZE = int(os.environ.get('CITY_INDEX_QUEUE_SIZE', 100))
+# Seconds between two geocoding requests
+CITY_INDEX_GEOCODE_INTERVAL = float(os.environ.get('CITY_INDEX_GEOCODE_INTERVAL', 1.0))
+DEFAULT_CITY = 'Ottawa'
+
+
+def city_key(city):
+    """'Ottawa, ON', 'ottawa,ON' and ' Ottawa ' all share the 'ottawa' entry."""
+    return ' '.join(city.split(',')[0].lower().split())
+
+
+def make_entry(bounding_box):
+    """Builds an index entry from a [latMin, latMax, lonMin, lonMax] bounding box."""
+    lat_min, lat_max, lon_min, lon_max = [float(value) for value in bounding_box]
+    return {
+        'boundingbox': [lat_min, lat_max, lon_min, lon_max],
+        'centroid': [(lat_min + lat_max) / 2, (lon_min + lon_max) / 2],  # [lat, lon]
+        'updated': time.time(),
+    }
+
+
+class CityIndex:
+    """ In-memory city -> bounding box/centroid map backed by a JSON file. """
+
+    def __init__(self, path=CITY_INDEX_PATH, max_age=CITY_INDEX_MAX_AGE, geocode=get_coordinates,
+                 queue_size=CITY_INDEX_QUEUE_SIZE, interval=CITY_INDEX_GEOCODE_INTERVAL):
+        self.path = path
+        self.max_age = max_age
+        self.geocode = geocode
+        self.interval = interval
+        self._entries = {}
+        self._pending = set()
+        self._failed = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._worker = None
+        self._geocode_lock = threading.Lock()
+        self._last_geocode = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                self._entries = json.load(file)
+        except FileNotFoundError:
+            self._entries = {}
+
+    def save(self):
+        with self._lock:
+            data = json.dumps(self._entries, indent=2, sort_keys=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as file:
+            file.write(data)
+        os.replace(tmp_path, self.path)
+
+    def lookup(self, city):
+        """Returns the entry of a city, or None. Never blocks on the network."""
+        key = city_key(city)
+        entry = self._entries.get(key)
+        if entry is None or time.time() - entry.get('updated', 0) > self.max_age:
+            self._refresh_in_background(city)
+        return entry
+
+    def centroid(self, city):
+        """Returns the [lat, lon] centroid of a city, or of DEFAULT_CITY while it is unknown."""
+        entry = self.lookup(city) or self.lookup(DEFAULT_CITY)
+        return entry['centroid']
+
+    def bounding_box(self, city):
+        """Returns the [latMin, latMax, lonMin, lonMax] box of a city, geocoding it when missing or stale."""
+        entry = self._entries.get(city_key(city))
+        if entry is None or time.time() - entry.get('updated', 0) > self.max_age:
+            try:
+                entry = self.refresh(city)
+            except Exception:
+                # A stale box is better than none
+                if entry is None:
+                    raise
+        return entry['boundingbox']
+
+    def refresh(self, city):
+        """Geocodes a city and stores its entry, this does network I/O."""
+        # One request at a time, at least self.interval apart
+        with self._geocode_lock:
+            if self._last_geocode is not None:
+                wait = self._last_geocode + self.interval - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            try:
+                bounding_box = self.geocode(city)
+            finally:
+                self._last_geocode = time.monotonic()
+        if not isinstance(bounding_box, list) or len(bounding_box) != 4:
+            raise ValueError(f"No bounding box found for {city}")
+        entry = make_entry(bounding_box)
+        with self._lock:
+            self._entries[city_key(city)] = entry
+        self.save()
+        return entry
+
+    def _refresh_in_background(self, city):
+        key = city_key(city)
+        with self._lock:
+            if key in self._pending or time.time() - self._failed.get(key, 0) < CITY_INDEX_RETRY_AFTER:
+                return
+            try:
+                self._queue.put_nowait(city)
+            except queue.Full:
+                # Queued again by a later lookup
+                return
+            self._pending.add(key)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._work, name='geocode', daemon=True)
+                self._worker.start()
+
+    def _work(self):
+        while True:
+            city = self._queue.get()
+            key = city_key(city)
+            try:
+                self.refresh(city)
+            except Exception as e:
+                print(f"Error geocoding {city}: {e}")
+                with self._lock:
+                    self._failed[key] = time.time()
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+
+if __name__ == '__main__':
+    index = CityIndex()
+    for name in sys.argv[1:] or [DEFAULT_CITY]:
+        print(name, index.refresh(name))
@@ -0,0 +1,177 @@
+""" Shared HTTP client for the Realtor.ca API and OpenStreetMap.
+
+One requests.Session keeps connections alive in a pool of HTTP_POOL_SIZE per
+host and retries connection errors and 5xx responses with exponential
+backoff (HTTP_RETRIES, HTTP_BACKOFF). 403 and 429 are not retried here, the
+crawl scheduler backs off the whole host instead.
+
+Successful responses are cached on disk, keyed on the method, URL, query and
+form body, for a TTL that depends on the endpoint:
+
+    http_cache/<endpoint>/<key[:2]>/<key>.json
+
+HTTP_MODE picks how the cache is used:
+
+    live     cached responses younger than their TTL are reused (default),
+             unless the request passes a shorter max_age (0 to refetch)
+    record   every request goes to the network and its response is saved
+    replay   responses only come from the cache, whatever their age, and a
+             request that was never recorded fails; nothing goes to the network
+    off      no cache
+
+Record a crawl once, then replay it offline with CRAWL_PAGE_INTERVAL=0:
+
+    HTTP_MODE=record python app.py
+    HTTP_MODE=replay CRAWL_PAGE_INTERVAL=0 python app.py
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+
+HTTP_MODE = os.environ.get('HTTP_MODE', 'live')
+HTTP_CACHE_DIR = os.environ.get('HTTP_CACHE_DIR', 'http_cache')
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 3))
+# Seconds before the first retry, doubled on each of the next ones
+HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', 1))
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 10))
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# Seconds a cached response is reused for, per endpoint
+HTTP_CACHE_TTLS = {
+    'search': float(os.environ.get('HTTP_CACHE_TTL_SEARCH', 15 * 60)),
+    'details': float(os.environ.get('HTTP_CACHE_TTL_DETAILS', 24 * 3600)),
+    'geocode': float(os.environ.get('HTTP_CACHE_TTL_GEOCODE', 30 * 24 * 3600)),
+}
+# Response headers kept in the cache
+CACHED_HEADERS = ('Content-Type', 'Date', 'ETag', 'Last-Modified')
+
+
+def make_session(pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF):
+    """Returns a session with a connection pool and a retry policy."""
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=RETRY_STATUSES,
+        # The search endpoint is a POST, but it only reads
+        allowed_methods=None,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def cache_key(method, url, params=None, data=None):
+    """Hashes a request, independent of the order of its parameters."""
+    query = urlencode(sorted((params or {}).items()))
+    body = urlencode(sorted((data or {}).items()))
+    return hashlib.sha256(f"{method.upper()} {url}?{query}\n{body}".encode()).hexdigest()
+
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
+
+def _response(entry):
+    # Rebuilds a requests.Response, so callers can't tell a cached response from a fresh one
+    response = requests.Response()
+    response.status_code = entry['status']
+    response.url = entry['url']
+    response.headers = CaseInsensitiveDict(entry['headers'])
+    response.encoding = 'utf-8'
+    response._content = entry['body'].encode('utf-8')
+    return response
+
+
+class ResponseCache:
+    """ Responses saved as JSON files, one directory per endpoint. """
+
+    def __init__(self, directory=HTTP_CACHE_DIR, ttls=None):
+        self.directory = directory
+        self.ttls = HTTP_CACHE_TTLS if ttls is None else ttls
+
+    def _path(self, endpoint, key):
+        return os.path.join(self.directory, endpoint, key[:2], f"{key}.json")
+
+    def get(self, endpoint, key, max_age=None):
+        """Returns the cached response, or None when it is missing or older than max_age."""
+        try:
+            with open(self._path(endpoint, key)) as file:
+                entry = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+        if max_age is not None and time.time() - entry['fetched'] > max_age:
+            return None
+        return _response(entry)
+
+    def put(self, endpoint, key, method, response):
+        path = self._path(endpoint, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _write_json_atomic(path, {
+            'method': method.upper(),
+            'url': response.url,
+            'status': response.status_code,
+            'headers': {name: response.headers[name] for name in CACHED_HEADERS if name in response.headers},
+            'body': response.text,
+            'fetched': time.time(),
+        })
+
+
+class HttpClient:
+    """ The session and the cache, shared by every request of the process. """
+
+    def __init__(self, mode=HTTP_MODE, cache=None, session=None, timeout=HTTP_TIMEOUT):
+        if mode not in ('live', 'record', 'replay', 'off'):
+            raise ValueError(f"Unknown HTTP_MODE: {mode}")
+        self.mode = mode
+        self.cache = cache or ResponseCache()
+        self.session = session or make_session()
+        self.timeout = timeout
+
+    def request(self, method, url, endpoint, params=None, data=None, headers=None, max_age=None):
+        """
+        Sends a request, or answers it from the cache depending on the mode.
+        In live mode, max_age caps the age of a reused response below the
+        endpoint's TTL; 0 always sends the request and refreshes the cache.
+        """
+        key = cache_key(method, url, params, data)
+        if self.mode == 'replay':
+            cached = self.cache.get(endpoint, key)
+            if cached is None:
+                raise LookupError(f"No recorded response for {method.upper()} {url} ({endpoint} {key})")
+            return cached
+        if self.mode == 'live':
+            ttl = self.cache.ttls.get(endpoint, 0)
+            cached = self.cache.get(endpoint, key, ttl if max_age is None else min(max_age, ttl))
+            if cached is not None:
+                return cached
+
+        response = self.session.request(method, url, params=params, data=data, headers=headers,
+                                        timeout=self.timeout)
+        if self.mode != 'off' and response.status_code == 200:
+            self.cache.put(endpoint, key, method, response)
+        return response
+
+    def get(self, url, endpoint, params=None, headers=None, max_age=None):
+        return self.request('GET', url, endpoint, params=params, headers=headers, max_age=max_age)
+
+    def post(self, url, endpoint, data=None, headers=None, max_age=None):
+        return self.request('POST', url, endpoint, data=data, headers=headers, max_age=max_age)
+
+
+client = HttpClient()
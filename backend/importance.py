@@ -0,0 +1,125 @@
+""" Computes, renders and publishes the SHAP feature importance plot.
+
+This module runs inside the job queue's worker processes, so it only depends
+on the model artifact path and the test set it is given, not on ml_server.
+"""
+import os
+import time
+from io import BytesIO
+
+import boto3
+import joblib
+import matplotlib.pyplot as plt
+import shap
+
+from shap_cache import SHAP_CACHE_DIR, ShapCache
+from shap_engine import compute_shap_values
+
+# Use Agg backend for plotting
+plt.switch_backend('Agg')
+
+ML_API_URL = os.environ.get('ML_API_URL', 'http://localhost:5001')
+S3_IMAGES_BUCKET = os.environ.get('S3_IMAGES_BUCKET', 'rentalai-static-images')
+
+# S3 client of the current process, clients can't be shared with worker processes
+_s3_client = None
+
+
+def get_s3_client():
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client(
+            's3',
+            aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
+            aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
+            region_name=os.environ.get('AWS_REGION', 'us-east-1')
+        )
+    return _s3_client
+
+
+# Function to save a rendered plot (PNG bytes) to S3
+def save_plot_to_s3(image, filename):
+    img_data = BytesIO(image)
+
+    # Upload to S3
+    get_s3_client().upload_fileobj(
+        img_data,
+        S3_IMAGES_BUCKET,
+        filename,
+        ExtraArgs={'ContentType': 'image/png', 'ACL': 'public-read'}
+    )
+
+    # Return the public URL
+    return f"https://{S3_IMAGES_BUCKET}.s3.amazonaws.com/{filename}"
+
+
+def render_beeswarm(shap_values):
+    """Renders the beeswarm plot of the 10 most important features as PNG bytes."""
+    plt.figure()
+    shap.plots.beeswarm(shap_values, max_display=10, show=False)
+    plt.title('Features Importance (Beeswarm Plot)')
+    plt.xlabel('SHAP Value')
+    plt.ylabel('Features')
+
+    img_data = BytesIO()
+    plt.savefig(img_data, format='png', bbox_inches='tight')
+    plt.close()
+    return img_data.getvalue()
+
+
+def publish_importance_plot(shap_cache, key, meta):
+    """Makes a cached plot available and returns its URL."""
+    # A partial plot gets its own URL, the full one replaces it later
+    partial = meta.get('partial', False)
+    filename = f"rent_feat_import_{key}{'-partial' if partial else ''}.png"
+
+    # For production: upload to S3 once per key
+    if os.environ.get('ENVIRONMENT') == 'production':
+        if 'image_url' not in meta or partial:
+            image_url = save_plot_to_s3(shap_cache.load_image(key), filename)
+            meta = shap_cache.update(key, image_url=image_url)
+        return meta['image_url']
+
+    # For local development: save to static folder
+    image_path = os.path.join('static', filename)
+    if partial or not os.path.exists(image_path):
+        # Make sure the static directory exists
+        os.makedirs('static', exist_ok=True)
+        with open(image_path, 'wb') as file:
+            file.write(shap_cache.load_image(key))
+    return f"{ML_API_URL}/static/{filename}"
+
+
+def compute_importance(model_path, X_test, key, model_version, engine, cache_dir=SHAP_CACHE_DIR):
+    """
+    Job entry point: explains the test set with the model stored at model_path,
+    stores the values and the plot under key and returns the plot's URL, along
+    with the time spent in each stage and a warning when the SHAP time budget
+    cut the explanation short.
+    """
+    timings = {}
+    shap_cache = ShapCache(cache_dir)
+    meta = shap_cache.get(key)
+    if meta is None:
+        started = time.perf_counter()
+        model = joblib.load(model_path, mmap_mode='r')
+        shap_values = compute_shap_values(model, X_test)
+        timings['shap'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        image = render_beeswarm(shap_values)
+        timings['render'] = time.perf_counter() - started
+
+        # Stored to be published, but computed again by the next request
+        meta = shap_cache.put(key, shap_values, image,
+                              model_version=model_version, engine=engine,
+                              rows=len(shap_values.values), partial=len(shap_values.values) < len(X_test))
+
+    started = time.perf_counter()
+    image_path = publish_importance_plot(shap_cache, key, meta)
+    timings['s3_upload'] = time.perf_counter() - started
+    result = {'image_path': image_path, 'model_version': model_version, 'timings': timings}
+    if meta.get('partial'):
+        result['warning'] = (f"SHAP time budget spent, the plot explains {meta['rows']} "
+                             f"of {len(X_test)} rows")
+    return result
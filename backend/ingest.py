@@ -0,0 +1,84 @@
+""" Prepares listing records for MongoDB and maintains the collection indexes.
+
+Listings keep the flattened Realtor column names ('Property.LeaseRentUnformattedValue',
+'Property.Address.Longitude', ...). MongoDB reads dots in query paths and index
+keys as nested fields, so the values used by server-side queries are also
+copied into top-level fields at ingest:
+
+    rent           Property.LeaseRentUnformattedValue, as a number
+    bedrooms       Building.Bedrooms, with "2 + 1" counted as 3
+    building_type  Building.Type, 'Unknown' when missing
+    location       GeoJSON point from Property.Address.Longitude/Latitude
+"""
+import math
+import time
+
+from pymongo import ASCENDING, GEOSPHERE, ReturnDocument
+
+
+def _number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(number) else number
+
+
+def parse_bedrooms(value):
+    """'2 + 1' (bedrooms + dens) -> 3.0, '2' -> 2.0, missing -> None."""
+    if isinstance(value, str) and '+' in value:
+        parts = [_number(part) for part in value.split('+')]
+        return None if None in parts else sum(parts)
+    return _number(value)
+
+
+def prepare_listing(record):
+    """Adds the top-level search fields to a listing record, in place."""
+    record['rent'] = _number(record.get('Property.LeaseRentUnformattedValue'))
+    record['bedrooms'] = parse_bedrooms(record.get('Building.Bedrooms'))
+    building_type = record.get('Building.Type')
+    record['building_type'] = building_type if isinstance(building_type, str) and building_type else 'Unknown'
+
+    longitude = _number(record.get('Property.Address.Longitude'))
+    latitude = _number(record.get('Property.Address.Latitude'))
+    if longitude is not None and latitude is not None and -180 <= longitude <= 180 and -90 <= latitude <= 90:
+        record['location'] = {'type': 'Point', 'coordinates': [longitude, latitude]}
+    else:
+        record.pop('location', None)
+    return record
+
+
+def project_fields(fields):
+    """
+    Returns the aggregation stage keeping only the listed fields of each document.
+    Listing fields are flattened names such as 'Property.LeaseRent', which a find()
+    projection would read as nested paths, so the top-level keys are filtered instead.
+    """
+    return {'$replaceRoot': {'newRoot': {'$arrayToObject': {'$filter': {
+        'input': {'$objectToArray': '$$ROOT'},
+        'cond': {'$in': ['$$this.k', ['_id'] + fields]},
+    }}}}}
+
+
+def ensure_indexes(collection):
+    """Creates the indexes behind the listing searches, a no-op when they exist."""
+    # Budget searches sorted by rent, optionally for a number of bedrooms
+    collection.create_index([('rent', ASCENDING), ('_id', ASCENDING)], name='rent')
+    collection.create_index([('bedrooms', ASCENDING), ('rent', ASCENDING), ('_id', ASCENDING)],
+                            name='bedrooms_rent')
+    # Map viewport searches, listings without coordinates are left out of the index
+    collection.create_index([('location', GEOSPHERE), ('rent', ASCENDING)], name='location_rent')
+
+
+def data_version(meta_collection, name='properties'):
+    """Returns the version of a collection's data, bumped by every ingest that changes it."""
+    document = meta_collection.find_one({'_id': name})
+    return document['version'] if document else 0
+
+
+def bump_data_version(meta_collection, name='properties'):
+    """Marks the collection's data as changed, invalidating what was computed from it."""
+    document = meta_collection.find_one_and_update(
+        {'_id': name}, {'$inc': {'version': 1}, '$set': {'updated': time.time()}},
+        upsert=True, return_document=ReturnDocument.AFTER)
+    return document['version']
@@ -0,0 +1,104 @@
+""" Background jobs run in a process pool, with in-flight deduplication.
+
+Jobs are submitted under a key describing the work; submitting a key that is
+already queued or running returns the existing job instead of starting a new
+one, so concurrent identical requests trigger a single computation.
+
+Workers are spawned rather than forked: the servers fork from processes
+running threads (model refresh, deal scorer, pymongo's monitors), and a forked
+child can deadlock on a lock one of them held. Jobs take paths and reload what
+they need, so nothing is inherited from the parent anyway.
+"""
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+# Finished jobs kept around for the status endpoint
+JOB_HISTORY_SIZE = int(os.environ.get('JOB_HISTORY_SIZE', 1000))
+
+
+class JobQueue:
+    """ Tracks jobs submitted to a process pool by id and by key. """
+
+    def __init__(self, max_workers=JOB_WORKERS, history_size=JOB_HISTORY_SIZE, on_finish=None):
+        self.max_workers = max_workers
+        self.history_size = history_size
+        # Called with the job's status once it is done or failed
+        self.on_finish = on_finish
+        self._executor = None
+        self._jobs = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.RLock()
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def _submit_to_pool(self, fn, args):
+        # The pool is created on first use, and again if a worker died
+        if self._executor is None:
+            self._executor = self._new_executor()
+        try:
+            return self._executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._executor = self._new_executor()
+            return self._executor.submit(fn, *args)
+
+    def submit(self, key, fn, *args):
+        """Runs fn(*args) in the pool unless a job with the same key is in flight, returns the job."""
+        with self._lock:
+            job_id = self._in_flight.get(key)
+            if job_id is not None:
+                return self.get(job_id)
+
+            job = {
+                'id': uuid.uuid4().hex,
+                'key': key,
+                'status': 'queued',
+                'submitted': time.time(),
+                'finished': None,
+                'result': None,
+                'error': None,
+            }
+            self._jobs[job['id']] = job
+            self._in_flight[key] = job['id']
+            while len(self._jobs) > self.history_size:
+                self._jobs.popitem(last=False)
+
+            future = self._submit_to_pool(fn, args)
+            job['future'] = future
+            future.add_done_callback(lambda done: self._finish(job, done))
+            return self.get(job['id'])
+
+    def _finish(self, job, future):
+        with self._lock:
+            try:
+                job['result'] = future.result()
+                job['status'] = 'done'
+            except Exception as e:
+                job['error'] = str(e)
+                job['status'] = 'failed'
+            job['finished'] = time.time()
+            if self._in_flight.get(job['key']) == job['id']:
+                del self._in_flight[job['key']]
+        if self.on_finish is not None:
+            try:
+                self.on_finish(self.get(job['id']) or job)
+            except Exception as e:
+                print(f"Error in job callback for {job['id']}: {e}")
+
+    def get(self, job_id):
+        """Returns a copy of the job's status, or None if it is unknown."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            status = {name: value for name, value in job.items() if name != 'future'}
+            if status['status'] == 'queued' and 'future' in job and job['future'].running():
+                status['status'] = 'running'
+            return status
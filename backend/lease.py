@@ -0,0 +1,69 @@
+""" Leases in the meta collection, for work only one process may do at a time.
+
+Every process that could run a background job (the crawl scheduler, the deal
+scorer) holds a Lease on it and checks `held()` before doing the work. The
+first process to insert the lease document holds it and renews it while it
+checks; the others get a DuplicateKeyError and take it over once it expires,
+i.e. LEASE_TIMEOUT seconds after the holder stopped or crashed. The Flask
+debug reloader and WSGI servers with several workers import the app in more
+than one process, only the holder of a lease runs its job.
+"""
+import atexit
+import os
+import socket
+import threading
+import time
+import uuid
+
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+# Seconds a lease is held without being renewed, it is renewed after a third of them
+LEASE_TIMEOUT = float(os.environ.get('LEASE_TIMEOUT', 300))
+
+
+class Lease:
+    """ A named lease, renewed by calling held() at least every timeout / 3 seconds. """
+
+    def __init__(self, meta_collection, name, timeout=LEASE_TIMEOUT):
+        self.meta_collection = meta_collection
+        self.name = name
+        self.timeout = timeout
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+        self.renewed = None
+        self._lock = threading.Lock()
+        # A stopped process hands the lease over at once instead of after the timeout
+        atexit.register(self.release)
+
+    def acquire(self):
+        """Takes or renews the lease, returns whether this process holds it."""
+        now = time.time()
+        try:
+            renewed = self.meta_collection.update_one({'_id': self.name, 'owner': self.owner},
+                                                      {'$set': {'expires': now + self.timeout}})
+            if not renewed.matched_count:
+                # Inserts the lease, or takes over an expired one; a held lease makes the upsert fail
+                self.meta_collection.update_one({'_id': self.name, 'expires': {'$lt': now}},
+                                                {'$set': {'owner': self.owner, 'expires': now + self.timeout}},
+                                                upsert=True)
+        except DuplicateKeyError:
+            self.renewed = None
+            return False
+        self.renewed = now
+        return True
+
+    def held(self):
+        """Whether this process holds the lease, renewing it when a third of its timeout has passed."""
+        with self._lock:
+            if self.renewed is not None and time.time() - self.renewed < self.timeout / 3:
+                return True
+            return self.acquire()
+
+    def release(self):
+        with self._lock:
+            if self.renewed is not None:
+                self.renewed = None
+                try:
+                    self.meta_collection.delete_one({'_id': self.name, 'owner': self.owner})
+                except PyMongoError:
+                    # It expires on its own
+                    pass
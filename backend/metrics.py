@@ -0,0 +1,144 @@
+""" Lightweight latency histograms exposed in the Prometheus text format.
+
+Both Flask services time their request stages (JSON parse, Mongo fetch,
+predict, render, ...) with stage_timer and expose the histograms on /metrics.
+Recording a sample is a bisect and two additions under a lock, cheap enough
+to leave on in production.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import Response, g, has_request_context, request
+
+# Upper bounds in seconds, from sub-millisecond predictions to minute long SHAP runs
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Histogram:
+    """ A Prometheus histogram with a fixed set of label names. """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                # One count per bucket plus +Inf, then the sum
+                series = self._series[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for labelvalues, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                labels = _format_labels(self.labelnames, labelvalues, [('le', bound)])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{labels} {values[-1]}")
+        return lines
+
+
+STAGE_DURATION = Histogram('rentalai_stage_duration_seconds',
+                           'Time spent in each stage of a request',
+                           ('route', 'stage', 'model_version'))
+REQUEST_DURATION = Histogram('rentalai_request_duration_seconds',
+                             'Time spent handling a request',
+                             ('route', 'method', 'status', 'model_version'))
+
+# Functions returning extra exposition lines (e.g. cache counters)
+_collectors = []
+# Function returning the model version label of the current process
+_model_version = lambda: ''
+
+
+def current_route():
+    if has_request_context() and request.url_rule is not None:
+        return request.url_rule.rule
+    return ''
+
+
+def observe_stage(stage, seconds, route=None, model_version=None):
+    """Records the duration of a stage measured elsewhere (e.g. in a worker process)."""
+    STAGE_DURATION.observe(seconds,
+                           current_route() if route is None else route,
+                           stage,
+                           _model_version() if model_version is None else model_version)
+
+
+@contextmanager
+def stage_timer(stage, route=None, model_version=None):
+    """Times the enclosed block as one stage of the current request."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started, route, model_version)
+
+
+def add_collector(collector):
+    """Registers a function returning extra lines for /metrics."""
+    _collectors.append(collector)
+
+
+def render():
+    lines = STAGE_DURATION.render() + REQUEST_DURATION.render()
+    for collector in _collectors:
+        lines.extend(collector())
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app, model_version=None):
+    """Times every request of the app and serves the histograms on /metrics."""
+    global _model_version
+    if model_version is not None:
+        _model_version = lambda: model_version() or ''
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('metrics_started', None)
+        if started is not None and request.url_rule is not None:
+            REQUEST_DURATION.observe(time.perf_counter() - started, request.url_rule.rule,
+                                     request.method, str(response.status_code), _model_version())
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """
+        Prometheus metrics
+        ---
+        responses:
+          200:
+            description: Returns the per-stage and per-request latency histograms in the Prometheus text format
+        """
+        return Response(render(), mimetype='text/plain; version=0.0.4')
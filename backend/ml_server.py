@@ -1,17 +1,29 @@
 import json
-import pickle
 import time
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 from flask_cors import CORS
 from flasgger import Swagger
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
-import shap
 from pymongo import MongoClient
 import os
+import threading
 import boto3
-from io import BytesIO
+from shap_cache import ShapCache, cache_key, frame_hash
+from shap_engine import engine_name
+from importance import compute_importance, publish_importance_plot
+from job_queue import JobQueue
+import metrics
+from metrics import observe_stage, stage_timer
+from model_registry import LocalModelSource, ModelRegistry, S3ModelSource
+from prediction_cache import PredictionCache
+from forest_engine import FOREST_ENGINE_MAX_ROWS, CompiledForest
+from geocode_index import CityIndex
+from features import payload_features
+from deal_score import DealScorer, underpriced
+from lease import Lease
+from snapshot import SnapshotStore
 
 # Use Agg backend for plotting
 plt.switch_backend('Agg')
@@ -21,6 +33,14 @@ API_URL = os.environ.get('API_URL', 'http://localhost:5000')
 ML_API_URL = os.environ.get('ML_API_URL', 'http://localhost:5001')
 FRONTEND_URL = os.environ.get('FRONTEND_URL', 'http://localhost:3000')
 MONGODB_URI = os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/')
+MONGODB_DB = os.environ.get('MONGODB_DB', 'rentalai_db')
+# 'off' leaves deal scoring to other processes; with 'on' the one holding the scorer's lease scores
+DEAL_SCORER = os.environ.get('DEAL_SCORER', 'on')
+# Largest number of deals returned at once
+MAX_DEALS = int(os.environ.get('MAX_DEALS', 100))
+# Listing fields returned with each deal
+DEAL_FIELDS = ['Id', 'MlsNumber', 'Property.Address.AddressText', 'RelativeDetailsURL',
+               'building_type', 'bedrooms', 'location']
 
 app = Flask(__name__, static_folder='static', static_url_path='/static')
 # Configure CORS to allow requests from the frontend
@@ -29,9 +49,10 @@ swag = Swagger(app)
 
 # Initialize MongoDB connection
 client = MongoClient(MONGODB_URI)
-db = client['rentalai_db']
+db = client[MONGODB_DB]
 properties_collection = db['properties']
-test_collection = db['test_data']
+# Memory-mapped columnar copies of the collections, one file per data version
+snapshots = SnapshotStore(db)
 
 # Initialize S3 client
 s3_client = boto3.client(
@@ -43,48 +64,89 @@ s3_client = boto3.client(
 
 S3_BUCKET = os.environ.get('S3_BUCKET_NAME', 'rentalai-models')
 MODEL_KEY = os.environ.get('MODEL_KEY', 'model.pkl')
-S3_IMAGES_BUCKET = os.environ.get('S3_IMAGES_BUCKET', 'rentalai-static-images')
 
-# Function to load model from S3
-def load_model_from_s3():
-    try:
-        # Download model from S3
-        response = s3_client.get_object(Bucket=S3_BUCKET, Key=MODEL_KEY)
-        model_data = response['Body'].read()
-        
-        # Load model from bytes
-        model = pickle.loads(model_data)
-        print(f"Successfully loaded model from S3: {S3_BUCKET}/{MODEL_KEY}")
-        return model
-    except Exception as e:
-        print(f"Error loading model from S3: {e}")
-        # Fallback to local model if available
-        if os.path.exists('model.pkl'):
-            print("Loading local model instead")
-            with open('model.pkl', 'rb') as file:
-                return pickle.load(file)
-        raise
-
-# Function to save plot to S3
-def save_plot_to_s3(plt, filename):
-    # Save plot to BytesIO object
-    img_data = BytesIO()
-    plt.savefig(img_data, format='png', bbox_inches='tight')
-    img_data.seek(0)
-    
-    # Upload to S3
-    s3_client.upload_fileobj(
-        img_data, 
-        S3_IMAGES_BUCKET, 
-        filename,
-        ExtraArgs={'ContentType': 'image/png', 'ACL': 'public-read'}
-    )
-    
-    # Return the public URL
-    return f"https://{S3_IMAGES_BUCKET}.s3.amazonaws.com/{filename}"
-
-# Load the model
-model = load_model_from_s3()
+# Serve models from a local directory instead of S3 (development and tests)
+MODEL_SOURCE_DIR = os.environ.get('MODEL_SOURCE_DIR')
+
+if MODEL_SOURCE_DIR:
+    model_source = LocalModelSource(os.path.join(MODEL_SOURCE_DIR, MODEL_KEY))
+else:
+    model_source = S3ModelSource(s3_client, S3_BUCKET, MODEL_KEY)
+
+# Job workers are spawned (see job_queue.py) and import `python ml_server.py` again as __mp_main__,
+# they don't serve requests and start no background threads
+SERVING = __name__ != '__mp_main__'
+
+# Load the model from the local cache, new versions are swapped in the background
+model_registry = ModelRegistry(model_source, fallback_path='model.pkl')
+if SERVING:
+    model_registry.start()
+
+# Recent predictions, keyed on the feature vector and dropped on model change
+prediction_cache = PredictionCache()
+
+# Function to expose the prediction cache counters on /metrics
+def prediction_cache_metrics():
+    stats = prediction_cache.stats()
+    lines = []
+    for counter in ('hits', 'misses', 'evictions', 'expirations', 'invalidations'):
+        lines.append(f"# TYPE rentalai_prediction_cache_{counter}_total counter")
+        lines.append(f"rentalai_prediction_cache_{counter}_total {stats[counter]}")
+    lines.append("# TYPE rentalai_prediction_cache_size gauge")
+    lines.append(f"rentalai_prediction_cache_size {stats['size']}")
+    return lines
+
+# Per-stage latency histograms, served on /metrics
+metrics.init_app(app, model_version=lambda: model_registry.version)
+metrics.add_collector(prediction_cache_metrics)
+
+# Active model compiled into flat node arrays, as (version, engine)
+forest_engine = (None, None)
+forest_engine_lock = threading.Lock()
+
+# Function to predict rows, with the compiled engine for single rows and small batches
+def predict_rows(version, model, features):
+    global forest_engine
+    if forest_engine[0] != version:
+        with forest_engine_lock:
+            if forest_engine[0] != version:
+                forest_engine = (version, CompiledForest.from_model(model))
+    engine = forest_engine[1]
+
+    features = np.asarray(features, dtype=np.float64)
+    if engine is not None and len(features) <= FOREST_ENGINE_MAX_ROWS and engine.supports(features):
+        return engine.predict(features)
+    return model.predict(features)
+
+# SHAP values and importance plots, keyed on the model version and test set
+shap_cache = ShapCache()
+
+# Function to record the stage timings measured by an importance job's worker
+def record_importance_timings(job):
+    result = job.get('result') or {}
+    for stage, seconds in result.get('timings', {}).items():
+        observe_stage(stage, seconds, route='/api/get_importance',
+                      model_version=result.get('model_version', ''))
+
+# Importance plots are computed in worker processes, one job per cache key
+importance_jobs = JobQueue(on_finish=record_importance_timings)
+
+# City bounding boxes and centroids, loaded once from disk
+city_index = CityIndex()
+
+# Listings are rescored in the background when the model or the listings change
+deal_scorer = DealScorer(db, model_registry, lease=Lease(db['meta'], 'deal_scorer'))
+if DEAL_SCORER == 'on' and SERVING:
+    deal_scorer.start()
+
+# Function to build the model's feature row from a prediction request payload
+def build_features(data):
+    """ Maps the request fields to the 21 model features, in FEATURE_NAMES order. """
+    # Centroid of the city's bounding box, from the offline index (Ottawa while unknown)
+    features, errors = payload_features([data], city_index.centroid)
+    if errors:
+        raise ValueError(errors[0])
+    return features[0]
 
 @app.route('/api/get_prediction', methods=['POST'])
 def get_pred():
@@ -168,70 +230,170 @@ def get_pred():
                 type: number
                 format: float
               example: [450000.0]
+            model_version:
+              type: string
+              example: "9b2f0c1d7e4a"
+      400:
+        description: A feature is missing or invalid (e.g. an unknown city)
     """
-    data = request.json
-
-    ProvinceName = int(data['province'])
-    BuildingBedrooms = float(data['bedNumb'])
-    BuildingStoriesTotal = float(data['storyNumb'])
-    BuildingType = int(data['buildingType'])
-
-    city = data['city']
-
-    # coords = get_coordinates("Ottawa")  # [latMin, latMax, lonMin, lonMax]
-    # TO FIX, GOT BOUDS FROM API FOR NOW, for ottawa
-    # "boundingbox": [
-    #     "44.9617738",
-    #     "45.5376502",
-    #     "-76.3555857",
-    #     "-75.2465783"
-    # ]
-    coords = ["44.9617738","45.5376502","-76.3555857","-75.2465783"]
-    PropertyAddressLongitude = float(coords[2]) + float(coords[3]) / 2
-    PropertyAddressLatitude = float(coords[0]) + float(coords[1]) / 2
-
-    hasLaundry = int(data['amenities'])
-    PublicTransit = int(data['publicTransit'])
-    RecreationNearby = int(data['recreation'])
-    Shopping = int(data['shops'])
-    Highway = int(data['highway'])
-    Park = int(data['park'])
-    Schools = int(data['schools'])
-    CEGEP = int(data['college'])
-    Hospital = int(data['hospital'])
-    University = int(data['university'])
-    PropertyParkingType = int(data['hasParking'])
-
-    postedDate = data['postedDate']
-
-    Year = int(postedDate.split('-')[0])
-    Month = int(postedDate.split('-')[1])
-    Day = int(postedDate.split('-')[2])
-
-    ParkingSizeType = int(data['parkingSize'])
-
-    features = [[ProvinceName, BuildingBedrooms, BuildingStoriesTotal,
-                 BuildingType, PropertyAddressLongitude, PropertyAddressLatitude,
-                 hasLaundry, PublicTransit, RecreationNearby, Shopping, Highway,
-                 Park, Schools, CEGEP, Hospital, University, PropertyParkingType,
-                 Year, Month, Day, ParkingSizeType]]
-
-    prediction = model.predict(features)
-
-    prediction_list = prediction.tolist()
+    version, model = model_registry.get()
+    if model is None:
+        return jsonify({"error": "No model loaded yet"}), 503
+
+    with stage_timer('json_parse', model_version=version):
+        data = request.json
+
+    try:
+        with stage_timer('feature_build', model_version=version):
+            features = build_features(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    prediction = prediction_cache.get(version, features)
+    if prediction is None:
+        with stage_timer('predict', model_version=version):
+            prediction = predict_rows(version, model, [features]).tolist()[0]
+        prediction_cache.put(version, features, prediction)
+
+    prediction_list = [prediction]
 
     return jsonify({
         'prediction': prediction_list,
+        'model_version': version,
     })
 
+# Function to parse a batch request body (JSON array or NDJSON) into rows
+def parse_batch(body, ndjson):
+    """ Returns (rows, errors), where errors maps a row index to its parse error. """
+    if not ndjson:
+        rows = json.loads(body)
+        if not isinstance(rows, list):
+            raise ValueError("expected a JSON array of listings")
+        return rows, {}
+
+    rows = []
+    errors = {}
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        try:
+            rows.append(json.loads(line))
+        except ValueError as e:
+            errors[len(rows)] = f"Invalid JSON: {str(e)}"
+            rows.append(None)
+    return rows, errors
+
+@app.route('/api/get_predictions', methods=['POST'])
+def get_preds():
+    """
+    Predicts the property prices of a batch of listings with a single model call.
+
+    Accepts a JSON array, or NDJSON (Content-Type: application/x-ndjson) with one
+    listing per line, using the same fields as /api/get_prediction. Results are
+    streamed back in the same format, one per input row, in input order. The
+    model version used is returned in the X-Model-Version header.
+    ---
+    consumes:
+      - application/json
+      - application/x-ndjson
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: array
+          items:
+            type: object
+    responses:
+      200:
+        description: One result per row, either a prediction or a validation error
+        schema:
+          type: array
+          items:
+            type: object
+            properties:
+              index:
+                type: integer
+                example: 0
+              prediction:
+                type: number
+                format: float
+                example: 2150.0
+              error:
+                type: string
+                example: "Missing field: 'bedNumb'"
+      400:
+        description: The request body could not be parsed
+    """
+    version, model = model_registry.get()
+    if model is None:
+        return jsonify({"error": "No model loaded yet"}), 503
+
+    ndjson = request.mimetype == 'application/x-ndjson'
+    try:
+        with stage_timer('json_parse', model_version=version):
+            rows, errors = parse_batch(request.get_data(as_text=True), ndjson)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid request body: {str(e)}"}), 400
+
+    # Rows missing from the prediction cache are packed at the top of one contiguous matrix
+    predictions = {}
+    missed_rows = []
+    with stage_timer('feature_build', model_version=version):
+        features, row_errors = payload_features(rows, city_index.centroid)
+        for index, message in row_errors.items():
+            errors.setdefault(index, message)
+        for index in range(len(rows)):
+            if index in errors:
+                continue
+            prediction = prediction_cache.get(version, features[index])
+            if prediction is not None:
+                predictions[index] = prediction
+            else:
+                features[len(missed_rows)] = features[index]
+                missed_rows.append(index)
+
+    if missed_rows:
+        with stage_timer('predict', model_version=version):
+            predicted = predict_rows(version, model, features[:len(missed_rows)]).tolist()
+        for position, index in enumerate(missed_rows):
+            predictions[index] = predicted[position]
+            prediction_cache.put(version, features[position], predicted[position])
+
+    def generate():
+        if not ndjson:
+            yield '['
+        for index in range(len(rows)):
+            if index in predictions:
+                result = {'index': index, 'prediction': predictions[index]}
+            else:
+                result = {'index': index, 'error': errors[index]}
+            if ndjson:
+                yield json.dumps(result) + '\n'
+            else:
+                yield (',' if index else '') + json.dumps(result)
+        if not ndjson:
+            yield ']'
+
+    mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'X-Model-Version': version})
+
 @app.route('/api/get_importance', methods=['GET'])
 def plot_feat_import():
     """
     Feature Importance
+
+    SHAP values are cached per model version and test set. When they are not
+    cached yet, the computation is queued and the response is a 202 with a
+    job id to poll on /api/jobs/<job_id>. Concurrent requests for the same
+    model and test set share one job.
     ---
     responses:
       200:
         description: Returns the image path of the plot for the factors that most influence our rental price prediction
+      202:
+        description: The plot is being computed, returns the job id and its status URL
     """
     try:
         # Check if MongoDB is connected
@@ -245,18 +407,21 @@ def plot_feat_import():
             
         # Get test data from MongoDB
         try:
-            test_data = list(test_collection.find({}, {'_id': 0}))
-            if not test_data:
+            with stage_timer('mongo_fetch'):
+                # Rows in file order, without the bookkeeping fields of sync.py
+                test_data = snapshots.table('test_data')
+            if not test_data.num_rows:
                 print("No test data found in MongoDB")
                 return jsonify({"error": "No test data found in MongoDB"}), 500
                 
-            print(f"Found {len(test_data)} test records")
+            print(f"Found {test_data.num_rows} test records")
         except Exception as e:
             print(f"Error retrieving test data: {e}")
             return jsonify({"error": f"Error retrieving test data: {str(e)}"}), 500
         
         # Convert to DataFrame
-        test = pd.DataFrame(test_data)
+        with stage_timer('dataframe_build'):
+            test = test_data.to_pandas()
         
         # Check if 'target' column exists
         if 'target' not in test.columns:
@@ -265,59 +430,122 @@ def plot_feat_import():
             
         X_test = test.drop('target', axis=1)
 
-        # Fits the explainer
-        try:
-            explainer = shap.Explainer(model.predict, X_test)
-            # Calculates the SHAP values - It takes some time
-            shap_values = explainer(X_test)
-        except Exception as e:
-            print(f"Error in SHAP calculation: {e}")
-            return jsonify({"error": f"Error in SHAP calculation: {str(e)}"}), 500
+        version, model = model_registry.get()
+        if model is None:
+            return jsonify({"error": "No model loaded yet"}), 503
 
-        # Create plot
-        try:
-            plt.figure()
-            shap.plots.beeswarm(shap_values, max_display=10, show=False)
-            plt.title('Features Importance (Beeswarm Plot)')
-            plt.xlabel('SHAP Value')
-            plt.ylabel('Features')
-        except Exception as e:
-            print(f"Error creating plot: {e}")
-            return jsonify({"error": f"Error creating plot: {str(e)}"}), 500
+        # Serve the stored plot if neither the model nor the test set changed
+        engine = engine_name(model)
+        key = cache_key(version, frame_hash(X_test), engine)
+        cached = shap_cache.get(key)
+        if cached is not None:
+            try:
+                return jsonify({'image_path': publish_importance_plot(shap_cache, key, cached)})
+            except Exception as e:
+                print(f"Error serving cached plot {key}, recomputing: {e}")
 
-        # Save the plot to S3
-        try:
-            # Generate a unique filename
-            filename = f"rent_feat_import_{int(time.time())}.png"
-            
-            # For production: save to S3
-            if os.environ.get('ENVIRONMENT') == 'production':
-                image_url = save_plot_to_s3(plt, filename)
-                plt.close()
-                return jsonify({'image_path': image_url})
-            
-            # For local development: save to static folder
-            else:
-                # Make sure the static directory exists
-                os.makedirs('static', exist_ok=True)
-                
-                image_path = 'static/rent_feat_import.png'
-                plt.savefig(image_path, bbox_inches='tight')
-                plt.close()
-                
-                # Return the local path
-                return jsonify({
-                    'image_path': f"{ML_API_URL}/static/rent_feat_import.png"
-                })
-                
-        except Exception as e:
-            print(f"Error saving plot: {e}")
-            return jsonify({"error": f"Error saving plot: {str(e)}"}), 500
+        # Queue the SHAP calculation, the rendering and the upload
+        job = importance_jobs.submit(key, compute_importance,
+                                     model_registry.artifact_path(version), X_test,
+                                     key, version, engine, shap_cache.directory)
+        status_url = f"{ML_API_URL}/api/jobs/{job['id']}"
+        return jsonify({
+            'job_id': job['id'],
+            'status': job['status'],
+            'status_url': status_url,
+        }), 202, {'Location': status_url}
 
     except Exception as e:
         print(f"Unexpected error: {e}")
         return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Background job status
+    ---
+    parameters:
+      - in: path
+        name: job_id
+        type: string
+        required: true
+    responses:
+      200:
+        description: Returns the status of the job (queued, running, done or failed) and its result once done
+      404:
+        description: Unknown job id
+    """
+    job = importance_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job: {job_id}"}), 404
+    return jsonify(job)
+
+@app.route('/api/model', methods=['GET'])
+def get_model():
+    """
+    Active model
+    ---
+    responses:
+      200:
+        description: Returns the version of the model used for predictions and where it comes from
+    """
+    return jsonify({
+        'model_version': model_registry.version,
+        'source': str(model_registry.source),
+        'last_checked': model_registry.last_checked,
+    })
+
+@app.route('/api/prediction_cache', methods=['GET'])
+def get_prediction_cache_stats():
+    """
+    Prediction cache statistics
+    ---
+    responses:
+      200:
+        description: Returns the size and the hit, miss and eviction counters of the prediction cache
+    """
+    return jsonify(prediction_cache.stats())
+
+@app.route('/api/deals', methods=['GET'])
+def get_deals():
+    """
+    Most underpriced listings
+
+    Listings whose rent is furthest below the rent the model predicts, read
+    from the deal score index in order. Only listings scored with the active
+    model are returned, scoring runs in the background after a change.
+    ---
+    parameters:
+      - in: query
+        name: limit
+        type: integer
+        required: false
+        description: Number of listings, 20 by default and at most MAX_DEALS (100 by default)
+    responses:
+      200:
+        description: >
+          Returns the listings with their rent, predicted_rent, rent_residual
+          (negative) and discount (the residual as a fraction of the predicted rent)
+    """
+    version = model_registry.version
+    if version is None:
+        return jsonify({"error": "No model loaded yet"}), 503
+    limit = request.args.get('limit', 20, type=int)
+    if limit < 1:
+        return jsonify({"error": "limit must be positive"}), 400
+    try:
+        deals = []
+        for document in underpriced(properties_collection, version, min(limit, MAX_DEALS), DEAL_FIELDS):
+            document.pop('_id')
+            # Missing CSV values are NaN, which isn't valid JSON
+            deal = {key: None if isinstance(value, float) and value != value else value
+                    for key, value in document.items()}
+            deal['discount'] = -deal['rent_residual'] / deal['predicted_rent'] if deal['predicted_rent'] else None
+            deals.append(deal)
+        return jsonify({'model_version': version, 'last_run': deal_scorer.last_run, 'data': deals})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5001))
     app.run(debug=os.environ.get('DEBUG', 'True').lower() == 'true', 
@@ -0,0 +1,190 @@
+""" Versioned model artifacts with a local disk cache and background hot-swap.
+
+The registry keeps every downloaded model under MODEL_CACHE_DIR/<version>/,
+where the version is derived from the ETag of the artifact in the object
+store. Workers start from the cached version (or the bundled model.pkl)
+without waiting on S3, then revalidate the ETag in a background thread and
+swap a new version in atomically when it changes. Local files get the ETag
+S3 gives the same bytes, so a bundled model that is also the one in the
+bucket isn't downloaded again.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+import joblib
+
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR', 'model_cache')
+# Seconds between two ETag revalidations (0 = only check at startup)
+MODEL_REFRESH_INTERVAL = float(os.environ.get('MODEL_REFRESH_INTERVAL', 300))
+# Part size of boto3's multipart uploads (its default threshold and chunk size)
+S3_PART_SIZE = 8 * 1024 * 1024
+
+
+def etag_to_version(etag):
+    """ETags are quoted and may contain '-', keep a filesystem safe version."""
+    return re.sub(r'[^A-Za-z0-9]', '', etag)[:32]
+
+
+def content_etag(path, part_size=S3_PART_SIZE):
+    """The ETag S3 gives a file uploaded by boto3: the MD5 of its bytes, or of its parts' MD5s above part_size."""
+    parts = []
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(part_size), b''):
+            parts.append(hashlib.md5(chunk).digest())
+    if len(parts) <= 1:
+        return f'"{(parts[0] if parts else hashlib.md5().digest()).hex()}"'
+    return f'"{hashlib.md5(b"".join(parts)).hexdigest()}-{len(parts)}"'
+
+
+class S3ModelSource:
+    """ A model artifact stored in an S3 bucket (or anything with the boto3 S3 API). """
+
+    def __init__(self, s3_client, bucket, key):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+
+    def __str__(self):
+        return f"s3://{self.bucket}/{self.key}"
+
+    def etag(self):
+        return self.s3_client.head_object(Bucket=self.bucket, Key=self.key)['ETag']
+
+    def download(self, path):
+        self.s3_client.download_file(self.bucket, self.key, path)
+
+
+class LocalModelSource:
+    """ A model artifact in a local directory, stands in for S3 in development and tests. """
+
+    def __init__(self, path):
+        self.path = path
+        self._etag = (None, None)
+
+    def __str__(self):
+        return self.path
+
+    def etag(self):
+        # Hashed again only when the modification time or the size changed
+        stat = os.stat(self.path)
+        if self._etag[0] != (stat.st_mtime_ns, stat.st_size):
+            self._etag = ((stat.st_mtime_ns, stat.st_size), content_etag(self.path))
+        return self._etag[1]
+
+    def download(self, path):
+        shutil.copyfile(self.path, path)
+
+
+class ModelRegistry:
+    """ Loads, caches and hot-swaps versions of the model from a source. """
+
+    def __init__(self, source, cache_dir=MODEL_CACHE_DIR,
+                 refresh_interval=MODEL_REFRESH_INTERVAL, fallback_path=None):
+        self.source = source
+        self.cache_dir = cache_dir
+        self.refresh_interval = refresh_interval
+        self.fallback_path = fallback_path
+        self.last_checked = None
+        self._active = (None, None)
+        self._lock = threading.Lock()
+        self._thread = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self):
+        """Returns the active (version, model) pair, (None, None) until one is loaded."""
+        return self._active
+
+    @property
+    def version(self):
+        return self._active[0]
+
+    def artifact_path(self, version):
+        return os.path.join(self.cache_dir, version, 'model.joblib')
+
+    def _activate(self, version, model):
+        with self._lock:
+            self._active = (version, model)
+        # Record the active version so the next start can load it without the source
+        tmp_path = os.path.join(self.cache_dir, f"current.json.{os.getpid()}.tmp")
+        with open(tmp_path, 'w') as file:
+            json.dump({'version': version, 'source': str(self.source), 'activated': time.time()}, file)
+        os.replace(tmp_path, os.path.join(self.cache_dir, 'current.json'))
+        print(f"Model version {version} is now active")
+
+    def _load(self, version):
+        # Memory-map the numpy arrays of the model where joblib can
+        return joblib.load(self.artifact_path(version), mmap_mode='r')
+
+    def _store(self, version, downloaded_path):
+        """Re-serializes a downloaded artifact (pickle or joblib) into the cache."""
+        model = joblib.load(downloaded_path)
+        os.makedirs(os.path.join(self.cache_dir, version), exist_ok=True)
+        tmp_path = f"{self.artifact_path(version)}.{os.getpid()}.tmp"
+        joblib.dump(model, tmp_path)
+        os.replace(tmp_path, self.artifact_path(version))
+
+    def load_cached(self):
+        """Activates the last version recorded in the cache, returns whether it did."""
+        try:
+            with open(os.path.join(self.cache_dir, 'current.json')) as file:
+                version = json.load(file)['version']
+            self._activate(version, self._load(version))
+            return True
+        except (FileNotFoundError, KeyError, ValueError) as e:
+            print(f"No cached model available: {e}")
+            return False
+
+    def load_fallback(self):
+        """Activates the bundled model file, used when nothing is cached yet."""
+        if not self.fallback_path or not os.path.exists(self.fallback_path):
+            return False
+        # The version the source has for the same bytes
+        version = etag_to_version(LocalModelSource(self.fallback_path).etag())
+        if not os.path.exists(self.artifact_path(version)):
+            self._store(version, self.fallback_path)
+        self._activate(version, self._load(version))
+        return True
+
+    def refresh(self):
+        """Revalidates the ETag of the source and swaps in a new version, returns whether it did."""
+        version = etag_to_version(self.source.etag())
+        self.last_checked = time.time()
+        if version == self.version:
+            return False
+
+        if not os.path.exists(self.artifact_path(version)):
+            print(f"Downloading model version {version} from {self.source}")
+            os.makedirs(os.path.join(self.cache_dir, version), exist_ok=True)
+            download_path = os.path.join(self.cache_dir, version, f"download.{os.getpid()}.tmp")
+            try:
+                self.source.download(download_path)
+                self._store(version, download_path)
+            finally:
+                if os.path.exists(download_path):
+                    os.remove(download_path)
+
+        self._activate(version, self._load(version))
+        return True
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Error refreshing model from {self.source}: {e}")
+            if not self.refresh_interval:
+                return
+            time.sleep(self.refresh_interval)
+
+    def start(self):
+        """Activates a local model right away, then revalidates the source in the background."""
+        if not self.load_cached():
+            self.load_fallback()
+        self._thread = threading.Thread(target=self._refresh_loop, name='model-refresh', daemon=True)
+        self._thread.start()
+        return self
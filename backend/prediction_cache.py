@@ -0,0 +1,90 @@
+""" Bounded LRU cache with TTL for model predictions.
+
+Prediction inputs are mostly low-cardinality (binary amenity flags, small
+counts, a date), so identical feature vectors repeat a lot. Entries are keyed
+on the canonical feature tuple and dropped whenever the model version changes.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+PREDICTION_CACHE_SIZE = int(os.environ.get('PREDICTION_CACHE_SIZE', 10000))
+PREDICTION_CACHE_TTL = float(os.environ.get('PREDICTION_CACHE_TTL', 3600))
+
+
+def canonical_key(features):
+    """Normalizes a feature row so that e.g. 2, 2.0 and '2' share an entry."""
+    return tuple(float(value) for value in features)
+
+
+class PredictionCache:
+    """ Thread-safe LRU cache of predictions, invalidated on model version change. """
+
+    def __init__(self, maxsize=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.model_version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _check_version(self, model_version):
+        # Called with the lock held
+        if model_version != self.model_version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self.model_version = model_version
+
+    def get(self, model_version, features):
+        """Returns the cached prediction for the feature row, or None."""
+        key = canonical_key(features)
+        with self._lock:
+            self._check_version(model_version)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            prediction, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return prediction
+
+    def put(self, model_version, features, prediction):
+        """Stores a prediction, evicting the least recently used entries if full."""
+        key = canonical_key(features)
+        with self._lock:
+            self._check_version(model_version)
+            self._entries[key] = (prediction, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'model_version': self.model_version,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
@@ -1,19 +1,37 @@
-""" Contains all queries to the Realtor.ca API and OpenStreetMap."""
-import requests
+""" Contains all queries to the Realtor.ca API and OpenStreetMap.
+
+Requests go through the shared http_client, with pooled connections, retries
+and the on-disk response cache (or its recordings, with HTTP_MODE=replay).
+"""
+from http_client import client
+
+REALTOR_HEADERS = {"Referer": "https://www.realtor.ca/",
+                   "Origin": "https://www.realtor.ca/",
+                   "Host": "api2.realtor.ca"}
+
+
+def _check(response):
+    """Raises an HTTPError for any status other than 200, 403 meaning rate limited."""
+    if response.status_code == 403:
+        print("Error 403: Rate limited")
+    elif response.status_code != 200:
+        print("Error " + str(response.status_code))
+    response.raise_for_status()
+    return response.json()
 
 
 def get_coordinates(city):
     """Gets the coordinate bounds of a city from OpenStreetMap."""
 
     # Ottawa,ON to Ottawa, ON
-    city = city.replace(',', ', ')
+    city = ', '.join(part.strip() for part in city.split(','))
 
-    url = "https://https://nominatim.openstreetmap.org/search.php?city=Ottawa&state=Ontario&country=Canada&format=jsonv2"
-    response = requests.get(url=url, timeout=10)
-    response.raise_for_status()
-    data = response.json()
+    url = "https://nominatim.openstreetmap.org/search"
+    params = {"q": city + ", Canada", "format": "jsonv2"}
+    # Nominatim's usage policy requires an identifying User-Agent
+    headers = {"User-Agent": "RentalAI"}
+    data = _check(client.get(url, 'geocode', params=params, headers=headers))
 
-    print(data)
     for response in data:
         if (response["class"] == "boundary" and
                 response["type"] == "administrative"):
@@ -26,9 +44,6 @@ def get_property_list(lat_min, lat_max, long_min, long_max, building_type, recor
     """Queries the Realtor.ca API to get a list of properties."""
 
     url = "https://api2.realtor.ca/Listing.svc/PropertySearch_Post"
-    headers = {"Referer": "https://www.realtor.ca/",
-               "Origin": "https://www.realtor.ca/",
-               "Host": "api2.realtor.ca"}
 
     form = {
         "LatitudeMin": lat_min,
@@ -43,28 +58,16 @@ def get_property_list(lat_min, lat_max, long_min, long_max, building_type, recor
         "ApplicationId": application_id
     }
 
-    response = requests.post(url=url, headers=headers, data=form, timeout=10)
-    if response.status_code == 403:
-        print("Error 403: Rate limited")
-    elif response.status_code != 200:
-        print("Error " + str(response.status_code))
-    response.raise_for_status()
-    return response.json()
-
+    return _check(client.post(url, 'search', data=form, headers=REALTOR_HEADERS))
 
-def get_property_details(property_id, mls_reference_number):
-    """Queries the Realtor.ca API to get details of a property."""
 
-    baseurl = "https://api2.realtor.ca/Listing.svc/PropertyDetails?ApplicationId=1&CultureId=1"
-    url = baseurl + "&PropertyID=" + property_id + "&ReferenceNumber=" + mls_reference_number
+def get_property_details(property_id, mls_reference_number, refresh=False):
+    """Queries the Realtor.ca API to get details of a property, refresh skips the cached response."""
 
-    headers = {"Referer": "https://www.realtor.ca/",
-               "Origin": "https://www.realtor.ca/",
-               "Host": "api2.realtor.ca"}
-    response = requests.get(url=url, headers=headers, timeout=10)
-    if response.status_code == 403:
-        print("Error 403: Rate limited")
-    elif response.status_code != 200:
-        print("Error " + str(response.status_code))
-    response.raise_for_status()
-    return response.json()
+    url = "https://api2.realtor.ca/Listing.svc/PropertyDetails"
+    params = {"ApplicationId": 1,
+              "CultureId": 1,
+              "PropertyID": property_id,
+              "ReferenceNumber": mls_reference_number}
+    return _check(client.get(url, 'details', params=params, headers=REALTOR_HEADERS,
+                             max_age=0 if refresh else None))
@@ -0,0 +1,256 @@
+""" Materialized rent statistics, for the dashboard and its charts.
+
+Two collections hold small rollup documents with a listing count, the sum of
+the rents and a histogram of the rents in fixed-width bins:
+
+    listing_stats     one document per building type, plus one for all listings
+                      {'_id': 'Apartment', 'count': 61, 'rent_count': 60, 'rent_sum': 118450.0,
+                       'histogram': {'1500': 4, '1550': 7, ...}, 'bin_width': 50, 'updated': ...}
+    rent_timeseries   the same per day and per month the listings were posted
+                      {'_id': 'month:2024-03:all', 'period': 'month', 'date': '2024-03',
+                       'building_type': 'all', 'count': 12, ...}
+
+Counts and sums are only ever incremented, so listings are added (or removed,
+with sign=-1) as they are ingested without reading the listings collection.
+The rebuild functions recompute a collection from the listings, for backfills
+and when the bin width changes. They build it in a temporary collection that
+is then renamed over the old one, so readers never see partial rollups.
+Writers of the rollups hold rollups_lock, a lease in the meta collection: a
+rebuild reading the listings while a sync applies its increments would lose
+or count them twice. Mean rents are exact; the median and quantiles are
+interpolated within a histogram bin.
+"""
+import math
+import os
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+from features import posted_dates
+
+# Width of the rent histogram bins, in dollars
+RENT_BIN_WIDTH = int(os.environ.get('RENT_BIN_WIDTH', 50))
+ALL_LISTINGS = 'all'
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+# Time series periods and the format of their dates
+TIMESERIES_PERIODS = {'day': '%Y-%m-%d', 'month': '%Y-%m'}
+# Seconds rollups_lock is held at most, a crashed holder's lease expires after them
+ROLLUP_LOCK_TIMEOUT = float(os.environ.get('ROLLUP_LOCK_TIMEOUT', 600))
+ROLLUP_LOCK_ID = 'rollups_lock'
+
+
+@contextmanager
+def rollups_lock(meta_collection, timeout=ROLLUP_LOCK_TIMEOUT, poll=0.1):
+    """Holds the lock of the rollups, shared by every process using the database."""
+    owner = uuid.uuid4().hex
+    while True:
+        now = time.time()
+        try:
+            # Inserts the lease, or takes over an expired one; a held lease makes the upsert fail
+            meta_collection.update_one({'_id': ROLLUP_LOCK_ID, 'expires': {'$lt': now}},
+                                       {'$set': {'owner': owner, 'expires': now + timeout}}, upsert=True)
+            break
+        except DuplicateKeyError:
+            time.sleep(poll)
+    try:
+        yield
+    finally:
+        meta_collection.delete_one({'_id': ROLLUP_LOCK_ID, 'owner': owner})
+
+
+def _swap(collection, build):
+    # Builds the new documents next to the collection, then replaces it at once
+    tmp_collection = collection.database[f"{collection.name}_rebuild"]
+    tmp_collection.drop()
+    build(tmp_collection)
+    if tmp_collection.estimated_document_count() == 0:
+        # Nothing to rename, and no listings to roll up
+        tmp_collection.drop()
+        collection.delete_many({})
+        return
+    tmp_collection.rename(collection.name, dropTarget=True)
+
+
+def rent_bin(rent, width=RENT_BIN_WIDTH):
+    """Returns the histogram key of a rent, None for listings without a rent."""
+    if rent is None or rent != rent or rent <= 0:
+        return None
+    return str(math.floor(rent / width) * width)
+
+
+def _empty_delta():
+    return {'count': 0, 'rent_count': 0, 'rent_sum': 0.0, 'histogram': defaultdict(int), 'fields': {}}
+
+
+def _add_to_delta(delta, count, rent_sum, key):
+    delta['count'] += count
+    if key is not None:
+        delta['rent_count'] += count
+        delta['rent_sum'] += rent_sum
+        delta['histogram'][key] += count
+
+
+def _apply(collection, deltas, width, sign=1):
+    now = time.time()
+    for _id, delta in deltas.items():
+        increments = {
+            'count': sign * delta['count'],
+            'rent_count': sign * delta['rent_count'],
+            'rent_sum': sign * delta['rent_sum'],
+        }
+        for key, count in delta['histogram'].items():
+            increments[f'histogram.{key}'] = sign * count
+        collection.update_one(
+            {'_id': _id},
+            {'$inc': increments, '$set': dict(delta['fields'], bin_width=width, updated=now)},
+            upsert=True,
+        )
+    if sign < 0:
+        # Days, months or building types without listings left
+        collection.delete_many({'count': {'$lte': 0}})
+
+
+def add_listings(stats_collection, records, sign=1, width=RENT_BIN_WIDTH):
+    """Adds prepared listing records (see ingest.prepare_listing) to the rollups, or removes them with sign=-1."""
+    deltas = defaultdict(_empty_delta)
+    for record in records:
+        rent = record.get('rent')
+        key = rent_bin(rent, width)
+        for building_type in (ALL_LISTINGS, record.get('building_type', 'Unknown')):
+            _add_to_delta(deltas[building_type], 1, rent or 0.0, key)
+    _apply(stats_collection, deltas, width, sign)
+
+
+def rebuild(properties_collection, stats_collection, width=RENT_BIN_WIDTH):
+    """Recomputes the rollups of every building type from the listings collection, under rollups_lock."""
+    rows = properties_collection.aggregate([
+        {'$project': {
+            'building_type': 1,
+            'rent': {'$cond': [{'$gt': ['$rent', 0]}, '$rent', None]},
+        }},
+        {'$group': {
+            '_id': {
+                'building_type': '$building_type',
+                'bin': {'$multiply': [{'$floor': {'$divide': ['$rent', width]}}, width]},
+            },
+            'count': {'$sum': 1},
+            'rent_sum': {'$sum': '$rent'},
+        }},
+    ])
+
+    deltas = defaultdict(_empty_delta)
+    for row in rows:
+        bin_start = row['_id'].get('bin')
+        key = None if bin_start is None else str(int(bin_start))
+        for building_type in (ALL_LISTINGS, row['_id'].get('building_type') or 'Unknown'):
+            _add_to_delta(deltas[building_type], row['count'], row['rent_sum'], key)
+
+    _swap(stats_collection, lambda collection: _apply(collection, deltas, width))
+
+
+def ensure_timeseries_indexes(timeseries_collection):
+    timeseries_collection.create_index(
+        [('period', ASCENDING), ('building_type', ASCENDING), ('date', ASCENDING)], name='period_type_date')
+
+
+def add_timeseries(timeseries_collection, records, sign=1, width=RENT_BIN_WIDTH):
+    """Adds prepared listing records to the daily and monthly rollups, or removes them with sign=-1."""
+    if not records:
+        return
+    frame = pd.DataFrame({
+        'posted': posted_dates([record.get('InsertedDateUTC') for record in records]),
+        'building_type': [record.get('building_type', 'Unknown') for record in records],
+        'rent': pd.to_numeric(pd.Series([record.get('rent') for record in records], dtype=object),
+                              errors='coerce'),
+    })
+    frame = frame[frame['posted'].notna()]
+    frame.loc[~(frame['rent'] > 0), 'rent'] = np.nan
+    frame['bin'] = np.floor(frame['rent'] / width) * width
+    frame = pd.concat([frame, frame.assign(building_type=ALL_LISTINGS)], ignore_index=True)
+
+    deltas = defaultdict(_empty_delta)
+    for period, date_format in TIMESERIES_PERIODS.items():
+        frame['date'] = frame['posted'].dt.strftime(date_format)
+        groups = frame.groupby(['date', 'building_type', 'bin'], dropna=False)['rent'].agg(['size', 'sum'])
+        for (date, building_type, bin_start), (count, rent_sum) in groups.iterrows():
+            delta = deltas[f'{period}:{date}:{building_type}']
+            delta['fields'] = {'period': period, 'date': date, 'building_type': building_type}
+            key = None if bin_start != bin_start else str(int(bin_start))
+            _add_to_delta(delta, int(count), float(rent_sum), key)
+    _apply(timeseries_collection, deltas, width, sign)
+
+
+def rebuild_timeseries(properties_collection, timeseries_collection, width=RENT_BIN_WIDTH, chunk_size=10000):
+    """Recomputes the daily and monthly rollups from the listings collection, under rollups_lock."""
+    def build(collection):
+        ensure_timeseries_indexes(collection)
+        cursor = properties_collection.find({}, {'_id': 0, 'InsertedDateUTC': 1, 'building_type': 1, 'rent': 1})
+        chunk = []
+        for record in cursor:
+            chunk.append(record)
+            if len(chunk) == chunk_size:
+                add_timeseries(collection, chunk, width=width)
+                chunk = []
+        add_timeseries(collection, chunk, width=width)
+
+    _swap(timeseries_collection, build)
+    ensure_timeseries_indexes(timeseries_collection)
+
+
+def stale(properties_collection, stats_collection, width=RENT_BIN_WIDTH):
+    """True when listings are stored without rollups, or with rollups of another bin width."""
+    if stats_collection.find_one({'bin_width': {'$ne': width}}, {'_id': 1}) is not None:
+        return True
+    return (stats_collection.estimated_document_count() == 0
+            and properties_collection.estimated_document_count() > 0)
+
+
+def backfill(properties_collection, stats_collection, timeseries_collection, width=RENT_BIN_WIDTH):
+    """Rebuilds both rollups when they are stale, returns whether they were."""
+    with rollups_lock(stats_collection.database['meta']):
+        # Another process may have rebuilt them while we waited
+        if not stale(properties_collection, stats_collection, width):
+            return False
+        rebuild(properties_collection, stats_collection, width)
+        rebuild_timeseries(properties_collection, timeseries_collection, width)
+        return True
+
+
+def histogram_quantile(histogram, width, q):
+    """Estimates a quantile from histogram bins, interpolating linearly within a bin."""
+    bins = sorted((int(key), count) for key, count in histogram.items() if count > 0)
+    total = sum(count for _, count in bins)
+    if not total:
+        return None
+    target = q * total
+    seen = 0
+    for bin_start, count in bins:
+        if seen + count >= target:
+            return bin_start + width * (target - seen) / count
+        seen += count
+    return bins[-1][0] + width
+
+
+def summarize(document):
+    """Turns a rollup document into the stats returned by the API."""
+    width = document.get('bin_width', RENT_BIN_WIDTH)
+    histogram = document.get('histogram', {})
+    rent_count = document.get('rent_count', 0)
+    return {
+        'count': document.get('count', 0),
+        'rent_count': rent_count,
+        'mean': document['rent_sum'] / rent_count if rent_count else None,
+        'median': histogram_quantile(histogram, width, 0.5),
+        'quantiles': {f'p{round(q * 100)}': histogram_quantile(histogram, width, q) for q in QUANTILES},
+        'histogram': [
+            {'min': int(key), 'max': int(key) + width, 'count': count}
+            for key, count in sorted(histogram.items(), key=lambda item: int(item[0])) if count > 0
+        ],
+        'updated': document.get('updated'),
+    }
@@ -0,0 +1,115 @@
+""" Persistent cache of SHAP values and rendered feature importance plots.
+
+Entries are keyed on the model version and a hash of the test set, so they are
+only recomputed when the model or the test data actually changes. An entry
+stored with partial=True (SHAP values cut short by the time budget) is served
+once and then treated as a miss, so the next request computes it again.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+SHAP_CACHE_DIR = os.environ.get('SHAP_CACHE_DIR', 'shap_cache')
+
+
+def frame_hash(df):
+    """Hashes the columns and the values of a DataFrame, ignoring its index."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([str(col) for col in df.columns]).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()[:16]
+
+
+def cache_key(model_version, data_hash, engine=None):
+    """Builds the cache key for a model version, a test set hash and the explainer used."""
+    if engine:
+        return f"{model_version}-{engine}-{data_hash}"
+    return f"{model_version}-{data_hash}"
+
+
+def _write_atomic(path, data):
+    """Writes to a temporary file first so readers never see a partial file."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+class ShapCache:
+    """ Stores SHAP values, the rendered beeswarm and its metadata per key. """
+
+    def __init__(self, directory=SHAP_CACHE_DIR):
+        self.directory = directory
+        self._entries = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, name):
+        return os.path.join(self.directory, key, name)
+
+    def _load(self, key):
+        with self._lock:
+            if key in self._entries:
+                return self._entries[key]
+        try:
+            with open(self._path(key, 'meta.json')) as file:
+                meta = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+        with self._lock:
+            self._entries[key] = meta
+        return meta
+
+    def get(self, key):
+        """Returns the metadata of a cached entry, or None if it was never fully computed."""
+        meta = self._load(key)
+        if meta is None or meta.get('partial'):
+            return None
+        return meta
+
+    def put(self, key, shap_values, image, **meta):
+        """Stores the SHAP values and the rendered plot (PNG bytes) under the key."""
+        os.makedirs(os.path.join(self.directory, key), exist_ok=True)
+
+        tmp_path = self._path(key, f"values.{os.getpid()}.tmp.npz")
+        np.savez_compressed(tmp_path,
+                            values=shap_values.values,
+                            base_values=shap_values.base_values,
+                            data=np.asarray(shap_values.data, dtype=np.float64),
+                            feature_names=np.asarray(shap_values.feature_names, dtype=str))
+        os.replace(tmp_path, self._path(key, 'values.npz'))
+        _write_atomic(self._path(key, 'beeswarm.png'), image)
+
+        # Replaces the metadata, a full entry keeps nothing of a partial one (e.g. its URL)
+        return self._store(key, dict(meta, created=time.time()))
+
+    def update(self, key, **fields):
+        """Merges fields into the metadata of an entry (e.g. its uploaded URL)."""
+        return self._store(key, dict(self._load(key) or {}, **fields))
+
+    def _store(self, key, meta):
+        meta['key'] = key
+        _write_atomic(self._path(key, 'meta.json'), json.dumps(meta).encode())
+        with self._lock:
+            self._entries[key] = meta
+        return meta
+
+    def load_image(self, key):
+        """Returns the rendered beeswarm PNG of an entry."""
+        with open(self._path(key, 'beeswarm.png'), 'rb') as file:
+            return file.read()
+
+    def load_values(self, key):
+        """Returns the stored SHAP values of an entry as a shap.Explanation."""
+        import shap
+
+        with np.load(self._path(key, 'values.npz')) as stored:
+            return shap.Explanation(values=stored['values'],
+                                    base_values=stored['base_values'],
+                                    data=stored['data'],
+                                    feature_names=list(stored['feature_names']))
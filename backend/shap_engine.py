@@ -0,0 +1,76 @@
+""" Selects and runs the SHAP explainer best suited to the loaded model.
+
+Tree ensembles (the RandomForestRegressor in model.pkl) are explained exactly
+from their tree structure; any other model falls back to the model-agnostic
+permutation explainer, which has to call predict many times per row.
+"""
+import os
+import time
+
+import numpy as np
+import shap
+
+# Rows of the test set used as the background (masking) distribution
+SHAP_BACKGROUND_SIZE = int(os.environ.get('SHAP_BACKGROUND_SIZE', 100))
+# Seconds after which no further chunks of rows are explained (0 = no limit)
+SHAP_TIME_BUDGET = float(os.environ.get('SHAP_TIME_BUDGET', 0))
+# Rows explained per chunk, the time budget is checked between chunks
+SHAP_CHUNK_SIZE = int(os.environ.get('SHAP_CHUNK_SIZE', 256))
+
+TREE_MODELS = ('RandomForestRegressor', 'ExtraTreesRegressor', 'DecisionTreeRegressor',
+               'GradientBoostingRegressor', 'HistGradientBoostingRegressor',
+               'XGBRegressor', 'LGBMRegressor', 'CatBoostRegressor')
+
+
+def engine_name(model, background_size=SHAP_BACKGROUND_SIZE):
+    """Names the explainer used for a model, so cached values can be keyed on it."""
+    kind = 'tree' if type(model).__name__ in TREE_MODELS else 'permutation'
+    return f"{kind}-bg{background_size}"
+
+
+def make_explainer(model, X, background_size=SHAP_BACKGROUND_SIZE):
+    """Builds the explainer for the model, with a sample of X as background data."""
+    if len(X) > background_size > 0:
+        background = shap.sample(X, background_size, random_state=0)
+    else:
+        background = X
+
+    if type(model).__name__ in TREE_MODELS:
+        if background_size <= 0:
+            # Exact path-dependent algorithm, uses the training cover of each node
+            return shap.TreeExplainer(model, feature_perturbation='tree_path_dependent')
+        return shap.TreeExplainer(model, data=background, feature_perturbation='interventional')
+
+    return shap.Explainer(model.predict, background)
+
+
+def compute_shap_values(model, X, background_size=SHAP_BACKGROUND_SIZE,
+                        time_budget=SHAP_TIME_BUDGET, chunk_size=SHAP_CHUNK_SIZE):
+    """
+    Explains the rows of X. When a time budget is set, rows are explained in
+    chunks and the remaining chunks are skipped once the budget is spent, so
+    the result may only cover the first rows of X: callers compare its length
+    with len(X) to tell a partial result.
+    """
+    explainer = make_explainer(model, X, background_size)
+    started = time.perf_counter()
+
+    chunks = []
+    for start in range(0, len(X), chunk_size):
+        chunk = X.iloc[start:start + chunk_size]
+        if isinstance(explainer, shap.TreeExplainer):
+            # check_additivity fails spuriously on float32 thresholds
+            chunks.append(explainer(chunk, check_additivity=False))
+        else:
+            chunks.append(explainer(chunk))
+
+        if time_budget and time.perf_counter() - started > time_budget:
+            break
+
+    if len(chunks) == 1:
+        return chunks[0]
+    return shap.Explanation(values=np.concatenate([c.values for c in chunks]),
+                            base_values=np.concatenate([np.broadcast_to(c.base_values, (len(c.values),))
+                                                         for c in chunks]),
+                            data=np.concatenate([c.data for c in chunks]),
+                            feature_names=chunks[0].feature_names)
@@ -0,0 +1,157 @@
+""" Columnar snapshots of the collections, for the analytics endpoints.
+
+A snapshot is an Arrow IPC file holding only the analytical columns of a
+collection, written once per data version (see ingest.data_version):
+
+    snapshots/properties-<version>.arrow   rents, bedrooms, building type,
+                                           location, post date and the
+                                           columns features.py reads
+    snapshots/test_data-<version>.arrow    the test set, in file order
+
+Listing documents carry about 50 flattened columns, remarks and media
+included. A snapshot is read from MongoDB with only its columns projected, in
+batches, then opened with pa.memory_map: the analytics read the columns they
+need straight from the page cache, without copies or round trips to MongoDB.
+
+Snapshots are refreshed by sync.run_sync, and on the first read after any
+other ingest changed the data version.
+"""
+import os
+import threading
+
+import pandas as pd
+import pyarrow as pa
+
+from features import SOURCE_COLUMNS
+from ingest import data_version, project_fields
+
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', 'snapshots')
+SNAPSHOT_BATCH_SIZE = int(os.environ.get('SNAPSHOT_BATCH_SIZE', 10000))
+
+# Listing columns features.py reads as numbers, the others are kept as text
+NUMERIC_COLUMNS = ('Building.StoriesTotal', 'Property.Address.Longitude', 'Property.Address.Latitude',
+                   'Property.ParkingSpaceTotal')
+LISTING_SCHEMA = pa.schema(
+    [('Id', pa.int64()), ('MlsNumber', pa.string()), ('rent', pa.float64()), ('bedrooms', pa.float64()),
+     ('building_type', pa.string()), ('Property.LeaseRentUnformattedValue', pa.float64()),
+     ('InsertedDateUTC', pa.int64())]
+    + [(column, pa.float64() if column in NUMERIC_COLUMNS else pa.string())
+       for column in SOURCE_COLUMNS if column != 'InsertedDateUTC'])
+# The columns of each snapshot, None keeps every column with the types of the data
+SNAPSHOTS = {
+    'properties': {'schema': LISTING_SCHEMA, 'sort': None},
+    # The test set in file order, without the bookkeeping fields of sync.py
+    'test_data': {'schema': None, 'sort': '_row'},
+}
+
+
+def snapshot_path(name, version, directory=SNAPSHOT_DIR):
+    return os.path.join(directory, f"{name}-{version}.arrow")
+
+
+def _batch(documents, schema):
+    frame = pd.DataFrame(documents)
+    if schema is None:
+        return pa.RecordBatch.from_pandas(frame, preserve_index=False)
+    columns = []
+    for field in schema:
+        values = frame[field.name] if field.name in frame.columns else pd.Series([None] * len(frame), dtype=object)
+        if pa.types.is_string(field.type):
+            # Text as it was crawled, numbers in text columns included
+            values = values.map(lambda value: None if value is None or value != value else str(value))
+        else:
+            values = pd.to_numeric(values, errors='coerce')
+            if pa.types.is_integer(field.type):
+                values = values.astype('Int64')
+        columns.append(pa.array(values, type=field.type, from_pandas=True))
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def write_snapshot(db, name, version, directory=SNAPSHOT_DIR, batch_size=SNAPSHOT_BATCH_SIZE):
+    """Writes the snapshot of a collection for a data version, returns its path."""
+    options = SNAPSHOTS[name]
+    schema = options['schema']
+    pipeline = [{'$sort': {options['sort']: 1}}] if options['sort'] else []
+    if schema is not None:
+        pipeline.append(project_fields(schema.names))
+    pipeline.append({'$project': {'_id': 0, '_row': 0, '_content_hash': 0}})
+
+    os.makedirs(directory, exist_ok=True)
+    path = snapshot_path(name, version, directory)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    writer = None
+    documents = []
+
+    def write(documents):
+        nonlocal writer
+        batch = _batch(documents, schema)
+        writer = writer or pa.ipc.new_file(tmp_path, batch.schema)
+        writer.write_batch(batch)
+
+    try:
+        for document in db[name].aggregate(pipeline, batchSize=batch_size):
+            documents.append(document)
+            if len(documents) == batch_size:
+                write(documents)
+                documents = []
+        if documents:
+            write(documents)
+        # An empty collection still gets its (empty) snapshot
+        writer = writer or pa.ipc.new_file(tmp_path, schema if schema is not None else pa.schema([]))
+    finally:
+        if writer is not None:
+            writer.close()
+    os.replace(tmp_path, path)
+    _remove_stale(name, path, directory)
+    return path
+
+
+def _remove_stale(name, current, directory):
+    # The previous snapshot is kept for readers that still have it mapped
+    paths = sorted((os.path.join(directory, file) for file in os.listdir(directory)
+                    if file.startswith(f"{name}-") and file.endswith('.arrow')), key=os.path.getmtime)
+    for path in [path for path in paths if path != current][:-1]:
+        try:
+            os.remove(path)
+        except OSError:
+            # Still mapped by another process on Windows, removed next time
+            pass
+
+
+class SnapshotStore:
+    """ The memory-mapped snapshot of each collection's current data version. """
+
+    def __init__(self, db, directory=SNAPSHOT_DIR):
+        self.db = db
+        self.directory = directory
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def refresh(self, name):
+        """Writes the snapshot of the current data version unless it exists, returns its path."""
+        version = data_version(self.db['meta'], name)
+        path = snapshot_path(name, version, self.directory)
+        if not os.path.exists(path):
+            # One writer per process, readers of other versions aren't blocked for long
+            with self._lock:
+                if not os.path.exists(path):
+                    write_snapshot(self.db, name, version, self.directory)
+        return version, path
+
+    def table(self, name, columns=None):
+        """Returns the snapshot as an Arrow table backed by the mapped file, with only the given columns."""
+        version, path = self.refresh(name)
+        cached = self._tables.get(name)
+        if cached is None or cached[0] != version:
+            # The columns of the table point into the mapped file, no data is copied
+            source = pa.memory_map(path, 'r')
+            cached = (version, pa.ipc.open_file(source).read_all(), source)
+            self._tables[name] = cached
+        table = cached[1]
+        return table.select(columns) if columns is not None else table
+
+
+def refresh_snapshots(db, directory=SNAPSHOT_DIR):
+    """Writes the snapshots of every collection for their current data version."""
+    store = SnapshotStore(db, directory)
+    return {name: store.refresh(name)[1] for name in SNAPSHOTS}
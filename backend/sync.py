@@ -0,0 +1,204 @@
+""" Incremental, idempotent sync of the CSV data into MongoDB.
+
+Every row gets a hash of its content (_content_hash). A sync reads the key and
+hash of the stored documents, then writes only the rows that are new or whose
+hash changed, with chunked unordered bulk_write upserts, and deletes the
+documents whose rows are gone. Running it twice on the same files writes
+nothing the second time, and readers never see an empty collection.
+
+Listings are keyed on (Id, MlsNumber) and record where they came from
+(_source): a CSV sync only deletes the listings of the CSV files, never the
+listings the crawler ingested (crawl_ingest.py). The rollups (rollups.py) are updated
+with the old and new versions of the changed listings, and the data version
+(ingest.py) is bumped when anything changed, and the analytics snapshots
+(snapshot.py) of the new version are written.
+
+    python sync.py                 # sync OttawaON.csv and test_set.csv
+    python sync.py --listings Ottawa2025.csv --keep-missing
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import pandas as pd
+from pymongo import ASCENDING, DeleteOne, MongoClient, ReplaceOne
+
+import rollups
+from snapshot import refresh_snapshots
+from ingest import bump_data_version, ensure_indexes, prepare_listing
+
+MONGODB_URI = os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/')
+MONGODB_DB = os.environ.get('MONGODB_DB', 'rentalai_db')
+SYNC_CHUNK_SIZE = int(os.environ.get('SYNC_CHUNK_SIZE', 1000))
+LISTINGS_CSV = 'OttawaON.csv'
+TEST_DATA_CSV = 'test_set.csv'
+
+LISTING_KEY = ('Id', 'MlsNumber')
+# Test rows have no identifier, they are keyed on their position in the file
+TEST_DATA_KEY = ('_row',)
+# Fields of the stored listings needed to take them out of the rollups
+ROLLUP_FIELDS = ('rent', 'building_type', 'InsertedDateUTC')
+
+
+def content_hash(record):
+    """Hashes a row's source fields, independent of their order."""
+    data = json.dumps(record, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def _key(document, key_fields):
+    return tuple(str(document.get(field)) for field in key_fields)
+
+
+def _bulk_write(collection, operations, chunk_size):
+    for start in range(0, len(operations), chunk_size):
+        collection.bulk_write(operations[start:start + chunk_size], ordered=False)
+
+
+def sync_collection(collection, records, key_fields, chunk_size=SYNC_CHUNK_SIZE, prune=True,
+                    prepare=None, tracked_fields=(), query=None, source=None):
+    """
+    Upserts the new and changed records into collection, keyed on key_fields,
+    and deletes the documents missing from records unless prune is False.
+    Only the documents matching query are compared, all of them by default.
+    With a source, records are stored with it as _source and only documents
+    of that source (or without one, stored before sources) are deleted.
+    Returns the counts of what was done, along with the stored documents that
+    were replaced or deleted (their tracked_fields only) and the records written.
+    """
+    # Later rows win over earlier rows with the same key
+    incoming = {}
+    skipped = 0
+    for record in records:
+        # Copied, the caller's rows are left as they are
+        record = dict(record)
+        if source is not None:
+            record['_source'] = source
+        if any(pd.isna(record.get(field)) for field in key_fields):
+            skipped += 1
+            continue
+        record['_content_hash'] = content_hash(record)
+        incoming[_key(record, key_fields)] = record
+
+    projection = {field: 1 for field in key_fields + ('_content_hash', '_source') + tuple(tracked_fields)}
+    existing = {}
+    operations = []
+    removed = []
+    for document in collection.find(query or {}, projection):
+        key = _key(document, key_fields)
+        gone = prune and key not in incoming and document.get('_source', source) == source
+        if key in existing or gone:
+            # Duplicates of a key, e.g. left by the delete-and-insert loads, and rows gone from the source
+            operations.append(DeleteOne({'_id': document['_id']}))
+            removed.append(document)
+        else:
+            existing[key] = document
+
+    written = []
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'deleted': len(operations), 'skipped': skipped}
+    for key, record in incoming.items():
+        stored = existing.get(key)
+        if stored is not None and stored.get('_content_hash') == record['_content_hash']:
+            counts['unchanged'] += 1
+            continue
+        if stored is None:
+            counts['inserted'] += 1
+        else:
+            counts['updated'] += 1
+            removed.append(stored)
+        if prepare is not None:
+            prepare(record)
+        written.append(record)
+        # Stored documents are replaced by _id, duplicates of their key may be deleted in the same batch
+        target = {'_id': stored['_id']} if stored is not None else {field: record[field] for field in key_fields}
+        operations.append(ReplaceOne(target, record, upsert=True))
+
+    _bulk_write(collection, operations, chunk_size)
+    return counts, removed, written
+
+
+def sync_listings(db, records, chunk_size=SYNC_CHUNK_SIZE, prune=True, query=None, source='csv'):
+    """
+    Syncs listing rows into db.properties and keeps the rollups and the data
+    version current. Pruning only deletes the listings of the same source.
+    """
+    properties_collection = db['properties']
+    stats_collection = db['listing_stats']
+    timeseries_collection = db['rent_timeseries']
+
+    properties_collection.create_index([(field, ASCENDING) for field in LISTING_KEY], name='listing_key')
+    # The listings and their rollup increments are written together, never during a rebuild
+    with rollups.rollups_lock(db['meta']):
+        # Rollups missing next to stored listings can't be updated incrementally
+        rebuild = rollups.stale(properties_collection, stats_collection)
+        counts, removed, written = sync_collection(
+            properties_collection, records, LISTING_KEY, chunk_size, prune,
+            prepare=prepare_listing, tracked_fields=ROLLUP_FIELDS, query=query, source=source)
+        ensure_indexes(properties_collection)
+        rollups.ensure_timeseries_indexes(timeseries_collection)
+
+        if rebuild:
+            rollups.rebuild(properties_collection, stats_collection)
+            rollups.rebuild_timeseries(properties_collection, timeseries_collection)
+        elif removed or written:
+            rollups.add_listings(stats_collection, removed, sign=-1)
+            rollups.add_timeseries(timeseries_collection, removed, sign=-1)
+            rollups.add_listings(stats_collection, written)
+            rollups.add_timeseries(timeseries_collection, written)
+
+    if removed or written:
+        bump_data_version(db['meta'])
+    return counts
+
+
+def upsert_listings(db, records, chunk_size=SYNC_CHUNK_SIZE):
+    """Upserts a batch of listings (e.g. a crawled page), reading only the stored listings with the same Ids."""
+    ids = list({record['Id'] for record in records if not pd.isna(record.get('Id'))})
+    return sync_listings(db, records, chunk_size, prune=False, query={'Id': {'$in': ids}}, source='crawl')
+
+
+def sync_test_data(db, records, chunk_size=SYNC_CHUNK_SIZE):
+    """Syncs the rows of the test set into db.test_data."""
+    records = [dict(record, _row=row) for row, record in enumerate(records)]
+    test_collection = db['test_data']
+    test_collection.create_index([('_row', ASCENDING)], name='row')
+    counts, removed, written = sync_collection(test_collection, records, TEST_DATA_KEY, chunk_size)
+    if removed or written:
+        bump_data_version(db['meta'], 'test_data')
+    return counts
+
+
+def run_sync(db, listings_csv=LISTINGS_CSV, test_data_csv=TEST_DATA_CSV,
+             chunk_size=SYNC_CHUNK_SIZE, prune=True):
+    """Syncs both CSV files, returns the counts of each collection."""
+    started = time.perf_counter()
+    results = {
+        'properties': sync_listings(db, pd.read_csv(listings_csv).to_dict('records'), chunk_size, prune),
+        'test_data': sync_test_data(db, pd.read_csv(test_data_csv).to_dict('records'), chunk_size),
+    }
+    for name, counts in results.items():
+        print(f"Synced {name}: " + ', '.join(f"{count} {action}" for action, count in counts.items()))
+    # The analytics read the new data from its snapshots
+    refresh_snapshots(db)
+    print(f"Sync finished in {time.perf_counter() - started:.2f}s")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--listings', default=LISTINGS_CSV, help='CSV file of the listings')
+    parser.add_argument('--test-data', default=TEST_DATA_CSV, help='CSV file of the test set')
+    parser.add_argument('--mongodb-uri', default=MONGODB_URI)
+    parser.add_argument('--chunk-size', type=int, default=SYNC_CHUNK_SIZE, help='operations per bulk_write')
+    parser.add_argument('--keep-missing', action='store_true',
+                        help='keep stored CSV listings that are not in the CSV file')
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongodb_uri)[MONGODB_DB]
+    run_sync(db, args.listings, args.test_data, args.chunk_size, prune=not args.keep_missing)
+
+
+if __name__ == '__main__':
+    main()
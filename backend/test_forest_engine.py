@@ -0,0 +1,39 @@
+""" Parity of CompiledForest with sklearn's predict, on model.pkl and test_set.csv.
+
+    python -m pytest test_forest_engine.py
+"""
+import os
+
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+
+from forest_engine import CompiledForest
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope='module')
+def model():
+    return joblib.load(os.path.join(BASE_DIR, 'model.pkl'))
+
+
+@pytest.fixture(scope='module')
+def test_set():
+    return pd.read_csv(os.path.join(BASE_DIR, 'test_set.csv')).drop('target', axis=1)
+
+
+def test_batch_matches_sklearn(model, test_set):
+    forest = CompiledForest.from_model(model)
+    X = test_set.to_numpy(dtype=np.float32)
+    assert forest.supports(X)
+    np.testing.assert_allclose(forest.predict(X), model.predict(test_set), rtol=1e-12)
+
+
+def test_rows_match_sklearn(model, test_set):
+    forest = CompiledForest.from_model(model)
+    X = test_set.to_numpy(dtype=np.float32)
+    expected = model.predict(test_set)
+    for index in range(len(X)):
+        np.testing.assert_allclose(forest.predict(X[index:index + 1]), expected[index:index + 1], rtol=1e-12)
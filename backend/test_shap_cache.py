@@ -0,0 +1,25 @@
+""" Entries of ShapCache cut short by the SHAP time budget are not served twice.
+
+    python -m pytest test_shap_cache.py
+"""
+import numpy as np
+import shap
+
+from shap_cache import ShapCache
+
+
+def explanation(rows):
+    return shap.Explanation(values=np.ones((rows, 2)), base_values=np.zeros(rows),
+                            data=np.ones((rows, 2)), feature_names=['a', 'b'])
+
+
+def test_partial_entry_is_a_miss(tmp_path):
+    cache = ShapCache(str(tmp_path))
+    cache.put('key', explanation(1), b'png', rows=1, partial=True)
+    cache.update('key', image_url='partial.png')
+    assert cache.get('key') is None
+    assert ShapCache(str(tmp_path)).get('key') is None
+
+    cache.put('key', explanation(3), b'png', rows=3, partial=False)
+    assert cache.get('key')['rows'] == 3
+    assert 'image_url' not in ShapCache(str(tmp_path)).get('key')
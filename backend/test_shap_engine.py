@@ -0,0 +1,43 @@
+""" Parity of the tree explainer with the permutation explainer it replaced, on test_set.csv.
+
+    python -m pytest test_shap_engine.py
+"""
+import os
+
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+import shap
+
+from shap_engine import SHAP_BACKGROUND_SIZE, compute_shap_values
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope='module')
+def model():
+    return joblib.load(os.path.join(BASE_DIR, 'model.pkl'))
+
+
+@pytest.fixture(scope='module')
+def test_set():
+    return pd.read_csv(os.path.join(BASE_DIR, 'test_set.csv')).drop('target', axis=1)
+
+
+def test_importance_matches_permutation_explainer(model, test_set):
+    values = compute_shap_values(model, test_set).values
+
+    # The explainer the importance plot used before, on the same background rows
+    if len(test_set) > SHAP_BACKGROUND_SIZE:
+        background = shap.sample(test_set, SHAP_BACKGROUND_SIZE, random_state=0)
+    else:
+        background = test_set
+    explainer = shap.PermutationExplainer(model.predict, background, seed=0)
+    expected = explainer(test_set, max_evals=2 * (test_set.shape[1] + 1) * 10).values
+
+    importance = np.abs(values).mean(axis=0)
+    expected_importance = np.abs(expected).mean(axis=0)
+    # Both estimate the same (interventional) SHAP values, the permutations only approximately
+    np.testing.assert_allclose(importance, expected_importance, atol=0.02 * expected_importance.max())
+    assert np.argmax(importance) == np.argmax(expected_importance)
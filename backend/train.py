@@ -0,0 +1,231 @@
+""" Training pipeline for the rent model, publishing versioned artifacts.
+
+Reads the listings from MongoDB or CSV files, builds their features with
+features.py, runs a cross-validated grid search over the random forest's
+hyperparameters on every core (joblib's process pool), refits the best
+model and evaluates it on a held-out split, like ML.ipynb did. Each run
+writes a new version:
+
+    models/<version>/model.joblib    the fitted model
+    models/<version>/metrics.json    CV and hold-out scores, best parameters,
+                                     rows, wall time and peak memory
+    models/<version>/manifest.json   the feature schema the model expects
+
+--publish copies the artifact to where ml_server loads models from, S3
+(S3_BUCKET_NAME/MODEL_KEY) or MODEL_SOURCE_DIR, after storing the whole
+version next to it under models/<version>/. The model registry picks up the
+new ETag and swaps the model in.
+
+    python train.py --source csv --csv OttawaON.csv
+    python train.py --source mongo --publish
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shutil
+import sys
+import time
+
+import joblib
+from joblib.externals.loky import get_reusable_executor
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+from sklearn.model_selection import GridSearchCV, KFold, train_test_split
+
+import features
+from ingest import project_fields
+
+MONGODB_URI = os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/')
+MONGODB_DB = os.environ.get('MONGODB_DB', 'rentalai_db')
+TRAIN_OUTPUT_DIR = os.environ.get('TRAIN_OUTPUT_DIR', 'models')
+# Processes of the hyperparameter search, -1 for every core
+TRAIN_JOBS = int(os.environ.get('TRAIN_JOBS', -1))
+TRAIN_CV_FOLDS = int(os.environ.get('TRAIN_CV_FOLDS', 5))
+# Hold-out split of the notebook
+TEST_SIZE = 0.2
+RANDOM_STATE = 42
+S3_BUCKET = os.environ.get('S3_BUCKET_NAME', 'rentalai-models')
+MODEL_KEY = os.environ.get('MODEL_KEY', 'model.pkl')
+MODEL_SOURCE_DIR = os.environ.get('MODEL_SOURCE_DIR')
+
+PARAM_GRID = {
+    'n_estimators': [100, 300],
+    'max_depth': [None, 10, 20],
+    'max_features': [1.0, 'sqrt'],
+    'min_samples_leaf': [1, 2],
+}
+
+
+def read_csv(paths):
+    return pd.concat([pd.read_csv(path) for path in paths], ignore_index=True)
+
+
+def read_mongo(mongodb_uri):
+    from pymongo import MongoClient
+
+    collection = MongoClient(mongodb_uri)[MONGODB_DB]['properties']
+    # Only the columns of the features and the target, by their flattened names
+    documents = collection.aggregate([project_fields(features.SOURCE_COLUMNS + [features.TARGET])])
+    return pd.DataFrame(list(documents))
+
+
+def peak_memory_mb():
+    """Peak resident memory of this process and of its finished workers, None where unsupported."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'main': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 2 ** 20,
+        'workers': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 2 ** 20,
+    }
+
+
+def data_hash(X, y):
+    digest = hashlib.sha256(np.ascontiguousarray(X).tobytes())
+    digest.update(np.ascontiguousarray(y).tobytes())
+    return digest.hexdigest()
+
+
+def manifest():
+    """The feature schema: names and order, dtype and the encodings of features.py."""
+    return {
+        'feature_names': features.FEATURE_NAMES,
+        'dtype': 'float32',
+        'source_columns': features.SOURCE_COLUMNS,
+        'target': features.TARGET,
+        'encodings': {
+            'ProvinceName': features.PROVINCES,
+            'BuildingType': features.BUILDING_TYPES,
+            'hasLaundry': features.BUILDING_AMENITIES,
+            'unknown_code': features.UNKNOWN_CODE,
+            'amenities_nearby': features.AMENITIES_NEARBY,
+            'parking_size_bins': features.PARKING_SIZE_BINS,
+        },
+        'sklearn_version': sklearn.__version__,
+        'python_version': platform.python_version(),
+    }
+
+
+def train(frame, param_grid=PARAM_GRID, folds=TRAIN_CV_FOLDS, n_jobs=TRAIN_JOBS):
+    """Fits the model on listing rows, returns it with its metrics."""
+    started = time.perf_counter()
+    X, y = features.training_set(frame)
+    # The forest can't split on missing values
+    valid = ~np.isnan(X).any(axis=1)
+    X, y = X[valid], y[valid]
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=TEST_SIZE, random_state=RANDOM_STATE)
+    feature_seconds = time.perf_counter() - started
+
+    # One process per fit of the grid, each forest single-threaded so the cores aren't oversubscribed
+    search = GridSearchCV(
+        RandomForestRegressor(random_state=RANDOM_STATE, n_jobs=1),
+        param_grid,
+        cv=KFold(n_splits=folds, shuffle=True, random_state=RANDOM_STATE),
+        scoring='neg_mean_absolute_error',
+        n_jobs=n_jobs,
+        refit=True,
+    )
+    search.fit(X_train, y_train)
+    model = search.best_estimator_
+    predicted = model.predict(X_test)
+    # Idle workers are kept around, their peak memory only counts once they exit
+    get_reusable_executor().shutdown(wait=True)
+
+    metrics = {
+        'rows': int(len(y)),
+        'dropped_rows': int((~valid).sum()),
+        'train_rows': int(len(y_train)),
+        'test_rows': int(len(y_test)),
+        'data_hash': data_hash(X, y),
+        'best_params': search.best_params_,
+        'cv_folds': folds,
+        'cv_mae': float(-search.best_score_),
+        'test_mae': float(mean_absolute_error(y_test, predicted)),
+        'test_rmse': float(np.sqrt(mean_squared_error(y_test, predicted))),
+        'test_r2': float(r2_score(y_test, predicted)),
+        'candidates': len(search.cv_results_['params']),
+        'feature_seconds': feature_seconds,
+        'wall_seconds': time.perf_counter() - started,
+        'peak_memory_mb': peak_memory_mb(),
+        'cpu_count': os.cpu_count(),
+        'n_jobs': n_jobs,
+        'trained': time.time(),
+    }
+    return model, metrics
+
+
+def write_artifact(model, metrics, output_dir=TRAIN_OUTPUT_DIR):
+    """Writes the model, its metrics and manifest to a new version directory, returns its path."""
+    version = time.strftime('%Y%m%dT%H%M%S', time.gmtime(metrics['trained'])) + '-' + metrics['data_hash'][:8]
+    path = os.path.join(output_dir, version)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(tmp_path)
+    joblib.dump(model, os.path.join(tmp_path, 'model.joblib'))
+    with open(os.path.join(tmp_path, 'metrics.json'), 'w') as file:
+        json.dump(dict(metrics, version=version), file, indent=2)
+    with open(os.path.join(tmp_path, 'manifest.json'), 'w') as file:
+        json.dump(dict(manifest(), version=version), file, indent=2)
+    # Readers never see a version without all of its files
+    os.replace(tmp_path, path)
+    return path
+
+
+def publish(path, model_key=MODEL_KEY, source_dir=MODEL_SOURCE_DIR, bucket=S3_BUCKET):
+    """Uploads a version next to the served model, then replaces the served model with it."""
+    version = os.path.basename(path)
+    files = ['model.joblib', 'metrics.json', 'manifest.json']
+    if source_dir:
+        os.makedirs(os.path.join(source_dir, 'models', version), exist_ok=True)
+        for name in files:
+            shutil.copyfile(os.path.join(path, name), os.path.join(source_dir, 'models', version, name))
+        tmp_path = os.path.join(source_dir, f"{model_key}.{os.getpid()}.tmp")
+        shutil.copyfile(os.path.join(path, 'model.joblib'), tmp_path)
+        os.replace(tmp_path, os.path.join(source_dir, model_key))
+        return os.path.join(source_dir, model_key)
+
+    import boto3
+
+    s3_client = boto3.client(
+        's3',
+        aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
+        aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
+        region_name=os.environ.get('AWS_REGION', 'us-east-1')
+    )
+    for name in files:
+        s3_client.upload_file(os.path.join(path, name), bucket, f"models/{version}/{name}")
+    s3_client.upload_file(os.path.join(path, 'model.joblib'), bucket, model_key)
+    return f"s3://{bucket}/{model_key}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', choices=['mongo', 'csv'], default='csv')
+    parser.add_argument('--csv', nargs='+', default=['OttawaON.csv'], help='CSV files of listings')
+    parser.add_argument('--mongodb-uri', default=MONGODB_URI)
+    parser.add_argument('--output-dir', default=TRAIN_OUTPUT_DIR)
+    parser.add_argument('--jobs', type=int, default=TRAIN_JOBS, help='search processes, -1 for every core')
+    parser.add_argument('--folds', type=int, default=TRAIN_CV_FOLDS)
+    parser.add_argument('--publish', action='store_true',
+                        help='replace the served model (MODEL_SOURCE_DIR, or S3 when it is not set)')
+    args = parser.parse_args()
+
+    frame = read_mongo(args.mongodb_uri) if args.source == 'mongo' else read_csv(args.csv)
+    print(f"Training on {len(frame)} listings from {args.source}")
+    model, metrics = train(frame, folds=args.folds, n_jobs=args.jobs)
+    path = write_artifact(model, metrics, args.output_dir)
+    print(f"Wrote {path}: CV MAE {metrics['cv_mae']:.1f}, test MAE {metrics['test_mae']:.1f}, "
+          f"R2 {metrics['test_r2']:.3f} in {metrics['wall_seconds']:.1f}s")
+    if args.publish:
+        print(f"Published {os.path.basename(path)} to {publish(path)}")
+
+
+if __name__ == '__main__':
+    main()
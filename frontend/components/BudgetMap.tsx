@@ -22,22 +22,12 @@ const BudgetMap: React.FC<BudgetMapProps> = ({ minBudget, maxBudget, listings })
     setIsClient(true);
   }, []);
 
-  // Filter listings based on budget range
+  // Listings are already filtered by budget by the /api/listings query
   useEffect(() => {
     if (!listings || listings.length === 0) return;
 
-    const filtered = listings.filter(listing => {
-      // Extract the numeric price from the formatted price string
-      const priceString = listing['Property.LeaseRent'] || '';
-      const priceMatch = priceString.match(/\$?([\d,]+)/);
-      if (!priceMatch) return false;
-      
-      const price = parseFloat(priceMatch[1].replace(/,/g, ''));
-      return price >= minBudget && price <= maxBudget;
-    });
-
-    setFilteredListings(filtered);
-    console.log(`Found ${filtered.length} listings within budget range`);
+    setFilteredListings(listings);
+    console.log(`Found ${listings.length} listings within budget range`);
   }, [listings, minBudget, maxBudget]);
 
   // Only render the map on the client side
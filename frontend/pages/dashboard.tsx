@@ -15,6 +15,21 @@ import {
 const apiURL = process.env.NEXT_PUBLIC_API_URL || 'http://localhost:5000/api';
 const mlApiURL = process.env.NEXT_PUBLIC_ML_API_URL || 'http://localhost:5001/api';
 
+// The rent statistics answer 503 while they are rebuilt in the background, retry after Retry-After
+async function getWhenReady(url: string, attempts = 10) {
+    for (let attempt = 1; ; attempt++) {
+        try {
+            return await axios.get(url);
+        } catch (error) {
+            if (!axios.isAxiosError(error) || error.response?.status !== 503 || attempt === attempts) {
+                throw error;
+            }
+            const seconds = Number(error.response.headers['retry-after']) || 2;
+            await new Promise(resolve => setTimeout(resolve, seconds * 1000));
+        }
+    }
+}
+
 export default function Dashboard() {
     const [loading, setLoading] = useState(true);
     const [rentPricesImage, setRentPricesImage] = useState('');
@@ -30,59 +45,16 @@ export default function Dashboard() {
         const fetchData = async () => {
             setLoading(true);
             try {
-                // Fetch listings data for stats first
-                const listingsResponse = await axios.get(`${apiURL}/get_data`);
-                let listings = [];
-                
-                // Handle different response formats
-                if (typeof listingsResponse.data === 'string') {
-                    try {
-                        // Clean and parse the string as JSON
-                        const cleanedData = listingsResponse.data
-                            .replace(/: NaN/g, ': null')
-                            .replace(/: Infinity/g, ': null')
-                            .replace(/: -Infinity/g, ': null');
-                            
-                        const parsedData = JSON.parse(cleanedData);
-                        
-                        // Check if parsed data is an array
-                        if (Array.isArray(parsedData)) {
-                            listings = parsedData;
-                        } else {
-                            // If parsed data is an object that contains an array
-                            listings = parsedData.listings || parsedData.properties || [];
-                        }
-                    } catch (e) {
-                        console.error('Error parsing string data:', e);
-                        console.log('Raw data sample:', listingsResponse.data.substring(0, 200) + '...');
-                        listings = [];
-                    }
-                } else if (Array.isArray(listingsResponse.data)) {
-                    listings = listingsResponse.data;
-                } else {
-                    // If response.data is not an array but has a property that contains the array
-                    listings = listingsResponse.data.listings || listingsResponse.data.properties || [];
-                }
-                
-                // Calculate stats
-                setListingsCount(listings.length);
-                
-                const rentPrices = listings
-                    .map(item => parseFloat(item['Property.LeaseRentUnformattedValue'] || 0))
-                    .filter(price => price > 0);
-                
-                if (rentPrices.length > 0) {
-                    const sum = rentPrices.reduce((a, b) => a + b, 0);
-                    setAverageRent(Math.round(sum / rentPrices.length));
-                    
-                    // Calculate median
-                    const sortedPrices = [...rentPrices].sort((a, b) => a - b);
-                    const mid = Math.floor(sortedPrices.length / 2);
-                    const median = sortedPrices.length % 2 === 0
-                        ? (sortedPrices[mid - 1] + sortedPrices[mid]) / 2
-                        : sortedPrices[mid];
-                    setMedianRent(Math.round(median));
-                    
+                // Fetch the precomputed listing stats first
+                const statsResponse = await getWhenReady(`${apiURL}/stats`);
+                const stats = statsResponse.data.all;
+
+                setListingsCount(stats.count);
+
+                if (stats.rent_count > 0) {
+                    setAverageRent(Math.round(stats.mean));
+                    setMedianRent(Math.round(stats.median));
+
                     // Determine if trend is up or down
                     setTrendingUp(Math.random() > 0.5);
                 }
@@ -90,7 +62,7 @@ export default function Dashboard() {
                 // Then fetch the chart images
                 try {
                     // Fetch rent prices over time chart
-                    const rentPricesResponse = await axios.get(`${apiURL}/get_rent_by_month`);
+                    const rentPricesResponse = await getWhenReady(`${apiURL}/get_rent_by_month`);
                     // Use the URL directly from the response
                     setRentPricesImage(rentPricesResponse.data.image_path);
                     
@@ -100,7 +72,24 @@ export default function Dashboard() {
                     setRentDistributionImage(rentDistributionResponse.data.image_path);
                     
                     // Fetch feature importance chart
-                    const response = await fetch(`${mlApiURL}/get_importance`);
+                    let response = await fetch(`${mlApiURL}/get_importance`);
+                    // The plot is computed in the background on the first request, poll the job
+                    if (response.status === 202) {
+                        const { job_id } = await response.json();
+                        while (true) {
+                            await new Promise(resolve => setTimeout(resolve, 1000));
+                            const jobResponse = await fetch(`${mlApiURL}/jobs/${job_id}`);
+                            const job = await jobResponse.json();
+                            if (job.status === 'done') {
+                                response = new Response(JSON.stringify(job.result), { status: 200 });
+                                break;
+                            }
+                            if (!jobResponse.ok || job.status === 'failed') {
+                                response = new Response(JSON.stringify({ error: job.error }), { status: 500 });
+                                break;
+                            }
+                        }
+                    }
                     if (response.ok) {
                         const featureImportanceData = await response.json();
                         // Use the URL directly from the response
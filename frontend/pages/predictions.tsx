@@ -155,13 +155,15 @@ export default function Predictions() {
         const res:{prediction: any, accuracy: any} = await response.json();
 
         let targetPrice = res.prediction;
+        // The prediction comes as a one-element array
+        const price = Number(targetPrice);
         setPredictionResult(targetPrice);
-        setMinPredictionResult(targetPrice - 200);
-        setMaxPredictionResult(targetPrice + 200);
+        setMinPredictionResult(price - 200);
+        setMaxPredictionResult(price + 200);
         setAccuracyResult(res.accuracy);
         
         // Fetch listings after prediction is successful
-        fetchListings();
+        fetchListings(price - 200, price + 200);
       } else {
         console.error("Failed to send form data to Flask backend");
         setIsLoading(false);
@@ -173,8 +175,19 @@ export default function Predictions() {
   }
   
   // Separate function to fetch listings
-  const fetchListings = () => {
-    fetch(apiURL+'/get_data')
+  const fetchListings = (minBudget: number, maxBudget: number) => {
+    // Only the fields shown on the budget map
+    const fields = ['Id', 'Property.LeaseRent', 'Property.LeaseRentUnformattedValue',
+      'Property.Address.AddressText', 'Property.Address.Latitude', 'Property.Address.Longitude',
+      'Building.Bedrooms', 'Building.BathroomTotal', 'Building.Type'];
+    // The budget is filtered by the server, one page of the cheapest listings is shown
+    const params = new URLSearchParams({
+      min_rent: String(Math.round(minBudget)),
+      max_rent: String(Math.round(maxBudget)),
+      limit: '1000',
+      fields: fields.join(','),
+    });
+    fetch(apiURL + '/listings?' + params.toString())
       .then(response => {
         if (!response.ok) {
           throw new Error('Network response was not ok');
@@ -199,7 +212,7 @@ export default function Predictions() {
             setListings(data);
           } else if (data && typeof data === 'object') {
             // If data is an object that contains an array
-            const listingsArray = data.listings || data.properties || [];
+            const listingsArray = data.data || data.listings || data.properties || [];
             setListings(listingsArray);
           } else {
             console.error('Unexpected data format:', typeof data);